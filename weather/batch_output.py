@@ -2,18 +2,19 @@
 """
 Input a .csv with format "RouteID, Measure, Lat, Lon" and a spreadsheet will be created for every point. 
 """
-import sys, traceback, os, glob
+import sys, traceback, os, glob, json, threading
+import numpy as np
 import pandas as pd
-from datetime import date, time, timedelta
-from PyQt5.QtWidgets import QApplication, QWidget, QInputDialog, QLineEdit, QFileDialog
-from PyQt5.QtGui import QIcon
-import sql_query, vaisala_request, raster_operations, emulate_spreadsheet
-import dataframe_image as dfi
+from datetime import date, datetime, time, timedelta
+from functools import partial
+# table_image (Pillow) is only imported once a .png is saved, and spreadsheet_dataset only imports pyarrow once a dataset is opened
+import config, pipeline, sql_query, station_index, vaisala_request, raster_operations, emulate_spreadsheet, season_state, metrics, shard, spreadsheet_dataset
 
 __authors__ = "Jordan Hiatt"
 
-def create_folder_path(folder_name):
-    folder_path = os.getcwd()+'\\'+folder_name
+# parent is the working folder unless a shard (shard.py) is saving to its own
+def create_folder_path(folder_name, parent=None):
+    folder_path = (parent if parent is not None else os.getcwd())+'\\'+folder_name
     if not os.path.isdir(folder_path):
         os.makedirs(folder_path)
     return folder_path
@@ -25,129 +26,628 @@ def create_file_path(lat, lon, folder_path):
     file_path = folder_path+'\\'+file_name
     return file_path
 
+BREAKUP_MESSAGE = "CUMULATIVE THAWING INDEX > 25: IMPOSE BREAKUP LIMITS"
+
+# Pulls the fields we need out of an input row. The column names depend on whether the input is RouteNo or SegCode. 
+def read_point(row, point_type):
+    point = {}
+    # TODO: Allow routes or segcodes
+    if point_type == 'RouteNo':
+        # TODO: Where is segcode? 
+        point['lat'] = row['LAT']
+        point['lon'] = row['LON']
+        point['route_code'] = row['ROUTE']
+        point['location'] = row['MILEPOINTER']
+        point['id'] = row['id']
+        #mile_range = row['RANGE']
+        measure = 'MilePoint'
+    else:
+        point['lat'] = row['lat']
+        point['lon'] = row['lon']
+        measure = 'Measure'
+        point['location'] = row['Measure']
+
+    point['point_string'] = "{}: {}\t {}: {}".format(point_type, row.iloc[0], measure, point['location'])
+    return point
+
+# Network/DB stage: SQL history, Vaisala and the NOAA forecast. This is almost all waiting on I/O. 
+# start_day is Oct 1 or, for a point carrying on from a saved state, the day after it. 
+def fetch_point_data(row, point_type, start_day, today_string, history_df=None, forecast_df=None):
+    point = read_point(row, point_type)
+    return point, fetch_point(point, start_day, today_string, history_df, forecast_df)
+
+# The days of one point from start_day on: historical, Vaisala and then the forecast. Also sets point['observed_days']. 
+def fetch_point(point, start_day, today_string, history_df=None, forecast_df=None):
+    lat = point['lat']
+    lon = point['lon']
+
+    # RWIS, normally already pulled for every point by pull_histories
+    if history_df is None:
+        print('Pulling historical RWIS data at point ({}, {}) from {} to {}...\n'.format(lat, lon, start_day, today_string))
+        with metrics.get_metrics().timer('fetch.history'):
+            df = sql_query.pull_data(start_day, today_string, lat, lon)
+    else:
+        df = history_df
+
+    # VAISALA
+    print('Pulling very recent RWIS data from Vaisala API at point ({}, {}) from {} to {}...\n'.format(lat, lon, start_day, today_string))
+    vaisala = vaisala_request.VaisalaObject(lat, lon)
+    with metrics.get_metrics().timer('fetch.vaisala'):
+        df = vaisala.append_existing_file(df, start_day)
+    # Everything before the forecast is observed, only those days can be saved in the point's state
+    point['observed_days'] = len(df)
+
+    # NOAA, normally already sampled for every point by sample_forecasts
+    if forecast_df is None:
+        raster = raster_operations.Raster(lat, lon, True)
+        with metrics.get_metrics().timer('fetch.forecast'):
+            df = raster.get_avg_at_coordinate(df)
+    else:
+        df = pd.concat([df, forecast_df], ignore_index=True)
+    return df
+
+def point_coordinates(mp_coord_df, point_type):
+    if point_type == 'RouteNo':
+        return mp_coord_df['LAT'], mp_coord_df['LON']
+    return mp_coord_df['lat'], mp_coord_df['lon']
+
+# The saved state and earlier rows of every point that can carry on from one, None for the points that start from Oct 1
+def load_states(mp_coord_df, point_type, prev_year_start):
+    if not config.resume_seasons:
+        return [None]*len(mp_coord_df)
+    try:
+        saved = season_state.get_season_state_store().load_all(prev_year_start)
+    except Exception as e:
+        traceback.print_exc()
+        print(str(e))
+        return [None]*len(mp_coord_df)
+    lats, lons = point_coordinates(mp_coord_df, point_type)
+    states = [saved.get(season_state.point_key(lat, lon)) for lat, lon in zip(lats, lons)]
+    print('{} of {} points carry on from a saved state\n'.format(sum(state is not None for state in states), len(states)))
+    return states
+
+# The first day each point needs data for
+def start_days(states, prev_year_start):
+    starts = []
+    for state in states:
+        if state is None:
+            starts.append(prev_year_start)
+        else:
+            starts.append((datetime.strptime(state[0]['day'], '%Y-%m-%d')+timedelta(days=1)).strftime('%Y-%m-%d'))
+    return starts
+
+# Every point of the input with its position, for the points that share another point's results
+def member_points(mp_coord_df, point_type, positions):
+    members = []
+    for position in positions:
+        point = read_point(mp_coord_df.iloc[position], point_type)
+        point['position'] = position
+        members.append(point)
+    return members
+
+# Groups the points that would get exactly the same spreadsheet so each group is only fetched and run once, then handed out to every 
+# point in it. Points are grouped by everything that goes into the spreadsheet: the stations inside the radius that the historical IDW 
+# uses, the nearest stations the Vaisala IDW uses (both with distances rounded to config.dedupe_distance_decimals), the forecast they 
+# sampled, which is the same for every point in an NDFD grid cell, and where their season starts from. 
+# Returns lists of positions in input order, the first one of each group is the one that's run. 
+def plan_points(mp_coord_df, point_type, starts, states, forecasts):
+    groups = [[position] for position in range(len(mp_coord_df))]
+    if not config.dedupe_points or len(mp_coord_df) < 2:
+        return groups
+    lats, lons = point_coordinates(mp_coord_df, point_type)
+    lats, lons = lats.to_numpy(dtype=float), lons.to_numpy(dtype=float)
+    try:
+        index = station_index.get_station_index()
+        nearest, nearest_distances = index.query(lats, lons, radius=False)
+        vectors = station_index.to_unit_vectors(lats, lons)
+        within = index.tree.query_ball_point(vectors, station_index.miles_to_chord(index.radius))
+    except Exception as e:
+        traceback.print_exc()
+        print(str(e))
+        return groups
+
+    decimals = config.dedupe_distance_decimals
+    keyed = {}
+    for position in range(len(mp_coord_df)):
+        station_list = sorted(within[position])
+        distances = station_index.chord_to_miles(np.linalg.norm(index.tree.data[station_list] - vectors[position], axis=1))
+        history_key = tuple(zip(station_list, np.round(distances, decimals).tolist()))
+        vaisala_key = tuple(zip(nearest[position].tolist(), np.round(nearest_distances[position], decimals).tolist()))
+        # Without a sampled forecast the point samples its own, so it can only share with a point at the same coordinates
+        forecast = forecasts[position]
+        forecast_key = (lats[position], lons[position]) if forecast is None else (tuple(forecast['low']), tuple(forecast['high']))
+        state_key = None if states[position] is None else json.dumps(states[position][0], sort_keys=True)
+        keyed.setdefault((starts[position], state_key, history_key, vaisala_key, forecast_key), []).append(position)
+    groups = sorted(keyed.values(), key=lambda group: group[0])
+    print('{} points share their inputs with another point, {} of {} points need to be run\n'.format(
+        sum(len(group) for group in groups if len(group) > 1), len(groups), len(mp_coord_df)))
+    return groups
+
+# Pulls the historical RWIS data for every point of the input with one query and does the IDW for all of them at once. 
+# Points that start on different days (a saved state or not) are pulled separately. 
+# If that fails every point falls back to its own pull_data, same as the forecast below. 
+def pull_histories(mp_coord_df, point_type, starts, today_string):
+    lats, lons = point_coordinates(mp_coord_df, point_type)
+    lats, lons = lats.to_numpy(), lons.to_numpy()
+    histories = [None]*len(mp_coord_df)
+    for start in sorted(set(starts)):
+        positions = [position for position, point_start in enumerate(starts) if point_start == start]
+        print('Pulling historical RWIS data for {} points from {} to {}...\n'.format(len(positions), start, today_string))
+        try:
+            for position, history_df in zip(positions, sql_query.pull_data_bulk(start, today_string, lats[positions], lons[positions])):
+                histories[position] = history_df
+        except Exception as e:
+            traceback.print_exc()
+            print(str(e))
+    return histories
+
+# Downloads the recent Vaisala data for every station near any of the points, all at the same time, so each point's 
+# VaisalaObject finds it in the cache. Anything that fails here is just downloaded again by the point that needs it. 
+def prefetch_vaisala(mp_coord_df, point_type, histories, starts, today_string):
+    lats, lons = point_coordinates(mp_coord_df, point_type)
+    # Each point asks Vaisala for the days after its historical data ends, or from its first day if there isn't any
+    start_dates = []
+    for history_df, start in zip(histories, starts):
+        if history_df is not None and not history_df.empty:
+            start_dates.append((datetime.strptime(history_df['day'].iloc[-1], '%Y-%m-%d')+timedelta(days=1)).strftime('%Y-%m-%d'))
+        elif history_df is not None:
+            start_dates.append(start)
+    if len(start_dates) == 0:
+        return
+    try:
+        index = station_index.get_station_index()
+        indices, distances = index.query(lats, lons, radius=False)
+        station_ids = index.stations['id'].iloc[sorted(set(indices[indices >= 0]))].tolist()
+        print('Pulling very recent RWIS data from Vaisala API for {} stations from {} to {}...\n'.format(len(station_ids), min(start_dates), today_string))
+        vaisala_request.fetch_stations(station_ids, min(start_dates), today_string)
+    except Exception as e:
+        traceback.print_exc()
+        print(str(e))
+
+# Downloads the forecast once and samples it at every point of the input in one pass over the grid. 
+# If that fails (a bad coordinate for instance) every point falls back to sampling on its own so only the bad ones fail. 
+def sample_forecasts(mp_coord_df, point_type):
+    lats, lons = point_coordinates(mp_coord_df, point_type)
+    print('Pulling 7 day forecast data from NOAA (this may take a while)...\n')
+    try:
+        days, lows, highs, averages = raster_operations.Raster.get_avg_at_coordinates(lats, lons, files_downloaded=False)
+    except Exception as e:
+        traceback.print_exc()
+        print(str(e))
+        return [None]*len(mp_coord_df)
+    return [raster_operations.Raster.forecast_frame(days, lows[i], highs[i]) for i in range(len(mp_coord_df))]
+
+# Runs the spreadsheet for every fetched point in one go. Points that have the same days and carry on from the same row (normally all of them) 
+# are done together as one points x days matrix. Returns each point's spreadsheet and its (day, average) at the start of breakup limits, 
+# None where there isn't one. If a group fails those points are dropped, same as a point that failed to fetch. 
+# Each point's state at its last settled observed day is saved for the next run. 
+# This never raises, so one bad point can't take down the rest of the batch with it. 
+def emulate_points(points, frames, states, season):
+    spreadsheets, breakups, checkpoints = build_points(points, frames, states)
+    save_states(season, checkpoints)
+    return spreadsheets, breakups
+
+# emulate_points without saving the states, which are given back as (point key, state, rows) for save_states
+def build_points(points, frames, states, today=None):
+    try:
+        with metrics.get_metrics().timer('spreadsheet.emulate', items=len(points)):
+            spreadsheets, breakups, checkpoints = emulate_groups(points, frames, states, today)
+    except Exception as e:
+        traceback.print_exc()
+        print(str(e))
+        return [None]*len(points), [None]*len(points), []
+    print('Spreadsheets built for {} points, {} have breakup limits\n'.format(len(points), sum(breakup is not None for breakup in breakups)))
+    return spreadsheets, breakups, checkpoints
+
+def save_states(season, checkpoints):
+    try:
+        with metrics.get_metrics().timer('spreadsheet.save_states', items=len(checkpoints)):
+            season_state.get_season_state_store().save_all(season, checkpoints)
+    except Exception as e:
+        traceback.print_exc()
+        print(str(e))
+
+# The spreadsheets of points that share a day axis, as one batch. If the batch fails each point is run on its own so only 
+# the bad ones are dropped. Gives back (batch, member) for each point, None for the ones that failed. 
+def emulate_group(frames, states, positions, rows, days, today=None):
+    def build(members):
+        highs = np.array([frames[position]['high'].to_numpy(dtype=float) for position in members])
+        lows = np.array([frames[position]['low'].to_numpy(dtype=float) for position in members])
+        return emulate_spreadsheet.build_emulated_batch(np.array(days, dtype=object), highs, lows, None if rows == 0 else [states[position][0] for position in members], today)
+    try:
+        batch = build(positions)
+        return [(batch, member) for member in range(len(positions))]
+    except Exception as e:
+        traceback.print_exc()
+        print(str(e))
+    if len(positions) == 1:
+        return [None]
+    print('Running the {} points of the failed batch one at a time\n'.format(len(positions)))
+    results = []
+    for position in positions:
+        try:
+            results.append((build([position]), 0))
+        except Exception as e:
+            traceback.print_exc()
+            print(str(e))
+            results.append(None)
+    return results
+
+# today is the day the run is for, date.today() if None
+def emulate_groups(points, frames, states, today=None):
+    spreadsheets = [None]*len(points)
+    breakups = [None]*len(points)
+    checkpoints = []
+    final_day = ((today or date.today())-timedelta(days=config.season_settle_days)).strftime('%Y-%m-%d')
+    groups = {}
+    for position, df in enumerate(frames):
+        rows = 0 if states[position] is None else states[position][0]['rows']
+        groups.setdefault((rows, tuple(df['day'])), []).append(position)
+    for (rows, days), members in groups.items():
+        for position, result in zip(members, emulate_group(frames, states, members, rows, days, today)):
+            if result is None:
+                continue
+            batch, member = result
+            # A point that fails from here on is dropped on its own
+            try:
+                point = points[position]
+                earlier_df = None if states[position] is None else states[position][1]
+                spreadsheet = emulate_spreadsheet.spreadsheet_frame(batch, member, point['lat'], point['lon'], point['point_string'], earlier_df, today)
+                row = batch['breakup_row'][member]
+                breakup = (batch['breakup_day'][member], spreadsheet['average'].iloc[row]) if row >= 0 else None
+
+                # The last observed day that won't change any more, saved for every point that shares this one's spreadsheet
+                point_checkpoints = []
+                settled = [local for local in range(point['observed_days']) if days[local] <= final_day]
+                if len(settled) > 0:
+                    checkpoint_row = rows+settled[-1]
+                    state = emulate_spreadsheet.season_state(batch, member, checkpoint_row)
+                    state_rows = emulate_spreadsheet.batch_rows(batch, member)[:settled[-1]+1]
+                    for member_point in point.get('members', [point]):
+                        point_checkpoints.append((season_state.point_key(member_point['lat'], member_point['lon']), state, state_rows))
+            except Exception as e:
+                traceback.print_exc()
+                print(str(e))
+                continue
+            spreadsheets[position] = spreadsheet
+            breakups[position] = breakup
+            checkpoints.extend(point_checkpoints)
+    return spreadsheets, breakups, checkpoints
+
+# Hands a group's spreadsheet out to every point in it, each with its own metadata. Gives back (point, spreadsheet, breakup) for each. 
+def fan_out(point, df, breakup, today=None):
+    results = []
+    for member, member_point in enumerate(point['members']):
+        member_df = df if member == 0 else emulate_spreadsheet.add_metadata(df.copy(), member_point['lat'], member_point['lon'], member_point['point_string'], today)
+        results.append((member_point, member_df, breakup))
+    return results
+
+# CSV stage: saves the spreadsheet .csv, or with a dataset (spreadsheet_dataset.py) adds it to the next batch
+def save_spreadsheet(point, df, breakup, dataset, output_folder=None):
+    if dataset is None:
+        write_spreadsheet(point, df, output_folder)
+    else:
+        dataset.add(point, df, breakup)
+
+def write_spreadsheet(point, df, output_folder=None):
+    # Create folder in current directory and save df as .csv 
+    folder_path = create_folder_path("Spreadsheets", output_folder)
+    file_path = create_file_path(point['lat'], point['lon'], folder_path)
+    with metrics.get_metrics().timer('output.csv'):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        df.to_csv(file_path, index=False)
+    # html_file = df[-7:].to_html()
+
+# The 7 days from the start of breakup limits, or the last 7 days if it hasn't broken up yet
+def breakup_table(df):
+    brokenbeforelist = df[df['message'] == BREAKUP_MESSAGE].index.tolist()
+    if len(brokenbeforelist) == 0:
+        print('Not broken up yet.  Listing last 7 days')
+        return df[-7:].copy()
+    closure_index = brokenbeforelist[0]
+    return df[closure_index:closure_index+7].copy()
+
+def closure_row(point, breakup):
+    if breakup is None:
+        return None
+    #'RANGE': mile_range
+    return {'id': point['id'], 'day': breakup[0], 'average': breakup[1], 'ROUTE': point['route_code'], 'MILEPOINTER': point['location'], 'LAT': point['lat'], 'LON': point['lon']}
+
+# PNG stage: saves the .png of a breakup table. config.table_renderer picks the built in renderer (table_image.py) or dataframe_image. 
+# This has to stay a top level function so it can be sent to a process pool. 
+def save_image(table, image_id, output_folder=None):
+    file_path = "SpreadSheets\\{}.png".format(image_id)
+    if output_folder is not None:
+        file_path = create_folder_path("Spreadsheets", output_folder)+"\\{}.png".format(image_id)
+    else:
+        create_folder_path("Spreadsheets")
+    # dfi.export(df_styled,r'\\itdexpwsp01\Apps\dataanalytics\SpringBreakupReports'+"\\{}.png".format(id))
+    with metrics.get_metrics().timer('output.png'):
+        if config.table_renderer == 'dataframe_image':
+            import dataframe_image as dfi
+            dfi.export(table.style.background_gradient(), file_path)
+        else:
+            import table_image
+            table_image.render_table(table, file_path)
+
+# Every point with the same id would overwrite the same .png, so the point that's last in the input is the only one that's drawn. 
+# The milepost range has one unified answer, corresponding to whichever output has the earliest spring breakup, and all points 
+# along the range reference the same image. 
+def last_positions(mp_coord_df, point_type):
+    if point_type != 'RouteNo':
+        return {}
+    return {image_id: position for position, image_id in enumerate(mp_coord_df['id'])}
+
+# Draws the .png of every id that doesn't have one yet from the last of its points that made it through. 
+# tables is a list of (position, point, table). 
+def save_missing_images(tables, rendered, output_folder=None):
+    last = {}
+    for position, point, table in sorted(tables, key=lambda table: table[0]):
+        last[point['id']] = table
+    for image_id, table in last.items():
+        if image_id in rendered:
+            continue
+        try:
+            save_image(table, image_id, output_folder)
+        except Exception as e:
+            traceback.print_exc()
+            print(str(e))
+
+# The PNG stage of the pipeline. Only points that are the last of their id (item['render']) are sent here to be drawn, 
+# the others keep their table in case that one fails. 
+def export_image_item(item):
+    save_image(item['table'], item['point']['id'], item['output_folder'])
+    item['table'] = None
+    return item
+
+# The spreadsheet stage of the pipeline, run on a process pool since it's the part that keeps a CPU busy. Every point of a group goes on 
+# from here as its own item. The states to save ride along on the first item to the states stage, so only this process writes the file. 
+# today is the run's, a worker process doesn't go by its own clock. 
+def emulate_items(today, items):
+    spreadsheets, breakups, checkpoints = build_points([item['point'] for item in items], [item['df'] for item in items], [item['state'] for item in items], today)
+    results = []
+    for item, spreadsheet, breakup in zip(items, spreadsheets, breakups):
+        if spreadsheet is not None:
+            results.extend({'position': point['position'], 'point': point, 'spreadsheet': df, 'breakup': breakup} for point, df, breakup in fan_out(item['point'], spreadsheet, breakup, today))
+    if len(results) > 0:
+        results[0]['checkpoints'] = checkpoints
+    return results
+
+# The states stage of the pipeline, saves the states of every item that's waiting at once
+def save_item_states(season, items):
+    checkpoints = [checkpoint for item in items for checkpoint in item.pop('checkpoints', [])]
+    if len(checkpoints) > 0:
+        save_states(season, checkpoints)
+    return items
+
+# One point after another, the original way of running. Only the spreadsheets are done all at once. 
+def run_serial(mp_coord_df, point_type, prev_year_start, today_string, groups, histories, forecasts, states, dataset=None, output_folder=None):
+    starts = start_days(states, prev_year_start)
+    points = []
+    frames = []
+    point_states = []
+    for group in groups:
+        position = group[0]
+        try: 
+            point, df = fetch_point_data(mp_coord_df.iloc[position], point_type, starts[position], today_string, histories[position], forecasts[position])
+            point['members'] = member_points(mp_coord_df, point_type, group)
+            points.append(point)
+            frames.append(df)
+            point_states.append(states[position])
+        except Exception as e:
+            traceback.print_exc()
+            print(str(e))
+
+    spreadsheets, breakups = emulate_points(points, frames, point_states, prev_year_start)
+    results = []
+    for point, df, breakup in zip(points, spreadsheets, breakups):
+        if df is not None:
+            results.extend(fan_out(point, df, breakup))
+
+    # Back in input order so the closure dates and .png come out the same as running every point
+    closure_dates = []
+    tables = []
+    for point, df, breakup in sorted(results, key=lambda result: result[0]['position']):
+        try: 
+            save_spreadsheet(point, df, breakup, dataset, output_folder)
+            if point_type == 'RouteNo':
+                tables.append((point['position'], point, breakup_table(df)))
+                closure_dates.append(closure_row(point, breakup))
+        except Exception as e:
+            traceback.print_exc()
+            print(str(e))
+    # One .png for each id
+    save_missing_images(tables, set(), output_folder)
+    return closure_dates
+
+# Runs the points through a pipeline (pipeline.py): fetching on a thread pool, the spreadsheets on a process pool in batches of whatever points 
+# have been fetched so far, the .csv on a couple of threads and the .png on a process pool, so a slow .png doesn't hold up fetching the next point. 
+# A failure only drops that point, same as the serial run. Results are returned in input order so closure_dates.csv 
+# and the .png of each id come out the same as a serial run. 
+def run_pipeline(mp_coord_df, point_type, prev_year_start, today_string, groups, histories, forecasts, states, workers, dataset=None, output_folder=None):
+    starts = start_days(states, prev_year_start)
+    last = last_positions(mp_coord_df, point_type)
+
+    def fetch(item):
+        position = item['position']
+        item['point'], item['df'] = fetch_point_data(mp_coord_df.iloc[position], point_type, starts[position], today_string, histories[position], forecasts[position])
+        item['point']['members'] = member_points(mp_coord_df, point_type, item['group'])
+        item['state'] = states[position]
+        return item
+
+    # Points at the same coordinates save to the same .csv, the last one in the input is the one that's kept no matter which is written first. 
+    # Only the small breakup table goes on to the .png stage, not the whole spreadsheet. 
+    written = {}
+    file_locks = {}
+    file_locks_lock = threading.Lock()
+    def write(item):
+        if dataset is not None:
+            dataset.add(item['point'], item['spreadsheet'], item['breakup'])
+        else:
+            file_name = create_file_path(item['point']['lat'], item['point']['lon'], '')
+            with file_locks_lock:
+                file_lock = file_locks.setdefault(file_name, threading.Lock())
+            with file_lock:
+                if written.get(file_name, -1) < item['position']:
+                    write_spreadsheet(item['point'], item['spreadsheet'], output_folder)
+                    written[file_name] = item['position']
+        if point_type != 'RouteNo':
+            return {'position': item['position'], 'closure_date': None}
+        item['table'] = breakup_table(item['spreadsheet'])
+        item['closure_date'] = closure_row(item['point'], item['breakup'])
+        item['render'] = last[item['point']['id']] == item['position']
+        item['output_folder'] = output_folder
+        del item['spreadsheet']
+        return item
+
+    fetch_workers = config.pipeline_fetch_workers or workers
+    spreadsheet_workers = config.pipeline_spreadsheet_workers or min(workers, os.cpu_count() or 1)
+    png_workers = config.pipeline_png_workers or min(workers, os.cpu_count() or 1)
+    stages = [
+        pipeline.Stage('fetch', fetch, fetch_workers),
+        pipeline.Stage('spreadsheet', partial(emulate_items, datetime.strptime(today_string, '%Y-%m-%d').date()), spreadsheet_workers, processes=True, batch_size=config.spreadsheet_batch_size),
+        pipeline.Stage('states', partial(save_item_states, prev_year_start), 1, batch_size=config.spreadsheet_batch_size),
+        pipeline.Stage('csv', write, config.pipeline_csv_workers),
+    ]
+    if point_type == 'RouteNo':
+        stages.append(pipeline.Stage('png', export_image_item, png_workers, processes=True, when=lambda item: item['render']))
+    items = ({'position': group[0], 'group': group} for group in groups)
+    results = sorted(pipeline.Pipeline(stages).run(items), key=lambda result: result['position'])
+
+    # Ids whose last point failed get the .png of the last one that didn't
+    if point_type == 'RouteNo':
+        save_missing_images([(result['position'], result['point'], result['table']) for result in results if result['table'] is not None], 
+                            set(result['point']['id'] for result in results if result['render']), output_folder)
+    return [result['closure_date'] for result in results]
+
 # TODO: Every process should just return a DF instead of creating .csv files
 # So pull_data returns a DF, then append_existing_file accepts a df and returns one
-def batch_run(mp_coord_df, point_type):
-    """Long-running task."""
+def batch_run(mp_coord_df, point_type, workers=1, output_folder=None, positions=None):
+    """Long-running task. With workers > 1 the points are run concurrently."""
+    # A shard (run_shard) saves everything to output_folder and positions are where its points are in the whole input
+    # Every run starts its own metrics (metrics.py), the summary is saved even if the run fails or is cancelled
+    run_metrics = metrics.start_run()
+    reporter = metrics.LiveReporter(run_metrics, config.metrics_live_interval).start() if config.metrics_live_interval else None
+    try:
+        run_batch(mp_coord_df, point_type, workers, output_folder, positions)
+    finally:
+        if reporter is not None:
+            reporter.stop()
+        try:
+            metrics_path = os.path.join(output_folder, 'run_metrics.json') if output_folder is not None else None
+            run_metrics.write_summary(metrics_path, points=len(mp_coord_df), point_type=point_type, workers=workers)
+        except Exception as e:
+            traceback.print_exc()
+            print(str(e))
+
+# (first day of the season, today)
+def season_days():
     #prev_year = (date.today()+timedelta(days=-365)).year 
     prev_year = (date.today()+timedelta(days=-270)).year  # just get us back to year of prev Oct 1. (Julian Date of Oct 1 is normally 274)
     #prev_year = 2021
     prev_year_start = '{}-10-01'.format(prev_year)
     today_string = date.today().strftime('%Y-%m-%d')
-    closure_date_df = pd.DataFrame()
-    files_downloaded = False
+    return prev_year_start, today_string
 
-    for i, row in enumerate(mp_coord_df.iterrows()):
-        try: 
-            # TODO: Allow routes or segcodes
-            if point_type == 'RouteNo':
-                # TODO: Where is segcode? 
-                lat = row[1]['LAT']
-                lon = row[1]['LON']
-                route_code = row[1]['ROUTE']
-                location = row[1]['MILEPOINTER']
-                id = row[1]['id']
-                #mile_range = row[1]['RANGE']
-                measure = 'MilePoint'
-            else:
-                lat = row[1]['lat']
-                lon = row[1]['lon']
-                measure = 'Measure'
-                location = row[1]['Measure']
-
-            point_string = "{}: {}\t {}: {}".format(point_type, row[1][0], measure, location)
-
-            # RWIS
-            print('Pulling historical RWIS data at point ({}, {}) from {} to {}...\n'.format(lat, lon, prev_year_start, today_string))
-            df = sql_query.pull_data(prev_year_start, today_string, lat, lon)
-
-            # VAISALA
-            print('Pulling very recent RWIS data from Vaisala API at point ({}, {}) from {} to {}...\n'.format(lat, lon, prev_year_start, today_string))
-            vaisala = vaisala_request.VaisalaObject(lat, lon)
-            df = vaisala.append_existing_file(df)
-
-            # NOAA
-            print('Pulling 7 day forecast data from NOAA (this may take a while)...\n')
-            raster = raster_operations.Raster(lat, lon, files_downloaded)
-            files_downloaded = True
-            df = raster.get_avg_at_coordinate(df)
+def run_batch(mp_coord_df, point_type, workers, output_folder=None, positions=None):
+    run_metrics = metrics.get_metrics()
+    prev_year_start, today_string = season_days()
 
-            # Spreadsheet
-            df = emulate_spreadsheet.build_emulated_spreadsheet(lat, lon, point_string, df)
+    # Points with a saved state only need the days after it
+    with run_metrics.timer('batch.load_states'):
+        states = load_states(mp_coord_df, point_type, prev_year_start)
+    starts = start_days(states, prev_year_start)
 
-            # Create folder in current directory and save df as .csv 
-            folder_path = create_folder_path("Spreadsheets")
-            file_path = create_file_path(lat, lon, folder_path)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            df.to_csv(file_path, index=False)
-            # html_file = df[-7:].to_html()
+    # The forecast is sampled for every point at once up front, then points that would come out the same are only run once
+    with run_metrics.timer('batch.sample_forecasts'):
+        forecasts = sample_forecasts(mp_coord_df, point_type)
+    with run_metrics.timer('batch.plan', items=len(mp_coord_df)):
+        groups = plan_points(mp_coord_df, point_type, starts, states, forecasts)
 
-            if point_type == 'RouteNo':
-                closure_date = df[df['message'] == "CUMULATIVE THAWING INDEX > 25: IMPOSE BREAKUP LIMITS"].copy() # we get the day and average from here
-                closure_date['ROUTE'] = route_code
-                closure_date['MILEPOINTER'] = location
-                #closure_date['RANGE'] = mile_range
-                closure_date['id'] = id
-                closure_date['LAT'] = lat
-                closure_date['LON'] = lon
-                closure_date_df = closure_date_df.append(closure_date, ignore_index=True)
-
-                brokenbeforelist = df[df['message'] == "CUMULATIVE THAWING INDEX > 25: IMPOSE BREAKUP LIMITS"].index.tolist()
-                if len(brokenbeforelist) == 0:
-                    print('Not broken up yet.  Listing last 7 days')
-                    mini_df = df[-7:].copy()
-                else:
-                    closure_index = df[df['message'] == "CUMULATIVE THAWING INDEX > 25: IMPOSE BREAKUP LIMITS"].index.tolist()[0]
-                    mini_df = df[closure_index:closure_index+7].copy()
-                # So this gets the last 7 days, but what would be better is the location of the closure date right? 
-                # mini_df = df[-7:].copy()
-                # mini_df = df[closure_index:closure_index+7].copy()
-                df_styled = mini_df.style.background_gradient()
-
-                # This overwrites .png with the same name, so if there are multiple items with id '1', then there will only be one '1.png' in the end. 
-                # The point is that the milepost range should have one unified answer, corresponding to whichever output has the earliest spring breakup. 
-                # All points along the range will reference the same image. 
-                dfi.export(df_styled,"SpreadSheets\\{}.png".format(id))
-                # dfi.export(df_styled,r'\\itdexpwsp01\Apps\dataanalytics\SpringBreakupReports'+"\\{}.png".format(id))
+    # The historical data is pulled for the first point of every group at once
+    firsts = [group[0] for group in groups]
+    first_df = mp_coord_df.iloc[firsts]
+    histories = [None]*len(mp_coord_df)
+    with run_metrics.timer('batch.pull_histories', items=len(firsts)):
+        for position, history_df in zip(firsts, pull_histories(first_df, point_type, [starts[position] for position in firsts], today_string)):
+            histories[position] = history_df
+    with run_metrics.timer('batch.prefetch_vaisala'):
+        prefetch_vaisala(first_df, point_type, [histories[position] for position in firsts], [starts[position] for position in firsts], today_string)
 
-        except Exception as e:
-            traceback.print_exc()
-            print(str(e))
+    # config.output_format 'csv' saves a .csv for every point, otherwise they all go in one dataset
+    dataset = None
+    if config.output_format != 'csv':
+        dataset = spreadsheet_dataset.open_dataset(os.path.join(output_folder, 'SpreadsheetDataset') if output_folder is not None else None, positions)
+    with run_metrics.timer('batch.points', items=len(groups)):
+        if workers > 1:
+            closure_dates = run_pipeline(mp_coord_df, point_type, prev_year_start, today_string, groups, histories, forecasts, states, workers, dataset, output_folder)
+        else:
+            closure_dates = run_serial(mp_coord_df, point_type, prev_year_start, today_string, groups, histories, forecasts, states, dataset, output_folder)
+
+    if dataset is None:
+        closure_date_df = pd.DataFrame([closure_date for closure_date in closure_dates if closure_date is not None], columns=['id', 'day', 'average', 'ROUTE', 'MILEPOINTER', 'LAT', 'LON'])
+    else:
+        with run_metrics.timer('output.dataset_close'):
+            dataset.close()
+        closure_date_df = dataset.closure_dates()
     closure_date_df['average'] = closure_date_df['average'].round(2)
-    file_name = 'closure_dates.csv'
+    file_name = 'closure_dates.csv' if output_folder is None else os.path.join(output_folder, 'closure_dates.csv')
     if os.path.exists(file_name):
         os.remove(file_name)
 
     # Get the id of the min of each group, and reduce the df to only those rows. 
     # Must be turned into datetime to get a min value
     closure_date_df['day'] = pd.to_datetime(closure_date_df['day']) 
-    closure_date_df = closure_date_df.iloc[closure_date_df.groupby(['id'])['day'].idxmin(axis=0)]
+    closure_date_df = closure_date_df.loc[closure_date_df.groupby(['id'])['day'].idxmin()]
 
     # closure_date_df = closure_date_df[['id', 'day', 'average', 'ROUTE', 'RANGE', 'MILEPOINTER', 'LAT', 'LON']]
     #closure_date_df[['id', 'day', 'average', 'ROUTE', 'RANGE', 'MILEPOINTER', 'LAT', 'LON']].to_csv(file_name, index=False)
     closure_date_df[['id', 'day', 'average', 'ROUTE', 'MILEPOINTER', 'LAT', 'LON']].to_csv(file_name, index=False)
     # closure_date_df[['min_closure', 'day', 'average', 'ROUTE', 'MILEPOINTER', 'LAT', 'LON', 'CODE']].groupby(by=['CODE'])['day'].min().to_csv(file_name, index=False)
+
+# Runs only shard index of count (shard.py) and saves its outputs to the shard's folder for shard.merge_shards
+def run_shard(mp_coord_df, point_type, index, count, workers=1):
+    positions = shard.shard_positions(mp_coord_df, point_type, index, count)
+    folder = shard.shard_folder(index, count)
+    shard.clear_folder(folder)
+    create_folder_path("Spreadsheets", folder)
+    print('Shard {} of {}: {} of {} points\n'.format(index, count, len(positions), len(mp_coord_df)))
+    batch_run(mp_coord_df.iloc[positions].reset_index(drop=True), point_type, workers, folder, positions)
+    shard.write_manifest(folder, index, count, point_type, len(mp_coord_df), positions)
         
-def main(mp_coord_df, arg):
+def main(mp_coord_df, arg, workers=1, shard_number=None):
     # take in excel spreadsheet of mile pointers, convert to coordinates
     # run each thing and save in a spreadsheets folder
     # TODO: CSV should have type of input and measure at the beginning of the file
-    if arg == '-s':
-        batch_run(mp_coord_df, 'SegCode')
-    elif arg == '-r':
-        batch_run(mp_coord_df, 'RouteNo')
+    # shard_number is (i, N) to run only shard i of N
+    if arg in ('-s', '-r'):
+        point_type = 'SegCode' if arg == '-s' else 'RouteNo'
+        if shard_number is None:
+            batch_run(mp_coord_df, point_type, workers)
+        else:
+            run_shard(mp_coord_df, point_type, shard_number[0], shard_number[1], workers)
     else:
         print('Argument error, use -s for SegCode/MP and -r for RouteNo/MP')
 
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 3:
-        # Remove all current files
-        files = glob.glob('Spreadsheets'+'\*')
-        for f in files:
-            os.remove(f)
+    # --shard i/N can go anywhere after the file name
+    args = sys.argv[1:]
+    shard_number = None
+    if '--shard' in args and args.index('--shard') + 1 < len(args):
+        at = args.index('--shard')
+        shard_number = shard.parse_shard(args[at + 1])
+        del args[at:at + 2]
+    if len(args) == 2 and args[0] == '--merge':
+        shard.merge_shards(int(args[1]))
+    elif len(args) in (2, 3):
+        # Remove all current files, a shard only clears its own folder
+        if shard_number is None:
+            files = glob.glob('Spreadsheets'+'\*')
+            for f in files:
+                os.remove(f)
             
         # TODO: Uncomment this to do a permission test on the ITD folder. 
         # leaf_dir = r'permission_test'
@@ -163,12 +663,15 @@ if __name__ == "__main__":
 
 
         # If this is the primary file and not used as a module, check arguments for .csv
-        df = pd.read_csv(sys.argv[1])
+        df = pd.read_csv(args[0])
         # TODO Remember that this is cutting off the .csv
         #df = df[:3]
-        main(df, sys.argv[2])
+        # Optional worker count, 1 runs the points one at a time
+        workers = int(args[2]) if len(args) == 3 else 1
+        main(df, args[1], workers, shard_number)
     else:
-        print("Error: python batch_outut.py <filename.csv> <-s/-r>")
+        print("Error: python batch_outut.py <filename.csv> <-s/-r> [workers] [--shard i/N]")
+        print("   or: python batch_outut.py --merge N")
         # output_routeno_milepointer
         print("Try routes_with_lon_lat.csv or ROUTENO_MILEPOINTER.csv")
         print("Use -s for SegCode/MP and -r for RouteNo/MP")
\ No newline at end of file
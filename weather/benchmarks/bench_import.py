@@ -0,0 +1,107 @@
+"""
+Import time of each weather module, from python -X importtime in a fresh interpreter, so a module that starts pulling in something heavy
+at import again shows up. Every import also runs in an empty scratch folder with sockets blocked, and any file it leaves behind or any
+connection it tries is reported, since importing a module shouldn't touch the disk or the network.
+--top lists the slowest imports underneath the slowest module. Results save and compare the same way as bench_suite.py:
+    python benchmarks/bench_import.py --weather ../before/weather --save before.json
+    python benchmarks/bench_import.py --save after.json
+    python benchmarks/bench_suite.py --compare before.json after.json
+Run from the weather folder.
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_suite import commit_of
+
+__authors__ = "Jordan Hiatt"
+
+MODULES = ['config', 'metrics', 'record_batch', 'db', 'station_index', 'sql_query', 'vaisala_cache', 'vaisala_request', 'forecast_download',
+           'raster_operations', 'grib', 'emulate_spreadsheet', 'season_state', 'pipeline', 'table_image', 'spreadsheet_dataset', 'shard',
+           'batch_output', 'service', 'wx_nws_api']
+
+# Any connection made while importing fails with this
+BLOCK_SOCKETS = ("import socket\n"
+                 "def blocked(*args, **kwargs):\n"
+                 "    raise RuntimeError('network access while importing')\n"
+                 "socket.socket.connect = blocked\n"
+                 "socket.create_connection = blocked\n"
+                 "socket.getaddrinfo = blocked\n")
+
+# (cumulative seconds of module, {package: cumulative seconds}) from the -X importtime lines on stderr
+def parse_importtime(stderr, module):
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, package = line[len('import time:'):].split('|')
+        packages[package.strip()] = int(cumulative_us)/1e6
+    return packages.get(module), packages
+
+# One import of module in a fresh interpreter. Returns (seconds, packages, files left behind, error)
+def import_once(weather_folder, module):
+    with tempfile.TemporaryDirectory() as folder:
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([weather_folder] + [p for p in os.environ.get('PYTHONPATH', '').split(os.pathsep) if p]))
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', BLOCK_SOCKETS+'import '+module], cwd=folder, env=env,
+                                capture_output=True, text=True)
+        left_behind = sorted(os.listdir(folder))
+    if result.returncode != 0:
+        return None, {}, left_behind, result.stderr.strip().splitlines()[-1]
+    seconds, packages = parse_importtime(result.stderr, module)
+    return seconds, packages, left_behind, None
+
+def run(weather_folder, modules, repeats, top):
+    weather_folder = os.path.abspath(weather_folder)
+    results = {'commit': commit_of(weather_folder), 'python': sys.version.split()[0], 'cases': {}}
+    slowest = (0, None, {})
+    print('{:<24} {:>12} {:>12}  {}'.format('module', 'median (ms)', 'min (ms)', 'side effects'))
+    for module in modules:
+        times = []
+        error = None
+        left_behind = []
+        for i in range(repeats):
+            seconds, packages, left_behind, error = import_once(weather_folder, module)
+            if error is not None:
+                break
+            times.append(seconds)
+        name = 'import.'+module
+        if error is not None:
+            results['cases'][name] = {'error': error}
+            print('{:<24} error: {}'.format(module, error))
+            continue
+        times = np.array(times)
+        results['cases'][name] = {'calls': len(times), 'min': float(times.min()), 'median': float(np.median(times)), 'mean': float(times.mean()),
+                                  'files': left_behind}
+        print('{:<24} {:>12.1f} {:>12.1f}  {}'.format(module, np.median(times)*1000, times.min()*1000,
+                                                     'wrote ' + ', '.join(left_behind) if left_behind else '-'))
+        if np.median(times) > slowest[0]:
+            slowest = (float(np.median(times)), module, packages)
+
+    if top and slowest[1] is not None:
+        print('\nSlowest imports under {}:'.format(slowest[1]))
+        packages = sorted(slowest[2].items(), key=lambda item: -item[1])
+        for package, seconds in packages[:top]:
+            print('{:<40} {:>10.1f} ms'.format(package, seconds*1000))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time of the weather modules')
+    parser.add_argument('--weather', default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), help='weather folder to time')
+    parser.add_argument('--repeats', type=int, default=5, help='imports of each module')
+    parser.add_argument('--top', type=int, default=15, help='slowest imports to list under the slowest module')
+    parser.add_argument('--save', default=None, help='save the results as JSON')
+    parser.add_argument('modules', nargs='*', help='modules to import, all of them by default')
+    args = parser.parse_args()
+
+    results = run(args.weather, args.modules or MODULES, args.repeats, args.top)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
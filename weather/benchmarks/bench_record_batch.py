@@ -0,0 +1,65 @@
+"""
+Compares building the day/high/low DataFrame a row at a time with DataFrame.append against RecordBatchBuilder, for a season's worth of
+rows (about 250) and more. Prints the total time and the time per row of each and checks that both give the same DataFrame.
+DataFrame.append is gone in pandas 2.0, there only the builder is timed.
+Run from the weather folder: python benchmarks/bench_record_batch.py [max rows]
+"""
+import os
+import sys
+import time
+import warnings
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import record_batch
+
+__authors__ = "Jordan Hiatt"
+
+# Rows shaped like the ones the historical SQL gives back
+def make_rows(row_count, seed=0):
+    rng = np.random.default_rng(seed)
+    start = date(2021, 10, 1)
+    highs = rng.uniform(20, 60, row_count)
+    return [((start+timedelta(days=i)).strftime('%Y-%m-%d'), float(highs[i]), float(highs[i]-rng.uniform(1, 20))) for i in range(row_count)]
+
+# The way pull_data used to do it
+def build_append(rows):
+    df = pd.DataFrame(columns=['day', 'high', 'low'])
+    for row in rows:
+        df = df.append({'day':row[0], 'high':row[1], 'low':row[2]},ignore_index=True)
+    return df
+
+def build_builder(rows):
+    hi_lo = record_batch.RecordBatchBuilder([('day', object), ('high', float), ('low', float)])
+    for row in rows:
+        hi_lo.append_values(row)
+    return hi_lo.build()
+
+def measure(build, rows, repeats):
+    start = time.perf_counter()
+    for i in range(repeats):
+        df = build(rows)
+    return df, (time.perf_counter() - start)/repeats
+
+def main(max_rows):
+    has_append = hasattr(pd.DataFrame, 'append')
+    print('{:>8} {:>12} {:>16} {:>12} {:>16}'.format('rows', 'append (s)', 'append (us/row)', 'builder (s)', 'builder (us/row)'))
+    row_count = 250
+    while row_count <= max_rows:
+        rows = make_rows(row_count)
+        builder_df, builder_time = measure(build_builder, rows, 5)
+        if has_append:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', FutureWarning)
+                append_df, append_time = measure(build_append, rows, 1)
+            pd.testing.assert_frame_equal(append_df, builder_df)
+            append_columns = '{:>12.4f} {:>16.1f}'.format(append_time, append_time/row_count*1e6)
+        else:
+            append_columns = '{:>12} {:>16}'.format('-', '-')
+        print('{:>8} {} {:>12.4f} {:>16.1f}'.format(row_count, append_columns, builder_time, builder_time/row_count*1e6))
+        row_count *= 4
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 16000)
@@ -0,0 +1,158 @@
+"""
+Runs service.py fully offline against local stand-ins for every upstream and times single point queries through it:
+a SQLite wx_history (config.db_backend = 'sqlite'), a local HTTP server answering the Vaisala export with generated XML and serving
+synthetic NDFD files (fixtures.py), all in a scratch folder. Without GDAL the forecast is a fixed stand-in instead of the NDFD files.
+Prints the time of a cold query, of the same query again (kept answer), of a query after a refresh (carries on from the season state a batch run saved),
+how many times the spreadsheet was built for a burst of identical concurrent queries, and the time of a burst of different points.
+Run from the weather folder: python benchmarks/bench_service.py [concurrent queries]
+"""
+import os
+import sys
+import io
+import time
+import shutil
+import tempfile
+import threading
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fixtures
+
+__authors__ = "Jordan Hiatt"
+
+# The Vaisala export and the NDFD files. Vaisala gets one station with a reading every hour over the days asked for.
+class StandInHandler(BaseHTTPRequestHandler):
+    forecast_folder = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/vaisala':
+            body = fixtures.vaisala_response(parse_qs(url.query))
+        elif url.path.startswith('/ndfd/') and self.forecast_folder is not None:
+            name = {'VP.001-003/ds.mint.bin': 'days1to3min.tif', 'VP.004-007/ds.mint.bin': 'days4to7min.tif',
+                    'VP.001-003/ds.maxt.bin': 'days1to3max.tif', 'VP.004-007/ds.maxt.bin': 'days4to7max.tif'}.get(url.path[len('/ndfd/'):])
+            if name is None:
+                self.send_error(404)
+                return
+            with open(os.path.join(self.forecast_folder, name), 'rb') as f:
+                body = f.read()
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# A week of forecast from tomorrow, for when GDAL isn't there to read the NDFD stand-ins
+def forecast_stand_in(lat, lon):
+    import raster_operations
+    days = [(date.today()+timedelta(days=i+1)).strftime('%Y-%m-%d') for i in range(7)]
+    lows = np.linspace(20, 30, 7) + (lat-45)
+    return raster_operations.Raster.forecast_frame(days, lows, lows+15)
+
+def start_thread(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return thread
+
+# The service prints as much as a batch run does, only these lines are shown
+def report(text):
+    print(text, file=sys.__stdout__)
+
+def main(concurrent):
+    folder = tempfile.mkdtemp()
+    sys.stdout = io.StringIO()
+    os.chdir(folder)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import config
+    fixtures.write_reference_temps(folder)
+    stations_df = fixtures.make_stations(80)
+    season_start = '{}-10-01'.format((date.today()+timedelta(days=-270)).year)
+    fixtures.write_history_db(os.path.join(folder, 'wx_history.sqlite'), stations_df, season_start, date.today().strftime('%Y-%m-%d'))
+
+    stand_in = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    start_thread(stand_in)
+    base_url = 'http://127.0.0.1:{}'.format(stand_in.server_address[1])
+    config.db_backend = 'sqlite'
+    config.db_sqlite_path = os.path.join(folder, 'wx_history.sqlite')
+    config.station_cache_path = os.path.join(folder, 'station_locations.csv')
+    config.vaisala_cache_path = os.path.join(folder, 'vaisala_cache.sqlite')
+    config.season_state_path = os.path.join(folder, 'season_state.sqlite')
+    config.forecast_cache_folder = os.path.join(folder, 'ForecastCache')
+    config.vaisala_export_url = base_url+'/vaisala?username=stand-in'
+    config.ndfd_base_url = base_url+'/ndfd'
+
+    import service, batch_output, raster_operations
+    forecast = None
+    try:
+        StandInHandler.forecast_folder = os.path.join(folder, 'ndfd')
+        os.makedirs(StandInHandler.forecast_folder)
+        fixtures.write_lambert_forecasts(StandInHandler.forecast_folder)
+        raster_operations.file_paths[:] = [(os.path.join(config.forecast_cache_folder, os.path.basename(f[0])), f[1], f[2]) for f in raster_operations.file_paths]
+    except Exception as e:
+        report('No NDFD stand-in ({}), using a fixed forecast'.format(e))
+        forecast = forecast_stand_in
+
+    breakup_service = service.BreakupService(forecast=forecast)
+    start = time.perf_counter()
+    breakup_service.warm()
+    report('warm up {:.3f}s'.format(time.perf_counter() - start))
+    server = service.make_server(breakup_service, port=0)
+    start_thread(server)
+    url = 'http://127.0.0.1:{}/breakup'.format(server.server_address[1])
+
+    def query(lat, lon):
+        start = time.perf_counter()
+        response = requests.get(url, params={'lat': lat, 'lon': lon})
+        response.raise_for_status()
+        return time.perf_counter() - start, response.json()
+
+    def emulate_calls():
+        return service.metrics.get_metrics().summary()['names'].get('spreadsheet.emulate', {}).get('calls', 0)
+
+    lats, lons = fixtures.make_points(concurrent+2)
+    seconds, answer = query(lats[0], lons[0])
+    report('cold query {:.3f}s (breakup {}, status {})'.format(seconds, answer['breakup'], answer['roadway_status']))
+    times = [query(lats[0], lons[0])[0] for i in range(100)]
+    report('same query again {:.2f}ms median over 100'.format(np.median(times)*1000))
+    # The batch run saves the point's season state, which the service reads on its next refresh
+    season, today_string = batch_output.season_days()
+    point = {'lat': lats[0], 'lon': lons[0], 'location': '', 'point_string': ''}
+    df = batch_output.fetch_point(point, batch_output.start_days([None], season)[0], today_string, forecast_df=breakup_service.forecast(lats[0], lons[0]))
+    batch_output.emulate_points([point], [df], [None], season)
+    breakup_service.refresh()
+    seconds, answer = query(lats[0], lons[0])
+    report('after a refresh {:.3f}s'.format(seconds))
+
+    # Identical queries at the same moment only build the spreadsheet once
+    before = emulate_calls()
+    with ThreadPoolExecutor(max_workers=concurrent) as pool:
+        start = time.perf_counter()
+        list(pool.map(lambda i: query(lats[1], lons[1]), range(concurrent)))
+        seconds = time.perf_counter() - start
+    report('{} identical concurrent queries {:.3f}s, spreadsheet built {} time(s)'.format(concurrent, seconds, emulate_calls() - before))
+
+    with ThreadPoolExecutor(max_workers=concurrent) as pool:
+        start = time.perf_counter()
+        list(pool.map(lambda i: query(lats[i+2], lons[i+2]), range(concurrent)))
+        seconds = time.perf_counter() - start
+    report('{} different concurrent queries {:.3f}s'.format(concurrent, seconds))
+
+    server.shutdown()
+    stand_in.shutdown()
+    breakup_service.stop()
+    sys.stdout = sys.__stdout__
+    os.chdir(tempfile.gettempdir())
+    shutil.rmtree(folder, ignore_errors=True)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 16)
@@ -0,0 +1,249 @@
+"""
+Times the public entry points on synthetic inputs (fixtures.py), with no network, database or NOAA files needed:
+build_emulated_spreadsheet on one season, on three separate seasons and on a run of points, VaisalaObject.get_vaisala_xml on exports of
+increasing size, the Vaisala IDW in get_hi_lo_interpolated over a season, and Raster.get_avg_at_coordinate on synthetic Lambert GeoTIFFs
+(needs GDAL). The Vaisala export is a local HTTP stand-in, requests for the export host are sent to it, so the download, the parsing and
+(where a commit has one) the observation cache are all in the times. Every case is run until it has taken at least --min-time seconds and
+the min/median/mean of a call are printed.
+
+Comparing commits: save the results of each one and compare them. --weather runs the suite against the weather folder of another
+checkout, so the same cases are timed on both. Only functions every commit has are called, the few bits of setup that differ are checked for.
+    git worktree add ../before <commit>
+    python benchmarks/bench_suite.py --weather ../before/weather --save before.json
+    python benchmarks/bench_suite.py --save after.json
+    python benchmarks/bench_suite.py --compare before.json after.json
+Run from the weather folder. -k only runs the cases with that text in their name.
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import warnings
+import tempfile
+import platform
+import subprocess
+import contextlib
+from urllib.parse import urlparse
+import numpy as np
+from requests.adapters import HTTPAdapter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fixtures
+
+__authors__ = "Jordan Hiatt"
+
+# Older commits have the export url written into vaisala_request, so requests for this host go to the stand-in whatever the url is
+VAISALA_HOST = 'exportdb.vaisala.io'
+SEASON_DAYS = ('2021-10-01', '2022-06-07')
+LOCATION = 'RouteNo: 1\t MilePoint: 1.0'
+
+# name -> setup function. Setup gets a scratch folder and returns the function to time.
+CASES = {}
+
+def case(name):
+    def register(setup):
+        CASES[name] = setup
+        return setup
+    return register
+
+# Starts the Vaisala stand-in (fixtures.VaisalaStandIn) and sends every request for VAISALA_HOST to it until the block ends
+@contextlib.contextmanager
+def vaisala_stand_in():
+    server = fixtures.start_server(fixtures.VaisalaStandIn)
+    base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    send = HTTPAdapter.send
+
+    def redirected(adapter, request, *args, **kwargs):
+        url = urlparse(request.url)
+        if url.hostname == VAISALA_HOST:
+            request.url = base_url + url.path + ('?'+url.query if url.query else '')
+        return send(adapter, request, *args, **kwargs)
+
+    HTTPAdapter.send = redirected
+    try:
+        yield base_url
+    finally:
+        HTTPAdapter.send = send
+        server.shutdown()
+        server.server_close()
+
+# Each call gets its own copy, older commits add their columns to the frame they're given
+@case('emulate_spreadsheet.build_emulated_spreadsheet_season')
+def setup_emulate_season(folder):
+    import emulate_spreadsheet
+    df = fixtures.make_hi_lo(250)
+    return lambda: emulate_spreadsheet.build_emulated_spreadsheet(45.0, -114.0, LOCATION, df.copy())
+
+# Three seasons of their own (Oct 1 2019, 2020 and 2021, different weather each), one spreadsheet each
+@case('emulate_spreadsheet.build_emulated_spreadsheet_3_seasons')
+def setup_emulate_seasons(folder):
+    import emulate_spreadsheet
+    seasons = [fixtures.make_hi_lo(250, seed, season_year=year) for seed, year in enumerate((2019, 2020, 2021))]
+
+    def build_seasons():
+        for df in seasons:
+            emulate_spreadsheet.build_emulated_spreadsheet(45.0, -114.0, LOCATION, df.copy())
+    return build_seasons
+
+# One spreadsheet after another for 100 points, the way a batch run calls it point by point
+@case('emulate_spreadsheet.build_emulated_spreadsheet_100_points')
+def setup_emulate_points(folder):
+    import emulate_spreadsheet
+    lats, lons = fixtures.make_points(100)
+    frames = [fixtures.make_hi_lo(250, seed) for seed in range(100)]
+
+    def build_points():
+        for lat, lon, df in zip(lats, lons, frames):
+            emulate_spreadsheet.build_emulated_spreadsheet(lat, lon, LOCATION, df.copy())
+    return build_points
+
+def vaisala_xml_case(observation_count):
+    def setup(folder):
+        import vaisala_request
+        vaisala = vaisala_request.VaisalaObject(45.0, -114.0)
+        return lambda: vaisala.get_vaisala_xml('export-{}'.format(observation_count), *SEASON_DAYS)
+    return setup
+
+case('vaisala.get_vaisala_xml_10k_observations')(vaisala_xml_case(10000))
+case('vaisala.get_vaisala_xml_100k_observations')(vaisala_xml_case(100000))
+
+# The 8 nearest of 80 stations over a season. get_station_ids (SQL Server) is replaced with the same nearest stations worked out here.
+# Cold: where a commit keeps an observation cache every call starts from an empty one, so every station is downloaded each time.
+# Repeated: the same query over and over, a commit with a cache answers from it after the first call.
+def vaisala_idw_case(cold):
+    def setup(folder):
+        import vaisala_request
+        try:
+            import vaisala_cache
+        except ImportError:
+            vaisala_cache = None
+        lats, lons = fixtures.make_points(1)
+        nearest_df = fixtures.nearest_stations(fixtures.make_stations(80), lats[0], lons[0])
+        vaisala = vaisala_request.VaisalaObject(lats[0], lons[0])
+        vaisala.get_station_ids = lambda *args, **kwargs: nearest_df.copy()
+        if vaisala_cache is not None:
+            vaisala_cache.observation_cache = vaisala_cache.ObservationCache(path=':memory:')
+
+        def interpolate():
+            if cold and vaisala_cache is not None:
+                vaisala_cache.observation_cache = vaisala_cache.ObservationCache(path=':memory:')
+            return vaisala.get_hi_lo_interpolated(*SEASON_DAYS)
+        return interpolate
+    return setup
+
+case('vaisala.get_hi_lo_interpolated_season')(vaisala_idw_case(True))
+case('vaisala.get_hi_lo_interpolated_season_repeated')(vaisala_idw_case(False))
+
+# The forecast files are made once for every raster case
+def forecast_files(folder):
+    import raster_operations
+    # GDAL is loaded the way the forecast code loads it, where a commit loads it lazily, before the fixtures use it
+    if hasattr(raster_operations, 'get_gdal') and raster_operations.get_gdal() is None:
+        raise ImportError('GDAL is needed for the forecast files')
+    forecast_folder = os.path.join(folder, 'forecast')
+    if not os.path.isdir(forecast_folder):
+        os.makedirs(forecast_folder)
+        raster_operations.file_paths[:] = fixtures.write_lambert_forecasts(forecast_folder)
+    return raster_operations.file_paths
+
+# A new Raster each call, older commits flip the sign of the longitude on the one they're given every time it's sampled
+def raster_case(point_count):
+    def setup(folder):
+        import raster_operations
+        forecast_files(folder)
+        history_df = fixtures.make_hi_lo(250)
+        lats, lons = fixtures.make_points(point_count)
+
+        def sample():
+            for lat, lon in zip(lats, lons):
+                raster_operations.Raster(lat, lon, True).get_avg_at_coordinate(history_df.copy())
+        return sample
+    return setup
+
+case('raster.get_avg_at_coordinate_one_point')(raster_case(1))
+case('raster.get_avg_at_coordinate_20_points')(raster_case(20))
+
+# Calls function until it has run for min_time seconds (and at least min_calls times), the code's own printing and warnings are thrown away
+def measure(function, min_time, min_calls=3):
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        function()
+        started = time.perf_counter()
+        while len(times) < min_calls or time.perf_counter() - started < min_time:
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+    times = np.array(times)
+    return {'calls': len(times), 'min': float(times.min()), 'median': float(np.median(times)), 'mean': float(times.mean())}
+
+def commit_of(folder):
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=folder, capture_output=True, text=True).stdout.strip()
+    except Exception:
+        return ''
+
+def run(weather_folder, keyword, min_time):
+    weather_folder = os.path.abspath(weather_folder)
+    sys.path.insert(0, weather_folder)
+    results = {'commit': commit_of(weather_folder), 'python': platform.python_version(), 'numpy': np.__version__, 'cases': {}}
+    print('{:<60} {:>7} {:>12} {:>12} {:>12}'.format('case', 'calls', 'min (s)', 'median (s)', 'mean (s)'))
+    # The weather modules make folders and read reference_temp.csv in the working folder, so everything happens in a scratch one
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        fixtures.write_reference_temps(folder)
+        with vaisala_stand_in():
+            for name, setup in CASES.items():
+                if keyword and keyword not in name:
+                    continue
+                try:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        function = setup(folder)
+                    result = measure(function, min_time)
+                except Exception as e:
+                    results['cases'][name] = {'error': '{}: {}'.format(type(e).__name__, e)}
+                    print('{:<60} error: {}'.format(name, results['cases'][name]['error']))
+                    continue
+                results['cases'][name] = result
+                print('{:<60} {:>7} {:>12.6f} {:>12.6f} {:>12.6f}'.format(name, result['calls'], result['min'], result['median'], result['mean']))
+        os.chdir(tempfile.gettempdir())
+    return results
+
+# Median time of every case in two saved runs and how much faster the second one is
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print('{:<60} {:>14} {:>14} {:>9}'.format('case', before.get('commit') or before_path, after.get('commit') or after_path, 'speedup'))
+    for name in sorted(set(before['cases']) | set(after['cases'])):
+        old, new = before['cases'].get(name, {}), after['cases'].get(name, {})
+        if 'median' not in old or 'median' not in new:
+            print('{:<60} {:>14} {:>14} {:>9}'.format(name, '{:.6f}'.format(old['median']) if 'median' in old else '-',
+                                                      '{:.6f}'.format(new['median']) if 'median' in new else '-', '-'))
+            continue
+        print('{:<60} {:>14.6f} {:>14.6f} {:>8.2f}x'.format(name, old['median'], new['median'], old['median']/new['median']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the hot paths on synthetic inputs')
+    parser.add_argument('--weather', default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), help='weather folder to time')
+    parser.add_argument('-k', dest='keyword', default=None, help='only run cases with this in their name')
+    parser.add_argument('--min-time', type=float, default=1.0, help='seconds to keep running each case')
+    parser.add_argument('--save', default=None, help='save the results as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two saved results instead of running')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    # run works in a scratch folder, so the path is made absolute first
+    save_path = os.path.abspath(args.save) if args.save else None
+    results = run(args.weather, args.keyword, args.min_time)
+    if save_path:
+        with open(save_path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Compares the streaming Vaisala XML parser against the old version that built the whole tree, on generated exports of increasing size.
+Prints the time and peak memory of each and checks that both give the same DataFrame.
+Run from the weather folder: python benchmarks/bench_vaisala_xml.py [max observations]
+"""
+import io
+import os
+import sys
+import time
+import tracemalloc
+import xml.etree.ElementTree as et
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import vaisala_request
+import fixtures
+
+__authors__ = "Jordan Hiatt"
+
+# The parser as it was before streaming, kept here to compare against
+def parse_tree(xml_bytes):
+    site = []
+    timestamp = []
+    t    = []
+    rh   = []
+    ts   = []
+    st   = []
+    xroot = et.fromstring(xml_bytes.decode('utf-8'))
+    for instance in xroot:
+        for name in instance.iter('name'):
+            foo1 = name.text
+        for resultOf in instance.iter('resultOf'):
+            foo2 = resultOf.get('timestamp')
+            foo3, foo4, foo5, foo6 = -999.99,-999.99,-999.99,-999.99,
+            for val in resultOf.findall('value'):
+                if val.get('code') == 'T':
+                    foo3 = float(val.text)
+                if val.get('code') == 'RH':
+                    foo4 = float(val.text)
+                if val.get('code') == 'TS':
+                    foo5 = float(val.text)
+                if val.get('code') == 'ST':
+                    foo6 = float(val.text)
+            site.append(foo1)
+            timestamp.append(foo2)
+            t.append(foo3)
+            rh.append(foo4)
+            ts.append(foo5)
+            st.append(foo6)
+    return pd.DataFrame({'site':site, 'timestamp':timestamp, 't':t, 'rh':rh, 'ts':ts, 'st':st})
+
+# Time and memory are measured on separate runs since tracing every allocation slows the parse down a lot
+def measure(parse, xml_bytes):
+    start = time.perf_counter()
+    df = parse(xml_bytes)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    parse(xml_bytes)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return df, elapsed, peak
+
+def main(max_observations):
+    print('{:>12} {:>12} {:>12} {:>14} {:>14}'.format('observations', 'tree (s)', 'stream (s)', 'tree peak MB', 'stream peak MB'))
+    observation_count = 1000
+    while observation_count <= max_observations:
+        xml_bytes = fixtures.make_vaisala_export(observation_count)
+        tree_df, tree_time, tree_peak = measure(parse_tree, xml_bytes)
+        # The response is a stream, so the source is a file-like object here too
+        stream_df, stream_time, stream_peak = measure(lambda b: vaisala_request.parse_vaisala_xml(io.BytesIO(b)), xml_bytes)
+        pd.testing.assert_frame_equal(tree_df, stream_df)
+        print('{:>12} {:>12.3f} {:>12.3f} {:>14.1f} {:>14.1f}'.format(len(tree_df), tree_time, stream_time, tree_peak/1e6, stream_peak/1e6))
+        observation_count *= 4
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 256000)
@@ -0,0 +1,202 @@
+"""
+Synthetic inputs for the benchmarks, all made locally so nothing needs the network, the database or the real NOAA files.
+Each one is seeded so every run (and every commit being compared) gets exactly the same data.
+"""
+import os
+import time
+import zlib
+import random
+import sqlite3
+import threading
+from datetime import date, datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+
+__authors__ = "Jordan Hiatt"
+
+SEASON_START = date(2021, 10, 1)
+
+# NDFD grids are on a Lambert conformal conic projection with these parameters
+NDFD_LAMBERT = '+proj=lcc +lat_1=25 +lat_2=25 +lat_0=25 +lon_0=-95 +x_0=0 +y_0=0 +R=6371200 +units=m +no_defs'
+# Roughly the area of the pacnwest sector
+PACNWEST_BOUNDS = (-126.0, 40.0, -108.0, 51.0)
+
+# The reference_temp.csv the spreadsheet compares against, one value a day from Oct 1
+def write_reference_temps(folder, day_count=366):
+    days = np.arange(day_count)
+    temps = 45.0 - 20.0*np.sin(2*np.pi*days/365.0)
+    pd.DataFrame(temps).to_csv(os.path.join(folder, 'reference_temp.csv'), header=False, index=False)
+
+# Daily highs and lows from Oct 1 (of SEASON_START's year or season_year) that go below freezing in the winter and thaw in the spring,
+# like a point in Idaho
+def make_hi_lo(day_count, seed=0, season_year=None):
+    rng = np.random.default_rng(seed)
+    days = np.arange(day_count)
+    average = 40.0 - 25.0*np.sin(2*np.pi*days/365.0) + rng.normal(0, 6, day_count)
+    spread = rng.uniform(8, 25, day_count)
+    season_start = SEASON_START if season_year is None else date(season_year, 10, 1)
+    return pd.DataFrame({
+        'day': [(season_start+timedelta(days=int(i))).strftime('%Y-%m-%d') for i in days],
+        'high': average+spread/2,
+        'low': average-spread/2,
+    })
+
+# A Vaisala XML export with a number of stations, each with an observation every so many minutes from start (Oct 1 2021 by default).
+# With seed_by_day each day's readings only depend on the seed and the day, so requests over overlapping days agree on the days they share
+def make_vaisala_export(observation_count, station_count=8, seed=0, start=None, minutes=10, seed_by_day=False):
+    rand = random.Random(seed)
+    start = start if start is not None else datetime(2021, 10, 1)
+    per_station = max(observation_count // station_count, 1)
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<observations>']
+    for s in range(station_count):
+        parts.append('<instance><name>STATION{}</name>'.format(s))
+        for i in range(per_station):
+            stamp = (start+timedelta(minutes=minutes*i)).strftime('%Y-%m-%d %H:%M:%S')
+            if seed_by_day and (i == 0 or stamp.endswith('00:00:00')):
+                rand = random.Random('{} {} {}'.format(seed, s, stamp[:10]))
+            parts.append('<resultOf timestamp="{}">'.format(stamp))
+            for code in ('T', 'RH', 'TS', 'ST'):
+                # Some values are left out to exercise the -999.99 default
+                if rand.random() > 0.05:
+                    parts.append('<value code="{}">{:.2f}</value>'.format(code, rand.uniform(-20, 30)))
+            parts.append('</resultOf>')
+        parts.append('</instance>')
+    parts.append('</observations>')
+    return ''.join(parts).encode('utf-8')
+
+# What a stand-in for the Vaisala export answers, from the query of the request: one station with a reading every hour over the days asked for
+def vaisala_response(query):
+    first = datetime.strptime(query['earliesttime'][0], '%Y-%m-%d')
+    last = datetime.strptime(query['latesttime'][0], '%Y-%m-%d')
+    hours = max(int((last-first).total_seconds()//3600), 1)
+    return make_vaisala_export(hours, station_count=1, seed=zlib.crc32(query.get('station', [''])[0].encode('utf-8')), start=first, minutes=60,
+                               seed_by_day=True)
+
+# The Vaisala export over HTTP. A station named export-<count> is a fixed export of count observations from 8 stations, any other station gets
+# vaisala_response. Answers are kept, so the stand-in isn't making XML while a benchmark case is timed.
+class VaisalaStandIn(BaseHTTPRequestHandler):
+    answers = {}
+
+    def do_GET(self):
+        query = urlparse(self.path).query
+        body = self.answers.get(query)
+        if body is None:
+            station = parse_qs(query).get('station', [''])[0]
+            if station.startswith('export-'):
+                body = make_vaisala_export(int(station[len('export-'):]))
+            else:
+                body = vaisala_response(parse_qs(query))
+            self.answers[query] = body
+        self.send_body(body)
+
+    def send_body(self, body, content_type='text/xml'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Serves handler on a free local port from a thread of its own. shutdown() and server_close() it when done.
+def start_server(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# RWIS stations spread over Idaho, in the same columns as RWIS_Station_Locations
+def make_stations(station_count, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'name': ['STATION{}'.format(i) for i in range(station_count)],
+        'id': np.arange(station_count),
+        'lat': rng.uniform(42.0, 49.0, station_count),
+        'lon': rng.uniform(-117.0, -111.0, station_count),
+    })
+
+# The count nearest stations to a point, closest first, in the shape VaisalaObject.get_station_ids gives them (name, id, lat, lon, distance)
+def nearest_stations(stations_df, lat, lon, count=8):
+    lats, lons = np.radians(stations_df['lat'].to_numpy(dtype=float)), np.radians(stations_df['lon'].to_numpy(dtype=float))
+    cos_angle = np.cos(np.radians(lat))*np.cos(lats)*np.cos(lons-np.radians(lon)) + np.sin(np.radians(lat))*np.sin(lats)
+    nearest_df = stations_df[['name', 'id', 'lat', 'lon']].copy()
+    nearest_df['distance'] = 3959.0*np.arccos(np.clip(cos_angle, -1.0, 1.0))
+    return nearest_df.sort_values('distance', kind='stable').head(count).reset_index(drop=True)
+
+# Points to run, inside the stations' area
+def make_points(point_count, seed=1):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(42.5, 48.5, point_count), rng.uniform(-116.5, -111.5, point_count)
+
+# A SQLite stand-in for wx_history (config.db_backend = 'sqlite'): the stations in RWIS_Station_Locations and three readings (fahrenheit)
+# a day from every station in rwis_view, with its dd/mm/yyyy dates. A few readings are missing.
+def write_history_db(path, stations_df, start_day, end_day, seed=0):
+    rng = np.random.default_rng(seed)
+    days = pd.date_range(start_day, end_day)
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE RWIS_Station_Locations (Station_Name TEXT, Station_ID INTEGER, Lat__Decimal REAL, Long__Decimal REAL)')
+    conn.execute('CREATE TABLE rwis_view (site TEXT, dt TEXT, Air_Temp REAL)')
+    conn.executemany('INSERT INTO RWIS_Station_Locations VALUES (?, ?, ?, ?)',
+                     [(name, int(station_id), float(lat), float(lon)) for name, station_id, lat, lon in stations_df[['name', 'id', 'lat', 'lon']].itertuples(index=False)])
+    seasonal = 40.0 - 25.0*np.sin(2*np.pi*np.arange(len(days))/365.0)
+    rows = []
+    for name in stations_df['name']:
+        readings = seasonal[:, None] + rng.normal(0, 8, (len(days), 3))
+        for day, day_readings in zip(days.strftime('%d/%m/%Y'), readings):
+            rows.extend((name, day, float(reading)) for reading in day_readings if rng.random() > 0.03)
+    conn.executemany('INSERT INTO rwis_view VALUES (?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+
+# Fills an ObservationCache with daily highs/lows (celsius) for every station from start_day to end_day so nothing has to be downloaded.
+# A few days are left out at each station so the IDW has gaps to deal with.
+def fill_observation_cache(cache, stations_df, start_day, end_day, seed=0):
+    rng = np.random.default_rng(seed)
+    days = pd.date_range(start_day, end_day).strftime('%Y-%m-%d')
+    for station_id in stations_df['id']:
+        average = rng.normal(2, 8, len(days))
+        daily_df = pd.DataFrame({'hi': average+5, 'lo': average-5}, index=days)
+        daily_df = daily_df[rng.random(len(days)) > 0.05]
+        cache.store(str(station_id), daily_df, start_day, end_day)
+
+# Four GeoTIFFs standing in for the NDFD min/max files (days 1-3 and 4-7), on the NDFD Lambert projection at 5 km with a
+# GRIB_VALID_TIME on every band starting tomorrow, which is everything ForecastGrid reads from them.
+# Returns entries in the same (file, min or max, product) shape as raster_operations.file_paths. Needs GDAL.
+def write_lambert_forecasts(folder, resolution=5000.0, seed=0):
+    from osgeo import gdal, osr
+    lambert = osr.SpatialReference()
+    lambert.ImportFromProj4(NDFD_LAMBERT)
+    geographic = osr.SpatialReference()
+    geographic.ImportFromEPSG(4326)
+    geographic.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    to_lambert = osr.CoordinateTransformation(geographic, lambert)
+
+    west, south, east, north = PACNWEST_BOUNDS
+    corners = [to_lambert.TransformPoint(lon, lat) for lon in (west, east) for lat in (south, north)]
+    min_x, max_x = min(c[0] for c in corners), max(c[0] for c in corners)
+    min_y, max_y = min(c[1] for c in corners), max(c[1] for c in corners)
+    x_size = int(np.ceil((max_x-min_x)/resolution))
+    y_size = int(np.ceil((max_y-min_y)/resolution))
+
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:y_size, 0:x_size]
+    tomorrow = time.mktime((date.today()+timedelta(days=1)).timetuple())+12*3600
+    entries = []
+    for name, kind, first_day, band_count in (('days1to3min.tif', 'min', 0, 3), ('days4to7min.tif', 'min', 3, 4),
+                                              ('days1to3max.tif', 'max', 0, 3), ('days4to7max.tif', 'max', 3, 4)):
+        file_path = os.path.join(folder, name)
+        data = gdal.GetDriverByName('GTiff').Create(file_path, x_size, y_size, band_count, gdal.GDT_Float32)
+        data.SetProjection(lambert.ExportToWkt())
+        data.SetGeoTransform((min_x, resolution, 0.0, max_y, 0.0, -resolution))
+        for b in range(band_count):
+            # Colder to the north and east, plus some noise, in celsius
+            celsius = 10.0 - 15.0*y/y_size - 5.0*x/x_size + rng.normal(0, 1, (y_size, x_size)) + (8 if kind == 'max' else 0)
+            band = data.GetRasterBand(b+1)
+            band.WriteArray(celsius.astype(np.float32))
+            band.SetMetadata({'GRIB_VALID_TIME': '{} sec UTC'.format(int(tomorrow+86400*(first_day+b)))})
+        data.FlushCache()
+        data = None
+        entries.append((file_path, kind, name))
+    return entries
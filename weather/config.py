@@ -16,10 +16,95 @@ global_lat_bar = None
 global_coords = None
 global_addr = None
 global_filename = ""
+# Made by batch_output when the first spreadsheet is saved, importing config doesn't touch the disk
 global_csv_folder_path = os.getcwd()+'\\Spreadsheets'
 
-if not os.path.isdir(global_csv_folder_path):
-    os.makedirs(os.getcwd()+'\\Spreadsheets')
+# NDFD forecast downloads. Point ndfd_base_url at a local server to test without NOAA. 
+ndfd_base_url = 'https://tgftp.nws.noaa.gov/SL.us008001/ST.opnl/DF.gr2/DC.ndfd/AR.pacnwest'
+forecast_cache_folder = os.path.join(os.getcwd(), 'ForecastCache')
+# Cached forecast files younger than this many seconds are used without asking NOAA at all
+forecast_max_age = 3600
+
+# Nearby RWIS stations and how they're weighted for inverse distance interpolation
+station_count = 8
+station_radius = 50 # in miles
+idw_power = 1.2
+# RWIS_Station_Locations is cached here and pulled again once it's older than station_cache_max_age seconds
+station_cache_path = os.path.join(os.getcwd(), 'station_locations.csv')
+station_cache_max_age = 86400
+
+# wx_history database. db_backend is 'sqlserver' or 'sqlite', the sqlite file needs the same tables for offline runs. 
+db_backend = 'sqlserver'
+db_connection_string = ('Driver={SQL Server};'
+                        'Server=ITD9HTSPC219328;'
+                        'Database=wx_history;'
+                        'Trusted_Connection=yes;')
+db_sqlite_path = os.path.join(os.getcwd(), 'wx_history.sqlite')
+db_timeout = 1
+db_pool_size = 8
+# Rows read from the database at a time by db.query_columns
+db_fetch_size = 10000
+
+# Daily Vaisala station highs/lows are cached here. Days newer than vaisala_settle_days ago are always asked for again. 
+vaisala_cache_path = os.path.join(os.getcwd(), 'vaisala_cache.sqlite')
+vaisala_settle_days = 1
+# Vaisala export, point this at a local server to test without Vaisala
+vaisala_export_url = 'https://exportdb.vaisala.io/export?username=idt&password=Data4Idaho'
+# Vaisala requests: how many stations are downloaded at once, seconds to wait on a response and retries per request
+vaisala_max_concurrency = 8
+vaisala_timeout = 60
+vaisala_retries = 3
+
+# Each point's spreadsheet state at the end of its settled observations is saved here, so the next run only does the days after it. 
+# Days newer than season_settle_days ago are always done again. With resume_seasons = False every point starts over from Oct 1. 
+season_state_path = os.path.join(os.getcwd(), 'season_state.sqlite')
+season_settle_days = 1
+resume_seasons = True
+
+# Batch runs with more than one worker go through a pipeline (pipeline.py). Workers for each stage, None uses the worker count from 
+# the command line. pipeline_queue_size is how many points can wait in front of a stage before the stages feeding it hold off. 
+pipeline_queue_size = 32
+pipeline_fetch_workers = None
+pipeline_csv_workers = 2
+pipeline_png_workers = None
+# The spreadsheet stage runs on a process pool of spawned workers that get these settings as they are when the run starts,
+# None uses the worker count up to the number of CPUs like the .png stage
+pipeline_spreadsheet_workers = None
+# Most points the spreadsheet stage runs together in one batch
+spreadsheet_batch_size = 256
+
+# How the breakup table .png of each id is drawn. 'builtin' draws it with Pillow (table_image.py), 'dataframe_image' is the old 
+# dfi.export, which starts a browser for every image. 
+table_renderer = 'builtin'
+
+# Points that would get the same spreadsheet (same stations at the same distances and the same forecast grid cell) are only run once 
+# and the results are copied to each of them. Distances are compared rounded to this many decimals of a mile. 
+dedupe_points = True
+dedupe_distance_decimals = 3
+
+# 'csv' saves a .csv in Spreadsheets for every point. 'parquet' or 'arrow' (needs pyarrow) saves every point's spreadsheet in one 
+# dataset in output_dataset_folder instead, written a file at a time every output_batch_rows rows. 
+output_format = 'csv'
+output_dataset_folder = os.path.join(os.getcwd(), 'SpreadsheetDataset')
+output_batch_rows = 500000
+# The dataset is split into this many bucket=N folders by point key, reading one point back only opens the files of its bucket
+output_dataset_buckets = 64
+
+# Every batch run saves a JSON summary of where its time went here (metrics.py). With metrics_live_interval set to a number of seconds, 
+# the time percentiles so far are also printed that often while the run is going. 
+metrics_path = os.path.join(os.getcwd(), 'run_metrics.json')
+metrics_live_interval = None
+
+# batch_output.py --shard i/N saves shard i's outputs in a folder in here, --merge N puts them back together (shard.py). 
+# Point it at a folder every machine can see to split a run across them. 
+shard_folder = os.path.join(os.getcwd(), 'Shards')
+
+# python service.py answers single point queries over HTTP (service.py). Answers are kept for service_cache_seconds, and every 
+# service_refresh_seconds the forecast files, station table, recent Vaisala observations and saved season states are brought up to date. 
+service_host = '127.0.0.1'
+service_port = 8765
+service_cache_seconds = 300
+service_refresh_seconds = 900
 
 def emitWorkerProgress(worker, s):
     # I think this will just grab the output_str right above it. Just lets us use variables outside of functions
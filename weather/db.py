@@ -0,0 +1,162 @@
+"""
+Shared connections to the wx_history database. Connections are kept in a small pool and handed out one at a time, so a batch
+run only pays for connecting once per thread instead of twice for every point.
+config.db_backend picks SQL Server (pyodbc, config.db_connection_string) or a local SQLite file (config.db_sqlite_path) that has
+the same tables, which lets everything run offline.
+Queries use ? placeholders, which both pyodbc and sqlite3 understand.
+query_columns reads big results config.db_fetch_size rows at a time straight into typed columns instead of a tuple for every row.
+"""
+import math
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import config
+import metrics
+
+__authors__ = "Jordan Hiatt"
+
+# SQLite doesn't have all of the SQL Server functions the queries use, so they're added to every SQLite connection
+def sqlite_substring(s, start, length):
+    if s is None:
+        return None
+    return str(s)[start-1:start-1+length]
+
+def sqlite_concat(*args):
+    return ''.join('' if a is None else str(a) for a in args)
+
+def sqlite_power(x, y):
+    if x is None or y is None:
+        return None
+    return math.pow(x, y)
+
+def connect(backend=None):
+    backend = backend if backend is not None else config.db_backend
+    if backend == 'sqlite':
+        conn = sqlite3.connect(config.db_sqlite_path, check_same_thread=False)
+        conn.create_function('substring', 3, sqlite_substring)
+        conn.create_function('concat', -1, sqlite_concat)
+        conn.create_function('power', 2, sqlite_power)
+        return conn
+    elif backend == 'sqlserver':
+        import pyodbc
+        # Setting the timeout tells the user if they're connected to the database
+        return pyodbc.connect(config.db_connection_string, timeout=config.db_timeout)
+    raise ValueError('Unknown database backend: {}'.format(backend))
+
+class ConnectionPool():
+    def __init__(self, backend=None, size=None):
+        self.backend = backend if backend is not None else config.db_backend
+        self.size = size if size is not None else config.db_pool_size
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.created = 0
+
+    # Reuses an idle connection if there is one, otherwise opens a new one as long as we're under the pool size
+    def get(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                try:
+                    return connect(self.backend)
+                except Exception:
+                    self.created -= 1
+                    raise
+        return self.idle.get()
+
+    def put(self, conn):
+        self.idle.put(conn)
+
+    # A connection that failed is closed and replaced later instead of going back in the pool
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self.lock:
+            self.created -= 1
+
+    @contextmanager
+    def connection(self):
+        conn = self.get()
+        try:
+            yield conn
+        except Exception:
+            self.discard(conn)
+            raise
+        else:
+            self.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(conn)
+
+# One pool for the whole process
+pool = None
+pool_lock = threading.Lock()
+
+def get_pool():
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = ConnectionPool()
+        return pool
+
+# Closes every idle connection, the next query starts a new pool (after switching config.db_backend for instance)
+def reset_pool():
+    global pool
+    with pool_lock:
+        if pool is not None:
+            pool.close()
+        pool = None
+
+@contextmanager
+def cursor():
+    with get_pool().connection() as conn:
+        cur = conn.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+
+# Runs a parameterized query and gives back every row as a tuple
+def query(sql, params=()):
+    with metrics.get_metrics().timer('sql.query'):
+        with cursor() as cur:
+            cur.execute(sql, params)
+            rows = [tuple(row) for row in cur.fetchall()]
+    metrics.get_metrics().add('sql.query', items=len(rows))
+    return rows
+
+# Runs a parameterized query and gives back a DataFrame. columns is a list of (name, dtype), one for each column the query selects, 
+# a dtype of None keeps whatever pandas picks. Rows are fetched config.db_fetch_size at a time and each chunk is made into typed columns 
+# right away, so a big result is never held as one tuple per row. NULL numbers come out as NaN. 
+def query_columns(sql, params=(), columns=()):
+    names = [name for name, dtype in columns]
+    dtypes = {name: dtype for name, dtype in columns if dtype is not None}
+    chunks = []
+    with metrics.get_metrics().timer('sql.query'):
+        with cursor() as cur:
+            cur.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(config.db_fetch_size)
+                if len(rows) == 0:
+                    break
+                # pyodbc gives back Row objects, pandas wants tuples
+                if not isinstance(rows[0], tuple):
+                    rows = [tuple(row) for row in rows]
+                chunks.append(pd.DataFrame.from_records(rows, columns=names).astype(dtypes))
+    metrics.get_metrics().add('sql.query', items=sum(len(chunk) for chunk in chunks))
+    if len(chunks) == 0:
+        return pd.DataFrame({name: np.array([], dtype=dtypes.get(name, object)) for name in names}, columns=names)
+    return pd.concat(chunks, ignore_index=True)
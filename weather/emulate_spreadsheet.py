@@ -4,15 +4,14 @@
 A neighboring state uses a spreadsheet that utilizes freezing and thawing indices over time to determine if load limits have to be applied. 
 This takes a list of daily average temperatures and performs the same operations as the spreadsheet but in a dataframe and outputs a .csv. 
 """
-from geopy import location
+import numpy as np
 import pandas as pd
 from decimal import Decimal, ROUND_UP
 import pprint
 import os
-import pathlib
+import threading
 from datetime import timedelta, date, datetime
 import config
-pathlib.Path(__file__).parent.absolute()
 
 __authors__ = "Jordan Hiatt"
 
@@ -20,10 +19,242 @@ __authors__ = "Jordan Hiatt"
 def round_up_tenth(float_input):
     return float(Decimal(str(float_input)).quantize(Decimal('.1'), rounding=ROUND_UP))
 
+# Read once per process instead of for every point
+reference_temps = None
+reference_temps_lock = threading.Lock()
+
+def get_reference_temps():
+    global reference_temps
+    with reference_temps_lock:
+        if reference_temps is None:
+            reference_temps = pd.read_csv('reference_temp.csv', header=None)[0].to_numpy(dtype=float)
+        return reference_temps
+
+# The reference temperature of each of the first day_count days, lined up by row like the spreadsheet does. Rows past the end of the file get NaN. 
+def reference_for(day_count):
+    ref_temp = np.full(day_count, np.nan)
+    temps = get_reference_temps()[:day_count]
+    ref_temp[:len(temps)] = temps
+    return ref_temp
+
+# The only part of the spreadsheet that has to go one day at a time, since today's freezing index depends on yesterday's thawing index.
+# The arrays are days x points so every point takes its step for the day together. 
+# cfi_reset_row and cti_reset_row are the rows of July 1 and January 1 of this year, or -1 if they aren't in the data. 
+# At the start of the season the first row only sets the CTI, otherwise the first row carries on from prev_cti and prev_cfi (one per point). 
+def freeze_thaw_kernel(dti, diff, avg, cfi_reset_row, cti_reset_row, prev_cti, prev_cfi, season_start):
+    dfi = np.zeros(dti.shape)
+    cfi = np.zeros(dti.shape)
+    cti = np.zeros(dti.shape)
+    if dti.shape[0] == 0:
+        return dfi, cfi, cti
+    first = 0
+    if season_start:
+        cti[0] = dti[0]
+        first = 1
+    for i in range(first, dti.shape[0]):
+        if i > 0:
+            prev_cti = cti[i-1]
+            prev_cfi = cfi[i-1]
+        # =IF(AND(L5=0,P4>M5),32-J5,0)
+        dfi[i] = np.where((dti[i] == 0) & (prev_cti > diff[i]), 32.0-avg[i], 0.0)
+        if i != cfi_reset_row:
+            cfi[i] = prev_cfi + dfi[i]
+        # if prev cti + current dti - current dfi/2 > 0, use that else 0
+        if i != cti_reset_row:
+            current_cti = prev_cti + dti[i] - dfi[i]/2.0
+            cti[i] = np.where(current_cti > 0, current_cti, 0.0)
+    return dfi, cfi, cti
+
+# Numba is optional and only imported the first time the kernel runs, without it the kernel is plain Python looping over NumPy arrays
+compiled_kernel = None
+compiled_kernel_lock = threading.Lock()
+
+def get_freeze_thaw_kernel():
+    global compiled_kernel
+    with compiled_kernel_lock:
+        if compiled_kernel is None:
+            try:
+                from numba import njit
+                compiled_kernel = njit(cache=True)(freeze_thaw_kernel)
+            except ImportError:
+                compiled_kernel = freeze_thaw_kernel
+        return compiled_kernel
+
+# For every point the first row at or after start (one for all points or one per point) where mask is true, or -1
+def first_row(mask, start=1):
+    mask = mask & (np.arange(mask.shape[1]) >= np.reshape(start, (-1, 1)))
+    return np.where(mask.any(axis=1), mask.argmax(axis=1), -1)
+
+# For every point, the row at or after start of the day days_after from_day, or -1 if there isn't a from_day or that day isn't in the data
+def row_after(days, from_days, start, days_after):
+    targets = (pd.to_datetime(pd.Series(from_days, dtype=object))+timedelta(days=days_after)).dt.strftime("%Y-%m-%d").to_numpy(dtype=object)
+    return first_row(days[np.newaxis, :] == targets[:, np.newaxis], start)
+
+MILESTONES = [
+    'FREEZING STARTED',
+    'WINTER LOAD INCREASED',
+    'THAWING BEGINS: RESCIND WINTER LOAD INCREASES',
+    'CUMULATIVE THAWING INDEX > 25: IMPOSE BREAKUP LIMITS',
+    'CTI > 25 + 8-WEEKS: RESCIND SPRING BREAKUP LIMITS\n BEGIN NORMAL WEIGHT LIMITS',
+    'NORMAL WEIGHT LIMITS + 2 WEEKS: BEGIN OVERWEIGHT PERMITS',
+]
+
+# Runs the spreadsheet for many points that share the same days. highs and lows are points x days. 
+# states is None at the start of the season, otherwise one season_state per point (all with the same number of rows) to carry on from, 
+# and days are the days after those rows. 
+# Gives back a dict of points x days arrays named after the spreadsheet columns, the row in the season of each milestone for every point 
+# (-1 if it hasn't happened) and breakup_day, the day breakup limits start at each point or None. 
+# today is the day the run is for (date.today() if None), a batch run hands its own down so every worker agrees on it. 
+def build_emulated_batch(days, highs, lows, states=None, today=None):
+    current_year = str((today or date.today()).year)
+    days = np.asarray(days, dtype=object)
+    highs = np.asarray(highs, dtype=float).reshape(-1, len(days))
+    lows = np.asarray(lows, dtype=float).reshape(-1, len(days))
+    points = np.arange(highs.shape[0])
+    season_start = states is None
+    # Rows of the season before these days, and the first row a flag can be set on (the first row of the season never has one)
+    offset = 0 if season_start else states[0]['rows']
+    first = 1 if season_start else 0
+
+    average = (highs+lows)/2.0
+    diff = (32.0-average)/2.0
+    ref_temp = reference_for(offset+len(days))[offset:]
+    #if average - ref < 0, make 0, else average - ref
+    thaw = average - ref_temp
+    dti = np.where(thaw < 0.0, 0.0, thaw)
+
+    if season_start:
+        prev_cti, prev_cfi = np.zeros(len(points)), np.zeros(len(points))
+        prior_reset = np.full(len(points), -1)
+        prior_rows = [np.full(len(points), -1) for text in MILESTONES]
+        prior_days = [np.full(len(points), None, dtype=object) for text in MILESTONES]
+    else:
+        prev_cti = np.array([state['cti'] for state in states], dtype=float)
+        prev_cfi = np.array([state['cfi'] for state in states], dtype=float)
+        prior_reset = np.array([state['cti_reset_row'] for state in states])
+        prior_rows = [np.array([state['milestone_rows'][m] for state in states]) for m in range(len(MILESTONES))]
+        prior_days = [np.array([state['milestone_days'][m] for state in states], dtype=object) for m in range(len(MILESTONES))]
+
+    cfi_reset_row = int(first_row((days == '{}-07-01'.format(current_year))[np.newaxis], first)[0])
+    cti_reset_row = int(first_row((days == '{}-01-01'.format(current_year))[np.newaxis], first)[0])
+    dfi, cfi, cti = get_freeze_thaw_kernel()(np.ascontiguousarray(dti.T), np.ascontiguousarray(diff.T), np.ascontiguousarray(average.T), 
+                                       cfi_reset_row, cti_reset_row, prev_cti, prev_cfi, season_start)
+    dfi, cfi, cti = dfi.T, cfi.T, cti.T
+
+    #L4 is dti, N4 is dfi
+    # =IF(AND(L4=0,N4=0),"NO THAW",IF(AND(L4>0,N4=0),"THAWING","REFREEZING"))
+    status = np.select([(dti == 0) & (dfi == 0), (dti > 0) & (dfi == 0)], ['NO THAW', 'THAWING'], 'REFREEZING').astype(object)
+    if season_start:
+        status[:, :1] = ''
+
+    # A milestone from before these days stays where it was, otherwise it's the row found here (moved to the row in the season)
+    def season_rows(m, rows):
+        return np.where(prior_rows[m] >= 0, prior_rows[m], np.where(rows >= 0, rows+offset, -1))
+    def season_days(m, rows):
+        return np.array([prior_days[m][p] if rows[p] < offset else days[rows[p]-offset] if rows[p] >= 0 else None for p in points], dtype=object)
+    # Rows here to start looking from, the row after a milestone that came first or the first row if it was before these days
+    def start_after(rows, after=0):
+        return np.maximum(rows-offset+after, first)
+
+    #flag checks, this comes straight off the spreadsheet. Each one only happens once, on the first day its condition is met.
+    freezing_row = season_rows(0, first_row(dfi > 0.0, first))
+    winter_load_row = season_rows(1, first_row(cfi > 280.0, first))
+    # Thawing can only start after the CTI reset
+    reset_row = np.where(prior_reset >= 0, prior_reset, cti_reset_row+offset if cti_reset_row >= 0 else -1)
+    thawing_row = season_rows(2, first_row((cti > 0.0) & (reset_row >= 0)[:, np.newaxis], start_after(reset_row, 1)))
+    breakup_row = season_rows(3, first_row((cti > 25.0) & (thawing_row >= 0)[:, np.newaxis], start_after(thawing_row)))
+    breakup_day = season_days(3, breakup_row)
+    # final day of 8 week range from breakup, CTI still has to be over 25 on that day
+    normal_row = row_after(days, breakup_day, start_after(breakup_row), 55)
+    normal_row = season_rows(4, np.where((normal_row >= 0) & (cti[points, np.maximum(normal_row, 0)] > 25.0), normal_row, -1))
+    normal_day = season_days(4, normal_row)
+    overweight_row = season_rows(5, row_after(days, normal_day, start_after(normal_row), 13))
+    milestone_rows = [freezing_row, winter_load_row, thawing_row, breakup_row, normal_row, overweight_row]
+    milestone_days = [season_days(0, freezing_row), season_days(1, winter_load_row), season_days(2, thawing_row), 
+                      breakup_day, normal_day, season_days(5, overweight_row)]
+
+    # Later messages on the same day replace earlier ones
+    message = np.full(dti.shape, '', dtype=object)
+    for text, rows in zip(MILESTONES, milestone_rows):
+        found = rows >= offset
+        message[points[found], rows[found]-offset] = text
+
+    return {
+        'day': days,
+        'average': average,
+        '32-avg/2': diff,
+        'ref_temp': ref_temp,
+        'daily_thawing_index': dti,
+        'daily_freezing_index': dfi,
+        'cumulative_freezing_index': cfi,
+        'cumulative_thawing_index': cti,
+        'roadway_status': status,
+        'message': message,
+        'row_offset': offset,
+        'cfi_reset_row': cfi_reset_row,
+        'cti_reset_row': cti_reset_row,
+        'season_reset_row': reset_row,
+        'milestone_rows': milestone_rows,
+        'milestone_days': milestone_days,
+        'breakup_row': breakup_row,
+        'breakup_day': breakup_day,
+    }
+
+# Everything needed to carry on a point of a batch after a row of the season, without running the days up to it again. 
+# row has to be one of the batch's rows. 
+def season_state(batch, point, row):
+    local = row-batch['row_offset']
+    return {
+        'rows': int(row)+1,
+        'day': batch['day'][local],
+        'cti': float(batch['cumulative_thawing_index'][point, local]),
+        'cfi': float(batch['cumulative_freezing_index'][point, local]),
+        'cti_reset_row': int(batch['season_reset_row'][point]) if batch['season_reset_row'][point] <= row else -1,
+        'milestone_rows': [int(rows[point]) if rows[point] <= row else -1 for rows in batch['milestone_rows']],
+        'milestone_days': [days[point] if rows[point] <= row else None for rows, days in zip(batch['milestone_rows'], batch['milestone_days'])],
+    }
+
+# The lines the spreadsheet run prints for one point of a batch, in the order the days happen
+def milestone_log(batch, point):
+    days = batch['day']
+    offset = batch['row_offset']
+    log = []
+    if batch['cfi_reset_row'] >= 0:
+        log.append((batch['cfi_reset_row'], -2, 'CFI RESET ON: {}\n'.format(days[batch['cfi_reset_row']])))
+    if batch['cti_reset_row'] >= 0:
+        log.append((batch['cti_reset_row'], -1, '{} CTI RESET\n'.format(days[batch['cti_reset_row']])))
+    for order, (text, rows) in enumerate(zip(MILESTONES, batch['milestone_rows'])):
+        if rows[point] >= offset:
+            log.append((rows[point]-offset, order, '{} {}\n'.format(days[rows[point]-offset], text)))
+    return [text for row, order, text in sorted(log)]
+
+# The rows of one point of a batch, without the metadata
+def batch_rows(batch, point):
+    return pd.DataFrame({
+        'day': batch['day'],
+        'average': batch['average'][point],
+        'roadway_status': batch['roadway_status'][point],
+        'message': batch['message'][point],
+    })
+
+# The .csv for one point of a batch, with the point's metadata at the top of the message column.
+# A batch that carries on from a saved state needs the rows before it, earlier_df. 
+def spreadsheet_frame(batch, point, lat, lon, point_location, earlier_df=None, today=None):
+    reduced_df = batch_rows(batch, point)
+    if earlier_df is not None:
+        reduced_df = pd.concat([earlier_df, reduced_df], ignore_index=True)
+    return add_metadata(reduced_df, lat, lon, point_location, today)
+
+# Adds metadata to the tope of the message column. A point that shares its spreadsheet with another one just needs its own metadata on a copy. 
+def add_metadata(reduced_df, lat, lon, point_location, today=None):
+    creation_date = (today or date.today()).strftime('%m-%d-%Y')
+    reduced_df.at[0, 'message'] = creation_date
+    reduced_df.at[1, 'message'] = '%.6f_%.6f' % (lat, lon)
+    reduced_df.at[2, 'message'] = point_location
+    return reduced_df
+
 # TODO: this function reads in two dataframes, I want the dataframe to be prepared before the function is called. 
 def build_emulated_spreadsheet(lat, lon, point_location, df):
-    current_year = str(date.today().year)
-    output_str = ''
     # TEST DATA
     # df = pd.read_csv('test_hi_lo.csv', names=['high', 'low'])
     # df['average'] = (df['high']+df['low'])/2.0
@@ -34,131 +265,11 @@ def build_emulated_spreadsheet(lat, lon, point_location, df):
     # df = pd.read_csv('CsvFiles\\appended_historical_data.csv', header=0)
     # df2 = pd.read_csv('forecast_temps.csv', header=0)
     # df = df.append(df2, ignore_index=True)
-    df['average'] = (df['high']+df['low'])/2.0
-
-    df['32-avg/2'] = ((32.0-df['average'])/2.0)
-    ref_temp = pd.read_csv('reference_temp.csv', header=None)
-    df['ref_temp'] = ref_temp
-
-    #if average - ref < 0, make 0, else average - ref
-    df['daily_thawing_index'] = (df['average'] - df['ref_temp']).apply(lambda x: 0.0 if x < 0.0 else x)
-
-    # =IF(AND(L5=0,P4>M5),32-J5,0)
-    df['daily_freezing_index'] = 0.0
-    df['cumulative_freezing_index'] = 0.0
-    # set the first CTI entry to the first DTI entry
-    df['cumulative_thawing_index'] = 0.0
-    df.at[0, 'cumulative_thawing_index'] = df['daily_thawing_index'].iloc[0]
-    df['roadway_status'] = ''
-    df['message'] = ''
-
-    # flags
-    freezing_started = False
-    winter_load_increased = False
-    cti_reset = False
-    cfi_reset = False
-    thawing_started = False
-    breakup_limits_started = False
-    eight_weeks_since_breakup_limits = False
-    normal_limits_restarted = False
-    overweight_started = False
-
-    # Start at 1 since we'll be using the previous index
-    for i in range(1, len(df)):
-        date_string = df.loc[i, 'day']
-        dfi = 0
-        dti = df.loc[i, 'daily_thawing_index']
-        diff = df.loc[i, '32-avg/2']
-        avg = df.loc[i, 'average']
-        prev_cti = df.loc[i-1, 'cumulative_thawing_index'] 
-        prev_cfi = df.loc[i-1, 'cumulative_freezing_index']
-        if dti == 0 and prev_cti > diff:
-            dfi = 32.0-avg
-        else:
-            dfi = 0
-        df.at[i, 'daily_freezing_index'] = dfi
-        if date_string == pd.to_datetime('7/1/{}'.format(current_year)).strftime("%Y-%m-%d"): 
-            print('CFI RESET ON: {}\n'.format(date_string))
-            output_str += 'CFI RESET ON: {}\n'.format(date_string)
-            cfi_reset = True
-            current_cfi = 0
-        else:
-            current_cfi = prev_cfi + dfi
-        df.at[i, 'cumulative_freezing_index'] = current_cfi
-
-        # if prev cti + current dti - current dfi/2 > 0, use that else 0
-        if date_string == pd.to_datetime('1/1/{}'.format(current_year)).strftime("%Y-%m-%d") and not cti_reset: #current year
-            current_cti = 0
-            cti_reset = True
-            print('{} CTI RESET\n'.format(date_string))
-            output_str += '{} CTI RESET\n'.format(date_string)
-        else:
-            current_cti = prev_cti + dti - dfi/2.0
-
-        if current_cti > 0:
-            df.at[i, 'cumulative_thawing_index'] = current_cti
-        else:
-            df.at[i, 'cumulative_thawing_index'] = 0
-
-        #L4 is dti, N4 is dfi
-        # =IF(AND(L4=0,N4=0),"NO THAW",IF(AND(L4>0,N4=0),"THAWING","REFREEZING"))
-        if dti == 0 and dfi == 0:
-            df.at[i, 'roadway_status'] = 'NO THAW'
-        else:
-            if dti > 0 and dfi == 0:
-                df.at[i, 'roadway_status'] = 'THAWING'
-            else:
-                df.at[i, 'roadway_status'] = 'REFREEZING'
-
-        #flag checks, this comes straight off the spreadsheet
-        if not freezing_started and dfi > 0.0:
-            print('{} FREEZING STARTED\n'.format(date_string))
-            output_str += '{} FREEZING STARTED\n'.format(date_string)
-            freezing_started = True
-            df.at[i, 'message'] = 'FREEZING STARTED'
-
-        if not winter_load_increased and current_cfi > 280.0:
-            print('{} WINTER LOAD INCREASED\n'.format(date_string))
-            output_str += '{} WINTER LOAD INCREASED\n'.format(date_string)
-            winter_load_increased = True
-            df.at[i, 'message'] = 'WINTER LOAD INCREASED'
-
-        if not thawing_started and cti_reset and current_cti > 0.0:
-            print('{} THAWING BEGINS: RESCIND WINTER LOAD INCREASES\n'.format(date_string))
-            output_str += '{} THAWING BEGINS: RESCIND WINTER LOAD INCREASES\n'.format(date_string)
-            thawing_started = True
-            df.at[i, 'message'] = 'THAWING BEGINS: RESCIND WINTER LOAD INCREASES'
-
-        if not breakup_limits_started and thawing_started and current_cti > 25.0:
-            print('{} CUMULATIVE THAWING INDEX > 25: IMPOSE BREAKUP LIMITS\n'.format(date_string))
-            output_str += '{} CUMULATIVE THAWING INDEX > 25: IMPOSE BREAKUP LIMITS\n'.format(date_string)
-            breakup_limits_started = True
-            breakup_end_date = pd.date_range(start=date_string, periods=56)[-1].strftime("%Y-%m-%d") # final day of 8 week range from present
-            df.at[i, 'message'] = 'CUMULATIVE THAWING INDEX > 25: IMPOSE BREAKUP LIMITS'
-        
-        if not normal_limits_restarted and breakup_limits_started and current_cti > 25.0 and date_string == breakup_end_date:
-            print('{} CTI > 25 + 8-WEEKS: RESCIND SPRING BREAKUP LIMITS\n BEGIN NORMAL WEIGHT LIMITS\n'.format(date_string))
-            output_str += '{} CTI > 25 + 8-WEEKS: RESCIND SPRING BREAKUP LIMITS\n BEGIN NORMAL WEIGHT LIMITS\n'.format(date_string)
-            normal_limits_restarted = True
-            overweight_start_date = pd.date_range(start=date_string, periods=14)[-1].strftime("%Y-%m-%d")
-            df.at[i, 'message'] = 'CTI > 25 + 8-WEEKS: RESCIND SPRING BREAKUP LIMITS\n BEGIN NORMAL WEIGHT LIMITS'
-        
-        if not overweight_started and normal_limits_restarted and date_string == overweight_start_date:
-            print('{} NORMAL WEIGHT LIMITS + 2 WEEKS: BEGIN OVERWEIGHT PERMITS\n'.format(date_string))
-            output_str += '{} NORMAL WEIGHT LIMITS + 2 WEEKS: BEGIN OVERWEIGHT PERMITS\n'.format(date_string)
-            overweight_started = True
-            df.at[i, 'message'] = 'NORMAL WEIGHT LIMITS + 2 WEEKS: BEGIN OVERWEIGHT PERMITS'
-
-    reduced_df = df[['day','average','roadway_status','message']]
-    creation_date = date.today().strftime('%m-%d-%Y')
-
-    # Adds metadata to the tope of the message column
-    reduced_df.at[0, 'message'] = creation_date
-    reduced_df.at[1, 'message'] = '%.6f_%.6f' % (lat, lon)
-    reduced_df.at[2, 'message'] = point_location
+    batch = build_emulated_batch(df['day'].to_numpy(), df['high'].to_numpy(dtype=float), df['low'].to_numpy(dtype=float))
+    for line in milestone_log(batch, 0):
+        print(line)
     # reduced_df.to_csv(file_path, index=False)
     # print('Breakup prediction csv saved: {}'.format(file_path))
     # output_str += 'Breakup prediction csv saved: {}\n'.format(pathlib.Path(file_path).parent.absolute().__str__()+'\\{}'.format(file_path))
     # output_str += 'Breakup prediction csv saved: {}\n'.format(file_path)
-
-    return reduced_df
+    return spreadsheet_frame(batch, 0, lat, lon, point_location)
@@ -0,0 +1,147 @@
+"""
+Keeps the NDFD forecast files in a cache folder and only downloads them again when NOAA has a newer product.
+Each file gets a .json next to it with the HTTP validators (ETag/Last-Modified), when it was fetched and the GRIB valid times of its bands.
+The base url comes from config.ndfd_base_url, so it can be pointed at a local HTTP server for testing.
+"""
+import os
+import json
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import config
+import metrics
+
+__authors__ = "Jordan Hiatt"
+
+class ForecastDownloader():
+    # The worker parameter is in case this object is used with a GUI, which would emit signals that updates the GUI from a separate thread.
+    def __init__(self, base_url=None, max_tries=8, backoff_base=1.0, backoff_cap=30.0, worker=None):
+        self.base_url = base_url if base_url is not None else config.ndfd_base_url
+        self.max_tries = max_tries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.worker = worker
+
+    def emit_progress(self, s):
+        print(s)
+        if self.worker is not None:
+            self.worker.emit_progress(s+'\n')
+
+    @staticmethod
+    def metadata_path(file_path):
+        return file_path+'.json'
+
+    @staticmethod
+    def read_metadata(file_path):
+        if not os.path.exists(file_path) or not os.path.exists(ForecastDownloader.metadata_path(file_path)):
+            return {}
+        with open(ForecastDownloader.metadata_path(file_path)) as f:
+            return json.load(f)
+
+    @staticmethod
+    def write_metadata(file_path, metadata):
+        temp_path = ForecastDownloader.metadata_path(file_path)+'.part'
+        with open(temp_path, 'w') as f:
+            json.dump(metadata, f, indent=2)
+        os.replace(temp_path, ForecastDownloader.metadata_path(file_path))
+
+    # Opening the file with GDAL both checks that the download isn't truncated and gets us the valid time of every band
+    @staticmethod
+    def read_valid_times(file_path):
+        # Through raster_operations so GDAL gets the same PROJ/GDAL data folders either way
+        import raster_operations
+        gdal = raster_operations.get_gdal()
+        data = gdal.Open(file_path)
+        if data is None:
+            raise Exception('{} is not a readable GRIB file'.format(file_path))
+        valid_times = []
+        for i in range(1, data.RasterCount + 1):
+            valid_times.append(int(data.GetRasterBand(i).GetMetadata().get('GRIB_VALID_TIME').split()[0]))
+        data = None
+        return valid_times
+
+    # Exponential backoff with full jitter so retries from several downloads don't line up
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2**attempt))
+
+    def is_fresh(self, metadata):
+        return len(metadata) > 0 and time.time() - metadata['fetched_at'] < config.forecast_max_age
+
+    # Makes sure one (file_path, kind, product) entry of raster_operations.file_paths is current.
+    # Returns True if a new file was written, False if the cached one is still good or is all there is after every try failed.
+    # Raises if every try failed and there's no cached file to fall back on.
+    def download(self, f):
+        file_path = f[0]
+        url = self.base_url+'/'+f[2]
+        metadata = self.read_metadata(file_path)
+        if metadata.get('url') == url and self.is_fresh(metadata):
+            metrics.get_metrics().hit('noaa.download')
+            self.emit_progress('{} is up to date, skipping download'.format(os.path.basename(file_path)))
+            return False
+
+        headers = {}
+        if metadata.get('url') == url:
+            if metadata.get('etag'):
+                headers['If-None-Match'] = metadata['etag']
+            if metadata.get('last_modified'):
+                headers['If-Modified-Since'] = metadata['last_modified']
+
+        # Written next to the real file and swapped in so a failed download never leaves half a file behind
+        temp_path = file_path+'.part'
+        for attempt in range(self.max_tries):
+            if config.cancel_flag:
+                raise Exception('Operation Cancelled')
+            try:
+                response = requests.get(url, headers=headers, verify=False, timeout=10, stream=True)
+                if response.status_code == 304:
+                    metrics.get_metrics().hit('noaa.download')
+                    metadata['fetched_at'] = time.time()
+                    self.write_metadata(file_path, metadata)
+                    self.emit_progress('{} has not changed upstream'.format(os.path.basename(file_path)))
+                    return False
+                response.raise_for_status()
+
+                byte_count = 0
+                with open(temp_path, 'wb') as out:
+                    for chunk in response.iter_content(chunk_size=1 << 16):
+                        out.write(chunk)
+                        byte_count += len(chunk)
+                metrics.get_metrics().miss('noaa.download')
+                metrics.get_metrics().add('noaa.download', bytes=byte_count)
+                valid_times = self.read_valid_times(temp_path)
+                os.replace(temp_path, file_path)
+                self.write_metadata(file_path, {
+                    'url': url,
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'fetched_at': time.time(),
+                    'valid_times': valid_times,
+                })
+                self.emit_progress('{} download complete'.format(os.path.basename(file_path)))
+                return True
+            except Exception as e:
+                self.emit_progress('Error downloading {} on trial: {} ({})'.format(os.path.basename(file_path), attempt + 1, e))
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                if attempt < self.max_tries - 1:
+                    time.sleep(self.backoff(attempt))
+
+        # A download that never works isn't fatal if there's an older cached file, it's still better than nothing
+        self.emit_progress('Giving up on {} after {} tries'.format(os.path.basename(file_path), self.max_tries))
+        if not os.path.exists(file_path):
+            raise Exception('Could not download {} after {} tries and there is no cached copy'.format(os.path.basename(file_path), self.max_tries))
+        return False
+
+    # All of the products are fetched at the same time
+    def download_all(self, file_paths):
+        folders = set(os.path.dirname(f[0]) for f in file_paths)
+        for folder in folders:
+            if folder and not os.path.isdir(folder):
+                os.makedirs(folder)
+        with ThreadPoolExecutor(max_workers=len(file_paths)) as pool:
+            return list(pool.map(self.timed_download, file_paths))
+
+    def timed_download(self, f):
+        with metrics.get_metrics().timer('noaa.download'):
+            return self.download(f)
@@ -13,11 +13,12 @@ from datetime import date
 import requests
 import pandas as pd
 import config
+import record_batch
 # proj.db lets us create projections, there's a problem where osgeo can't find the proj or gdal stuff
 current_dir = os.getcwd()
 # os.environ['PROJ_LIB'] = current_dir+'\\share\\proj'
 # os.environ['GDAL_DATA'] = current_dir+'\\share'
-from osgeo import gdal, osr
+# osgeo is only imported by the functions that use it, not when this module is
 
 file_paths = []
 file_paths.append(('days1to3min.bin','min','https://tgftp.nws.noaa.gov/SL.us008001/ST.opnl/DF.gr2/DC.ndfd/AR.pacnwest/VP.001-003/ds.mint.bin'))
@@ -69,6 +70,7 @@ class Raster():
                 os.remove(f[0])
 
     def get_avg_at_coordinate(self, in_df):
+        from osgeo import gdal
         # Clear files before and after function call 
         # self.clear_files(file_paths)
         # self.clear_files([avg_temps_filename])
@@ -164,7 +166,7 @@ class Raster():
 
         # Zip the two list and get the avg temp for each day
         avg_temps = []
-        avg_temps_df = pd.DataFrame(columns=['day', 'low', 'high'])
+        forecast = record_batch.RecordBatchBuilder([('day', object), ('low', float), ('high', float)])
         current_date = date.today()
         current_date_string = current_date.strftime("%Y-%m-%d")
 
@@ -174,9 +176,9 @@ class Raster():
             avg = (num1+num2)/2
             tup = (avg, cd_string)
             avg_temps.append(tup)
-            avg_temps_df = avg_temps_df.append({'day':cd_string, 'low': num1, 'high': num2}, ignore_index=True)
+            forecast.append_values((cd_string, num1, num2))
 
-        avg_temps_df.index.name = 'index'
+        avg_temps_df = forecast.build(index_name='index')
 
         # Create avg_temps csv to be appended onto the historical data
         # print('Writing forecast_temps.csv')
@@ -186,13 +188,14 @@ class Raster():
         # df = df.append(df2, ignore_index=True)
 
         #TODO: do we need to do a .copy()?
-        in_df = in_df.append(avg_temps_df, ignore_index=True)
+        in_df = pd.concat([in_df, avg_temps_df], ignore_index=True)
 
         # avg_temps_df.to_csv(avg_temps_filename)
 
         return in_df
 
     def get_min_loc(self):
+            from osgeo import gdal, osr
             if os.path.exists('ds.temp.bin'):
                 os.remove('ds.temp.bin')
             self.download_with_retry(('ds.temp.bin','min','https://tgftp.nws.noaa.gov/SL.us008001/ST.opnl/DF.gr2/DC.ndfd/AR.pacnwest/VP.001-003/ds.temp.bin'))
@@ -293,7 +296,8 @@ class Raster():
             if os.path.exists(output_raster):
                 os.remove(output_raster)
 
-# Create the raster object with coordinates
-raster = Raster(43.6,-116.3, True)
-# Print each temp in the bands
-raster.get_min_loc()
+if __name__ == "__main__":
+    # Create the raster object with coordinates
+    raster = Raster(43.6,-116.3, True)
+    # Print each temp in the bands
+    raster.get_min_loc()
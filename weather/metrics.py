@@ -0,0 +1,132 @@
+"""
+Counts where a batch run spends its time. Every stage of the run and every upstream (SQL, Vaisala, NOAA) records how long each call took
+under a name like 'sql.query' or 'stage.fetch', along with the bytes or rows it moved and whether it was answered from a cache.
+batch_run writes a JSON summary of every name to config.metrics_path at the end of the run (calls, total/mean/percentile seconds,
+bytes, items, cache hits and misses). With config.metrics_live_interval set, the percentiles so far are also printed every that many seconds.
+Only the process that runs batch_run is counted, work sent to a process pool shows up as the time its stage waited on the pool.
+"""
+import json
+import time
+import threading
+from contextlib import contextmanager
+import numpy as np
+import config
+
+__authors__ = "Jordan Hiatt"
+
+PERCENTILES = (50, 90, 99)
+
+class Metrics():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # name -> {'seconds': [every call], 'bytes', 'items', 'hits', 'misses'}
+        self.names = {}
+
+    def entry(self, name):
+        if name not in self.names:
+            self.names[name] = {'seconds': [], 'bytes': 0, 'items': 0, 'hits': 0, 'misses': 0}
+        return self.names[name]
+
+    # One call of name that took seconds, items is whatever it counts (rows, points, stations)
+    def record(self, name, seconds, bytes=0, items=0):
+        with self.lock:
+            entry = self.entry(name)
+            entry['seconds'].append(seconds)
+            entry['bytes'] += bytes
+            entry['items'] += items
+
+    # Adds bytes or items to name without counting a call, for amounts that are only known after the timer is done
+    def add(self, name, bytes=0, items=0):
+        with self.lock:
+            entry = self.entry(name)
+            entry['bytes'] += bytes
+            entry['items'] += items
+
+    def hit(self, name):
+        with self.lock:
+            self.entry(name)['hits'] += 1
+
+    def miss(self, name):
+        with self.lock:
+            self.entry(name)['misses'] += 1
+
+    # with metrics.timer('sql.query'): ... records the time of the block, even if it raises
+    @contextmanager
+    def timer(self, name, items=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, items=items)
+
+    def summary(self):
+        with self.lock:
+            names = {name: dict(entry, seconds=list(entry['seconds'])) for name, entry in self.names.items()}
+        result = {'started': self.started, 'wall_seconds': time.time() - self.started, 'names': {}}
+        for name in sorted(names):
+            entry = names[name]
+            seconds = np.array(entry['seconds'], dtype=float)
+            stats = {'calls': len(seconds), 'total_seconds': float(seconds.sum()), 'bytes': entry['bytes'], 'items': entry['items'],
+                     'hits': entry['hits'], 'misses': entry['misses']}
+            if len(seconds) > 0:
+                stats['mean_seconds'] = float(seconds.mean())
+                stats['max_seconds'] = float(seconds.max())
+                for p, value in zip(PERCENTILES, np.percentile(seconds, PERCENTILES)):
+                    stats['p{}_seconds'.format(p)] = float(value)
+            result['names'][name] = stats
+        return result
+
+    def write_summary(self, path=None, **run_info):
+        path = path if path is not None else config.metrics_path
+        summary = self.summary()
+        summary.update(run_info)
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+    # One line for every name that has calls, for printing while the run is going
+    def live_lines(self):
+        lines = []
+        for name, stats in self.summary()['names'].items():
+            if stats['calls'] > 0:
+                lines.append('{:<28} {:>7} calls {:>9.3f}s total  p50 {:.3f}s  p90 {:.3f}s  p99 {:.3f}s'.format(
+                    name, stats['calls'], stats['total_seconds'], stats['p50_seconds'], stats['p90_seconds'], stats['p99_seconds']))
+        return lines
+
+# Prints the live percentiles every interval seconds until stop is called
+class LiveReporter():
+    def __init__(self, metrics, interval):
+        self.metrics = metrics
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            print('\n'.join(['Metrics after {:.0f}s:'.format(time.time() - self.metrics.started)] + self.metrics.live_lines()))
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+# One set of metrics for the whole process, start_run replaces it at the start of every batch run
+metrics = None
+metrics_lock = threading.Lock()
+
+def get_metrics():
+    global metrics
+    with metrics_lock:
+        if metrics is None:
+            metrics = Metrics()
+        return metrics
+
+def start_run():
+    global metrics
+    with metrics_lock:
+        metrics = Metrics()
+        return metrics
@@ -0,0 +1,175 @@
+"""
+Runs items through a chain of stages, each with its own workers, connected by bounded queues. A slow stage holds back the ones before
+it once its queue is full instead of letting finished work pile up in memory, and every stage keeps going on other items in the meantime.
+A stage's function takes an item, or a list of items for a batch stage, and gives back the item for the next stage (a list for a batch
+stage). None drops the item. An item that raises is printed and dropped, same as the rest of the batch run does.
+Setting config.cancel_flag stops every stage and run raises 'Operation Cancelled'.
+Process pools start their workers fresh (spawn, the way Windows always does) instead of forking this process, which by then has the other
+stages' threads running and could be holding their locks. A fresh worker only has what its modules set up when imported, so config's
+settings are copied into it as they are when the run starts.
+"""
+import multiprocessing
+import queue
+import time
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import config
+import metrics
+
+__authors__ = "Jordan Hiatt"
+
+# Put on a queue after the last item
+DONE = object()
+
+# config's settings as they are now, so changes made at run time (the GUI, tests) reach the process workers too
+def settings():
+    return {name: value for name, value in vars(config).items()
+            if not name.startswith('_') and isinstance(value, (str, int, float, list, tuple, dict, type(None)))}
+
+# The initializer of every process worker
+def start_worker(values):
+    for name, value in values.items():
+        setattr(config, name, value)
+
+def process_pool(workers):
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=start_worker, initargs=(settings(),))
+
+class Stage():
+    # processes=True runs the function in a process pool with one process per worker, so it has to be a top level function (or a partial of one).
+    # batch_size makes it a batch stage, each call gets every item that's waiting, up to batch_size of them.
+    # when(item) picks the items the function is called for, the others go straight on to the next stage. Only for stages without a batch_size,
+    # and it's called in this process so with processes=True the items it skips are never sent to the pool.
+    def __init__(self, name, function, workers=1, processes=False, batch_size=None, when=None):
+        self.name = name
+        self.function = function
+        self.workers = max(1, workers)
+        self.processes = processes
+        self.batch_size = batch_size
+        self.when = when
+
+class Pipeline():
+    def __init__(self, stages, queue_size=None):
+        self.stages = stages
+        self.queue_size = queue_size if queue_size is not None else config.pipeline_queue_size
+        # One queue in front of every stage and one for the finished items
+        self.queues = [queue.Queue(maxsize=self.queue_size) for stage in stages] + [queue.Queue()]
+        self.stopped = threading.Event()
+        self.running = [stage.workers for stage in stages]
+        self.running_lock = threading.Lock()
+
+    def cancelled(self):
+        if config.cancel_flag:
+            self.stopped.set()
+        return self.stopped.is_set()
+
+    # Waits for room on a full queue (the backpressure), but gives up if the run is cancelled
+    def put(self, q, item):
+        while not self.cancelled():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, q):
+        while not self.cancelled():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return DONE
+
+    # Everything waiting on the queue, up to count items. DONE goes back on for the other workers.
+    def get_waiting(self, q, count):
+        items = []
+        while len(items) < count:
+            try:
+                item = q.get_nowait()
+            except queue.Empty:
+                break
+            if item is DONE:
+                q.put(DONE)
+                break
+            items.append(item)
+        return items
+
+    def call(self, stage, pool, argument):
+        if pool is not None:
+            return pool.submit(stage.function, argument).result()
+        return stage.function(argument)
+
+    def work(self, index, pool):
+        stage = self.stages[index]
+        in_queue = self.queues[index]
+        out_queue = self.queues[index+1]
+        while not self.cancelled():
+            item = self.get(in_queue)
+            if item is DONE:
+                # Every worker of the stage needs to see it
+                in_queue.put(DONE)
+                break
+            if stage.when is not None and stage.batch_size is None and not stage.when(item):
+                if not self.put(out_queue, item):
+                    break
+                continue
+            # Every call is timed under stage.<name>, items is how many went into it
+            start = time.perf_counter()
+            try:
+                if stage.batch_size is not None:
+                    batch = [item]+self.get_waiting(in_queue, stage.batch_size-1)
+                    results = self.call(stage, pool, batch)
+                    metrics.get_metrics().record('stage.'+stage.name, time.perf_counter()-start, items=len(batch))
+                else:
+                    results = [self.call(stage, pool, item)]
+                    metrics.get_metrics().record('stage.'+stage.name, time.perf_counter()-start, items=1)
+            except Exception as e:
+                metrics.get_metrics().record('stage.'+stage.name+'.failed', time.perf_counter()-start)
+                print('Error in the {} stage:'.format(stage.name))
+                traceback.print_exc()
+                print(str(e))
+                continue
+            for result in results:
+                if result is not None and not self.put(out_queue, result):
+                    break
+
+        # The last worker out tells the next stage there's nothing else coming
+        with self.running_lock:
+            self.running[index] -= 1
+            last = self.running[index] == 0
+        if last:
+            self.put(out_queue, DONE)
+
+    def feed(self, items):
+        for item in items:
+            if not self.put(self.queues[0], item):
+                return
+        self.put(self.queues[0], DONE)
+
+    # Runs every item through all of the stages and gives back whatever comes out of the last one, in the order it finished
+    def run(self, items):
+        pools = [process_pool(stage.workers) if stage.processes else None for stage in self.stages]
+        threads = [threading.Thread(target=self.feed, args=(items,), daemon=True)]
+        for index, stage in enumerate(self.stages):
+            for worker in range(stage.workers):
+                threads.append(threading.Thread(target=self.work, args=(index, pools[index]), name='{}-{}'.format(stage.name, worker), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        results = []
+        try:
+            while True:
+                item = self.get(self.queues[-1])
+                if item is DONE:
+                    break
+                results.append(item)
+        finally:
+            for thread in threads:
+                thread.join()
+            for pool in pools:
+                if pool is not None:
+                    pool.shutdown(cancel_futures=True)
+        if self.stopped.is_set():
+            raise Exception('Operation Cancelled')
+        return results
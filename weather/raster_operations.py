@@ -8,130 +8,66 @@ __authors__ = "Jordan Hiatt"
 import os
 import math
 import time
+import threading
 from datetime import datetime, timedelta
 from datetime import date
-import requests
+import numpy as np
 import pandas as pd
 import config
-# proj.db lets us create projections, there's a problem where osgeo can't find the proj or gdal stuff
+import forecast_download
+import record_batch
+import metrics
 current_dir = os.getcwd()
-os.environ['PROJ_LIB'] = current_dir+'\\share\\proj'
-os.environ['GDAL_DATA'] = current_dir+'\\share'
-from osgeo import gdal
 
-file_paths = []
-file_paths.append(('days1to3min.bin','min','https://tgftp.nws.noaa.gov/SL.us008001/ST.opnl/DF.gr2/DC.ndfd/AR.pacnwest/VP.001-003/ds.mint.bin'))
-file_paths.append(('days4to7min.bin','min', 'https://tgftp.nws.noaa.gov/SL.us008001/ST.opnl/DF.gr2/DC.ndfd/AR.pacnwest/VP.004-007/ds.mint.bin'))
-file_paths.append(('days1to3max.bin','max', 'https://tgftp.nws.noaa.gov/SL.us008001/ST.opnl/DF.gr2/DC.ndfd/AR.pacnwest/VP.001-003/ds.maxt.bin'))
-file_paths.append(('days4to7max.bin','max', 'https://tgftp.nws.noaa.gov/SL.us008001/ST.opnl/DF.gr2/DC.ndfd/AR.pacnwest/VP.004-007/ds.maxt.bin'))
-# avg_temps_filename = 'forecast_temps.csv'
+# GDAL is only imported the first time something needs it, not when this module is
+gdal = None
+gdal_lock = threading.Lock()
 
-class Raster():
-    def __init__(self, pos_north, pos_west, files_downloaded, worker=None):
-        # global file_paths
-        self.pos_north = pos_north
-        self.pos_west = pos_west
-        self.worker = worker
-        self.files_downloaded = files_downloaded
-        
-    # Downloads the files with hardcoded links. Usually fails on the first couple tries, but after the first success doesn't fail again. 
-    def download_with_retry(self, f):
-        remaining_download_tries = 15
-
-        while remaining_download_tries > 0 :
-            if config.cancel_flag:
-                raise Exception('Operation Cancelled')
-            try:
-                response = requests.get(f[2], verify=False, timeout=10)
-                open(f[0], 'wb').write(response.content)
-                print('{} download complete'.format(f[0]))
-                if self.worker is not None:
-                    self.worker.emit_progress('{} download complete\n'.format(f[0]))
-            except Exception as e:
-                print("Error downloading " + f[0] +" on trial: " + str(16 - remaining_download_tries))
-                if self.worker is not None:
-                    self.worker.emit_progress("Error downloading {} on trial: {}\n".format(f[0], str(16 - remaining_download_tries)))
-                remaining_download_tries = remaining_download_tries - 1
-                time.sleep(2)
-                continue
-            else:
-                break
+def get_gdal():
+    global gdal
+    with gdal_lock:
+        if gdal is None:
+            # proj.db lets us create projections, there's a problem where osgeo can't find the proj or gdal stuff. 
+            # The install has them in share, anywhere without it GDAL finds its own. This has to happen before osgeo is imported. 
+            if os.path.isdir(current_dir+'\\share'):
+                os.environ['PROJ_LIB'] = current_dir+'\\share\\proj'
+                os.environ['GDAL_DATA'] = current_dir+'\\share'
+            from osgeo import gdal as osgeo_gdal
+            gdal = osgeo_gdal
+        return gdal
 
-    def download_files(self):
-        for f in file_paths:
-            self.download_with_retry(f)
-
-    @staticmethod
-    def clear_files(file_paths):
-        for f in file_paths:
-            if os.path.exists(f[0]):
-                os.remove(f[0])
-
-    def get_avg_at_coordinate(self, in_df):
-        # Clear files before and after function call 
-        # self.clear_files(file_paths)
-        # self.clear_files([avg_temps_filename])
+# (cached file, min or max, product path under config.ndfd_base_url)
+file_paths = []
+file_paths.append((os.path.join(config.forecast_cache_folder, 'days1to3min.bin'),'min','VP.001-003/ds.mint.bin'))
+file_paths.append((os.path.join(config.forecast_cache_folder, 'days4to7min.bin'),'min', 'VP.004-007/ds.mint.bin'))
+file_paths.append((os.path.join(config.forecast_cache_folder, 'days1to3max.bin'),'max', 'VP.001-003/ds.maxt.bin'))
+file_paths.append((os.path.join(config.forecast_cache_folder, 'days4to7max.bin'),'max', 'VP.004-007/ds.maxt.bin'))
 
-        # grib needs coordinates positive
-        self.pos_west = -self.pos_west
-        print(self.files_downloaded)
-        # TODO: if files current, don't download and don't clear files. Clear the files from batch_output
-        if not self.files_downloaded:
-            # Before downloading any files we clear everything out
-            self.clear_files(file_paths)
-            print('Temporary files cleared')        
-            self.download_files()
+# The warped forecast is shared by every point in a run, this is rebuilt only when the downloaded files change. 
+forecast_grid = None
+forecast_grid_lock = threading.Lock()
 
-        min_list = []
-        max_list = [] 
+# Holds every band of the four NDFD files after they've been warped to EPSG:4326 once. 
+# Looking up a point is then just index arithmetic into arrays that are already in memory. 
+class ForecastGrid():
+    def __init__(self, file_paths):
+        gdal = get_gdal()
+        self.key = self.files_key(file_paths)
+        self.grids = []
 
         date_checked = False
-
         for grb_file in file_paths:
             # Open the grib file
             input_raster = gdal.Open(grb_file[0])
-            output_raster = current_dir+"\\temp.grb"
-
-            # Change lambert projection to epsg4326
-            warp_object = gdal.WarpOptions(dstSRS='EPSG:4326')
-            warp = gdal.Warp(output_raster, input_raster, dstSRS='EPSG:4326')
-            # Close the files
-            warp = None 
 
-            # Open the new grib file created
-            data = gdal.Open(output_raster)
+            # Change lambert projection to epsg4326, kept in memory instead of a temp.grb on disk
+            data = gdal.Warp('', input_raster, format='MEM', dstSRS='EPSG:4326')
             geo_transform = data.GetGeoTransform()
-            x_pixel_size = geo_transform[1]
-
-            # The y pixel size is negative, so we make it positive here
-            y_pixel_size = -geo_transform[5]
 
-            # print('geo_transform: {}'.format(geo_transform))
-            # print('raster x size: {} raster y size: {}'.format(data.RasterXSize, data.RasterYSize))
-            minx = geo_transform[0]
-
-            # The minx + (size of grid point * amount of points in grid) is the max x coordinate
-            maxx = minx + geo_transform[1] * data.RasterXSize
-            maxy = geo_transform[3]
-            miny = maxy + geo_transform[5] * data.RasterYSize
-
-            # Change negative east to positive west
-            positive_minx = -minx
-
-            # The top left of the grid array at (0,0) is the max latitude and min longitude
-            # We need to get the point's coordinate distance from the origin to get the position in the grid. 
-            x_distance_from_origin = abs(positive_minx-self.pos_west) 
-            y_distance_from_origin = abs(maxy-self.pos_north)
-
-            # Dividing coordinate distance by size of each pixel gets us the number of grid points from the origin.
-            # Now we have the location on the grid and can pull it from the array.
-            row = math.floor(x_distance_from_origin/x_pixel_size)
-            col = math.floor(y_distance_from_origin/y_pixel_size)
-
-            raster_count = data.RasterCount
-            for i in range(1, raster_count + 1):
+            is_max = []
+            for i in range(1, data.RasterCount + 1):
                 # Get the date of the current band
-                band = data.GetRasterBand(i)
+                band = input_raster.GetRasterBand(i)
                 epoch_time = int(band.GetMetadata().get('GRIB_VALID_TIME').split()[0])
                 band_date = time.strftime('%m-%d', time.localtime(epoch_time))
                 # only check the current date once
@@ -144,49 +80,190 @@ class Raster():
                     else:
                         print('Gribfile out of date')
                         print('Band {} is {} and tomorrow is {}'.format(i, band_date, tomorrows_date))
-
-                data_array = band.ReadAsArray()
-                # The raster band is read as Y, X or lat/lon. 
-                celsius = data_array[col, row]
-                faren = (celsius * 9/5) + 32 
-
                 # Skip today's forecast
-                if not (band_date == todays_date) and (grb_file[1] == 'max'):
-                    max_list.append(faren)
-                else:
-                    min_list.append(faren)
+                is_max.append(not (band_date == todays_date) and (grb_file[1] == 'max'))
+
+            # The raster bands are read as band, Y, X or band, lat, lon. 
+            bands = data.ReadAsArray().reshape(data.RasterCount, data.RasterYSize, data.RasterXSize)
+            self.grids.append({'geo_transform': geo_transform, 'bands': bands, 'is_max': np.array(is_max, dtype=bool)})
 
             data = None
             input_raster = None
-            if os.path.exists(output_raster):
-                os.remove(output_raster)
 
-        # Zip the two list and get the avg temp for each day
-        avg_temps = []
-        avg_temps_df = pd.DataFrame(columns=['day', 'low', 'high'])
-        current_date = date.today()
-        current_date_string = current_date.strftime("%Y-%m-%d")
+    # Files are identified by path, size and modified time so a new download invalidates the grid
+    @staticmethod
+    def files_key(file_paths):
+        key = []
+        for f in file_paths:
+            stat = os.stat(f[0])
+            key.append((f[0], stat.st_size, stat.st_mtime_ns))
+        return tuple(key)
 
-        for num1, num2 in zip(min_list, max_list):
-            current_date = current_date+timedelta(hours=24)
-            cd_string = current_date.strftime("%Y-%m-%d")
-            avg = (num1+num2)/2
-            tup = (avg, cd_string)
-            avg_temps.append(tup)
-            avg_temps_df = avg_temps_df.append({'day':cd_string, 'low': num1, 'high': num2}, ignore_index=True)
+    @staticmethod
+    def get_grid_index(geo_transform, pos_north, pos_west):
+        x_pixel_size = geo_transform[1]
+
+        # The y pixel size is negative, so we make it positive here
+        y_pixel_size = -geo_transform[5]
+        minx = geo_transform[0]
+        maxy = geo_transform[3]
+
+        # Change negative east to positive west
+        positive_minx = -minx
+
+        # The top left of the grid array at (0,0) is the max latitude and min longitude
+        # We need to get the point's coordinate distance from the origin to get the position in the grid. 
+        x_distance_from_origin = abs(positive_minx-pos_west) 
+        y_distance_from_origin = abs(maxy-pos_north)
 
+        # Dividing coordinate distance by size of each pixel gets us the number of grid points from the origin.
+        # Now we have the location on the grid and can pull it from the array.
+        row = math.floor(x_distance_from_origin/x_pixel_size)
+        col = math.floor(y_distance_from_origin/y_pixel_size)
+        return col, row
+
+    # Returns the forecast lows and highs in fahrenheit at a point, pos_west is positive
+    def sample(self, pos_north, pos_west):
+        min_list = []
+        max_list = []
+        for grid in self.grids:
+            col, row = self.get_grid_index(grid['geo_transform'], pos_north, pos_west)
+            celsius = grid['bands'][:, col, row]
+            faren = (celsius * 9/5) + 32 
+            min_list.extend(faren[~grid['is_max']])
+            max_list.extend(faren[grid['is_max']])
+        return min_list, max_list
+
+    # Vectorized version of sample for arrays of points, lons are negative west like the input csv. 
+    # Every band of a file is gathered for all points at once. Returns (points, bands) arrays of lows and highs in fahrenheit. 
+    # interpolation='bilinear' blends the four surrounding cell centers instead of taking the cell the point falls in. 
+    # With 'nearest' a point off the grid gets NaN. 
+    def sample_points(self, lats, lons, interpolation='nearest'):
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        min_stack = []
+        max_stack = []
+        for grid in self.grids:
+            geo_transform = grid['geo_transform']
+            bands = grid['bands']
+            # Same distances from the top left of the grid as get_grid_index, in pixels. They're kept signed so a point north or west 
+            # of the grid is off it instead of landing the same distance inside. 
+            x_pixels = (lons - geo_transform[0])/geo_transform[1]
+            y_pixels = (geo_transform[3] - lats)/-geo_transform[5]
+
+            if interpolation == 'nearest':
+                celsius = self.nearest(bands, y_pixels, x_pixels)
+            elif interpolation == 'bilinear':
+                celsius = self.bilinear(bands, y_pixels, x_pixels)
+            else:
+                raise ValueError('Unknown interpolation: {}'.format(interpolation))
+
+            faren = (celsius * 9/5) + 32 
+            min_stack.append(faren[~grid['is_max']])
+            max_stack.append(faren[grid['is_max']])
+        return np.concatenate(min_stack).T, np.concatenate(max_stack).T
+
+    # The cell each point falls in, NaN for the points off the grid
+    @staticmethod
+    def nearest(bands, y_pixels, x_pixels):
+        y = np.floor(y_pixels).astype(int)
+        x = np.floor(x_pixels).astype(int)
+        inside = (y >= 0) & (y < bands.shape[1]) & (x >= 0) & (x < bands.shape[2])
+        celsius = bands[:, np.clip(y, 0, bands.shape[1] - 1), np.clip(x, 0, bands.shape[2] - 1)]
+        return np.where(inside, celsius, np.nan)
+
+    # Pixel (0,0) covers the area from the origin to one pixel over, so its center is half a pixel in. 
+    # Points outside of the outer cell centers are clamped to the edge. 
+    @staticmethod
+    def bilinear(bands, y_pixels, x_pixels):
+        y = np.clip(y_pixels - 0.5, 0, bands.shape[1] - 1)
+        x = np.clip(x_pixels - 0.5, 0, bands.shape[2] - 1)
+        y0 = np.minimum(np.floor(y).astype(int), max(bands.shape[1] - 2, 0))
+        x0 = np.minimum(np.floor(x).astype(int), max(bands.shape[2] - 2, 0))
+        y1 = np.minimum(y0 + 1, bands.shape[1] - 1)
+        x1 = np.minimum(x0 + 1, bands.shape[2] - 1)
+        wy = y - y0
+        wx = x - x0
+        top = bands[:, y0, x0]*(1 - wx) + bands[:, y0, x1]*wx
+        bottom = bands[:, y1, x0]*(1 - wx) + bands[:, y1, x1]*wx
+        return top*(1 - wy) + bottom*wy
+
+# Warps the downloaded files the first time they're needed and hands back the same grid until they change. 
+def get_forecast_grid():
+    global forecast_grid
+    with forecast_grid_lock:
+        if forecast_grid is None or forecast_grid.key != ForecastGrid.files_key(file_paths):
+            metrics.get_metrics().miss('noaa.grid')
+            with metrics.get_metrics().timer('noaa.grid'):
+                forecast_grid = ForecastGrid(file_paths)
+        else:
+            metrics.get_metrics().hit('noaa.grid')
+        return forecast_grid
+
+class Raster():
+    def __init__(self, pos_north, pos_west, files_downloaded, worker=None):
+        # global file_paths
+        self.pos_north = pos_north
+        self.pos_west = pos_west
+        self.worker = worker
+        self.files_downloaded = files_downloaded
+        
+    # Brings one file up to date in the forecast cache. Nothing is downloaded if NOAA hasn't published a newer product. 
+    def download_with_retry(self, f):
+        forecast_download.ForecastDownloader(worker=self.worker).download(f)
+
+    # All four files are checked and downloaded at the same time
+    def download_files(self):
+        forecast_download.ForecastDownloader(worker=self.worker).download_all(file_paths)
+
+    @staticmethod
+    def clear_files(file_paths):
+        for f in file_paths:
+            if os.path.exists(f[0]):
+                os.remove(f[0])
+
+    # Bulk version of get_avg_at_coordinate for a whole list of points. 
+    # Returns the forecast days along with (points, days) arrays of the lows, highs and averages in fahrenheit. 
+    @staticmethod
+    def get_avg_at_coordinates(lats, lons, files_downloaded=True, interpolation='nearest', worker=None):
+        if not files_downloaded:
+            Raster(None, None, files_downloaded, worker).download_files()
+
+        with metrics.get_metrics().timer('noaa.sample', items=len(lats)):
+            lows, highs = get_forecast_grid().sample_points(lats, lons, interpolation)
+
+        # Same as zipping the two lists, extra days on either side are dropped
+        day_count = min(lows.shape[1], highs.shape[1])
+        lows = lows[:, :day_count]
+        highs = highs[:, :day_count]
+        days = [(date.today()+timedelta(days=i+1)).strftime("%Y-%m-%d") for i in range(day_count)]
+        return days, lows, highs, (lows+highs)/2
+
+    # The forecast for one point out of get_avg_at_coordinates, in the same shape get_avg_at_coordinate appends
+    @staticmethod
+    def forecast_frame(days, lows, highs):
+        avg_temps_df = pd.DataFrame({'day': days, 'low': lows, 'high': highs})
         avg_temps_df.index.name = 'index'
+        return avg_temps_df
 
-        # Create avg_temps csv to be appended onto the historical data
-        # print('Writing forecast_temps.csv')
-        # self.clear_files([avg_temps_filename])
-        # df = pd.read_csv('CsvFiles\\appended_historical_data.csv', header=0)
-        # df2 = pd.read_csv('forecast_temps.csv', header=0)
-        # df = df.append(df2, ignore_index=True)
+    def get_avg_at_coordinate(self, in_df):
+        # grib needs coordinates positive
+        pos_west = -self.pos_west
+        # The download is skipped when the cached files are still current
+        if not self.files_downloaded:
+            self.download_files()
 
-        #TODO: do we need to do a .copy()?
-        in_df = in_df.append(avg_temps_df, ignore_index=True)
+        min_list, max_list = get_forecast_grid().sample(self.pos_north, pos_west)
 
-        # avg_temps_df.to_csv(avg_temps_filename)
+        # Zip the two lists, one row a day from tomorrow
+        forecast = record_batch.RecordBatchBuilder([('day', object), ('low', float), ('high', float)])
+        current_date = date.today()
+        for num1, num2 in zip(min_list, max_list):
+            current_date = current_date+timedelta(hours=24)
+            forecast.append_values((current_date.strftime("%Y-%m-%d"), num1, num2))
 
+        avg_temps_df = forecast.build(index_name='index')
+
+        #TODO: do we need to do a .copy()?
+        in_df = pd.concat([in_df, avg_temps_df], ignore_index=True)
         return in_df
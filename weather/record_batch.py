@@ -0,0 +1,29 @@
+"""
+Builds a DataFrame a row at a time without DataFrame.append, which copies the whole frame for every row it adds (and is gone in pandas 2.0).
+Each column is a plain list until build, which makes the DataFrame once with the dtype the column was declared with, so a few hundred
+rows cost a few hundred list appends instead of a few hundred copies.
+"""
+import numpy as np
+import pandas as pd
+
+__authors__ = "Jordan Hiatt"
+
+class RecordBatchBuilder():
+    # columns is a list of (name, dtype), in the order the DataFrame should have them. Missing numbers come out as NaN.
+    def __init__(self, columns):
+        self.names = [name for name, dtype in columns]
+        self.dtypes = [dtype for name, dtype in columns]
+        self.columns = [[] for name in self.names]
+
+    def __len__(self):
+        return len(self.columns[0]) if len(self.columns) > 0 else 0
+
+    # One row as values in column order, a database row for instance
+    def append_values(self, values):
+        for column, value in zip(self.columns, values):
+            column.append(value)
+
+    def build(self, index_name=None):
+        df = pd.DataFrame({name: np.array(column, dtype=dtype) for name, dtype, column in zip(self.names, self.dtypes, self.columns)}, columns=self.names)
+        df.index.name = index_name
+        return df
@@ -0,0 +1,68 @@
+"""
+Saves where each point's spreadsheet is at the end of its settled observations (the cumulative indices, which milestones have happened 
+and the rows so far) so the daily run only pulls and runs the days after it plus the forecast instead of the whole season again.
+States are kept in a SQLite file keyed by the point's coordinates and the first day of the season.
+The saved rows are taken as final, if the history of a point is corrected delete the file or set config.resume_seasons = False to start over.
+"""
+import json
+import sqlite3
+import threading
+import pandas as pd
+import config
+
+__authors__ = "Jordan Hiatt"
+
+def point_key(lat, lon):
+    return '%.6f_%.6f' % (lat, lon)
+
+class SeasonStateStore():
+    def __init__(self, path=None):
+        self.path = path if path is not None else config.season_state_path
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS season_state (point TEXT, season TEXT, state TEXT, PRIMARY KEY (point, season))')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS season_rows (point TEXT, season TEXT, row INTEGER, day TEXT, average REAL, roadway_status TEXT, message TEXT, PRIMARY KEY (point, season, row))')
+        self.conn.commit()
+        self.lock = threading.Lock()
+
+    # The saved state and rows of every point that has them, point -> (state, DataFrame of the rows up to the state)
+    def load_all(self, season):
+        with self.lock:
+            state_rows = self.conn.execute('SELECT point, state FROM season_state WHERE season = ?', (season,)).fetchall()
+            rows = self.conn.execute('SELECT point, day, average, roadway_status, message FROM season_rows WHERE season = ? ORDER BY point, row', (season,)).fetchall()
+        rows_df = pd.DataFrame.from_records(rows, columns=['point', 'day', 'average', 'roadway_status', 'message'])
+        frames = {point: df.drop(columns='point').reset_index(drop=True) for point, df in rows_df.groupby('point', sort=False)}
+
+        states = {}
+        for point, state in state_rows:
+            state = json.loads(state)
+            # A state without all of its rows can't be carried on from
+            if point in frames and len(frames[point]) == state['rows']:
+                states[point] = (state, frames[point])
+        return states
+
+    # checkpoints is a list of (point, state, new_df), new_df being the rows from the point's last state up to this one
+    def save_all(self, season, checkpoints):
+        state_rows = []
+        rows = []
+        for point, state, new_df in checkpoints:
+            state_rows.append((point, season, json.dumps(state)))
+            first = state['rows']-len(new_df)
+            for row, (day, average, status, message) in enumerate(zip(new_df['day'], new_df['average'], new_df['roadway_status'], new_df['message'])):
+                rows.append((point, season, first+row, day, None if pd.isna(average) else float(average), status, message))
+        with self.lock:
+            # Rows past the state are left over from a longer state that was replaced by a run that started over
+            self.conn.executemany('DELETE FROM season_rows WHERE point = ? AND season = ? AND row >= ?', [(point, season, state['rows']) for point, state, new_df in checkpoints])
+            self.conn.executemany('INSERT OR REPLACE INTO season_rows VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self.conn.executemany('INSERT OR REPLACE INTO season_state VALUES (?, ?, ?)', state_rows)
+            self.conn.commit()
+
+# One store for the whole process
+season_state_store = None
+season_state_store_lock = threading.Lock()
+
+def get_season_state_store():
+    global season_state_store
+    with season_state_store_lock:
+        if season_state_store is None:
+            season_state_store = SeasonStateStore()
+        return season_state_store
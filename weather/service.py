@@ -0,0 +1,300 @@
+"""
+Answers "what's the breakup status of this point" over HTTP/JSON from one process that keeps running, so nothing has to start over for each
+query: the NDFD grids stay warped in memory (raster_operations.get_forecast_grid), the station index, Vaisala observations and the RWIS
+history of every point asked for stay loaded, database connections stay open in db.py's pool and every point carries on from the season
+state the batch run saved (season_state.py), the service only reads them.
+Each answer is kept for config.service_cache_seconds, and identical queries that come in while one is being worked out wait for it
+instead of doing it again. Every config.service_refresh_seconds the forecast files are checked for a newer product, the recent
+observations are asked for again and the histories are pulled again for all of the points at once.
+
+    python service.py [port]
+    GET /breakup?lat=45.123&lon=-114.567[&location=US-95 MP 12]
+    GET /health
+    GET /metrics
+
+The upstreams are the ones in config (db_backend, vaisala_export_url, ndfd_base_url), which can all be pointed at local stand-ins to run
+offline, see benchmarks/bench_service.py. forecast replaces the NDFD forecast with a function of (lat, lon) giving its days.
+"""
+import sys
+import json
+import time
+import threading
+import traceback
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import config, batch_output, emulate_spreadsheet, raster_operations, season_state, sql_query, station_index, vaisala_cache, metrics
+
+__authors__ = "Jordan Hiatt"
+
+# Identical calls that overlap are only run once, the ones that come in while it's running wait for it and get the same result
+class SingleFlight():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, function):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+        if not leader:
+            metrics.get_metrics().hit('service.coalesced')
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = function()
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['done'].set()
+        return call['result']
+
+class BreakupService():
+    def __init__(self, forecast=None, cache_seconds=None, refresh_seconds=None):
+        self.forecast = forecast if forecast is not None else self.sample_forecast
+        self.cache_seconds = cache_seconds if cache_seconds is not None else config.service_cache_seconds
+        self.refresh_seconds = refresh_seconds if refresh_seconds is not None else config.service_refresh_seconds
+        self.flights = SingleFlight()
+        # key -> (time, answer)
+        self.answers = {}
+        # point key -> (lat, lon, start day, DataFrame) of the RWIS history of every point asked for in self.season
+        self.histories = {}
+        self.answers_lock = threading.Lock()
+        # Saved season states of the season in self.season, reloaded on every refresh
+        self.season = None
+        self.states = {}
+        # Goes up with every refresh, an answer or history worked out from before the last refresh isn't kept
+        self.generation = 0
+        self.started = time.time()
+        self.refreshed = None
+        self.stopped = threading.Event()
+        self.refresher = None
+
+    # Loads everything up front so the first query doesn't pay for it
+    def warm(self):
+        vaisala_cache.get_observation_cache()
+        self.refresh()
+
+    # Newer forecast files, the station table once it's older than config.station_cache_max_age, the recent observations, saved states 
+    # and histories. Answers from before are dropped.
+    def refresh(self):
+        with metrics.get_metrics().timer('service.refresh'):
+            if self.forecast == self.sample_forecast:
+                try:
+                    raster_operations.Raster(None, None, False).download_files()
+                    raster_operations.get_forecast_grid()
+                except Exception as e:
+                    traceback.print_exc()
+                    print(str(e))
+            stations = station_index.StationIndex.load()
+            with station_index.station_index_lock:
+                station_index.station_index = stations
+            vaisala_cache.get_observation_cache().forget_recent()
+            season, today_string = batch_output.season_days()
+            states = {}
+            if config.resume_seasons:
+                try:
+                    states = season_state.get_season_state_store().load_all(season)
+                except Exception as e:
+                    traceback.print_exc()
+                    print(str(e))
+            histories = self.pull_histories(season, states, today_string)
+            with self.answers_lock:
+                self.season, self.states = season, states
+                self.histories = histories
+                self.answers = {}
+                self.generation += 1
+            self.refreshed = time.time()
+
+    # The history of every point kept from this season pulled again up to today, with one query for all the points that start on the same day. 
+    # A point that fails is left out and pulled on its own the next time it's asked for. 
+    def pull_histories(self, season, states, today_string):
+        with self.answers_lock:
+            points = [(key, lat, lon) for key, (lat, lon, start_day, history_df) in self.histories.items()] if season == self.season else []
+        starts = batch_output.start_days([states.get(key) for key, lat, lon in points], season)
+        histories = {}
+        for start in sorted(set(starts)):
+            group = [point for point, point_start in zip(points, starts) if point_start == start]
+            try:
+                with metrics.get_metrics().timer('service.pull_histories', items=len(group)):
+                    pulled = sql_query.pull_data_bulk(start, today_string, [lat for key, lat, lon in group], [lon for key, lat, lon in group])
+            except Exception as e:
+                traceback.print_exc()
+                print(str(e))
+                continue
+            for (key, lat, lon), history_df in zip(group, pulled):
+                histories[key] = (lat, lon, start, history_df)
+        return histories
+
+    # The metrics start over with every refresh so they don't grow for as long as the service runs, /metrics is since the last one
+    def refresh_loop(self):
+        while not self.stopped.wait(self.refresh_seconds):
+            metrics.start_run()
+            try:
+                self.refresh()
+            except Exception as e:
+                traceback.print_exc()
+                print(str(e))
+
+    def start_refresher(self):
+        self.refresher = threading.Thread(target=self.refresh_loop, daemon=True)
+        self.refresher.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    # The forecast days at one point from the warped grid, in the shape batch_output.fetch_point appends
+    @staticmethod
+    def sample_forecast(lat, lon):
+        days, lows, highs, averages = raster_operations.Raster.get_avg_at_coordinates([lat], [lon])
+        return raster_operations.Raster.forecast_frame(days, lows[0], highs[0])
+
+    # The answer for a point, from the ones kept or else worked out once for everyone asking at the same time
+    def point_status(self, lat, lon, location=''):
+        key = (season_state.point_key(lat, lon), location, self.season)
+        with self.answers_lock:
+            kept = self.answers.get(key)
+        if kept is not None and time.time() - kept[0] < self.cache_seconds:
+            metrics.get_metrics().hit('service.answer')
+            return dict(kept[1], cached=True)
+        metrics.get_metrics().miss('service.answer')
+        answer = self.flights.do(key, lambda: self.build_answer(key, lat, lon, location))
+        return dict(answer, cached=False)
+
+    def build_answer(self, key, lat, lon, location):
+        start = time.perf_counter()
+        season, today_string = batch_output.season_days()
+        point = {'lat': lat, 'lon': lon, 'location': location, 'point_string': location}
+        point_key = season_state.point_key(lat, lon)
+        with self.answers_lock:
+            generation = self.generation
+            current = season == self.season
+            state = self.states.get(point_key) if current else None
+            kept = self.histories.get(point_key) if current else None
+        start_day = batch_output.start_days([state], season)[0]
+        if kept is not None and kept[2] == start_day:
+            metrics.get_metrics().hit('service.history')
+            history_df = kept[3]
+        else:
+            metrics.get_metrics().miss('service.history')
+            with metrics.get_metrics().timer('fetch.history'):
+                history_df = sql_query.pull_data(start_day, today_string, lat, lon)
+            with self.answers_lock:
+                if current and generation == self.generation:
+                    self.histories[point_key] = (lat, lon, start_day, history_df)
+        df = batch_output.fetch_point(point, start_day, today_string, history_df=history_df, forecast_df=self.forecast(lat, lon))
+        # Only the batch run saves season states, the checkpoints of a query are dropped so season_state.sqlite isn't written from here
+        with metrics.get_metrics().timer('spreadsheet.emulate'):
+            spreadsheets, breakups, checkpoints = batch_output.emulate_groups([point], [df], [state])
+        if spreadsheets[0] is None:
+            raise Exception('The spreadsheet could not be built for ({}, {})'.format(lat, lon))
+        answer = status_answer(point, spreadsheets[0], breakups[0], today_string)
+        answer['seconds'] = time.perf_counter() - start
+        with self.answers_lock:
+            if generation == self.generation:
+                self.answers[key] = (time.time(), answer)
+        return answer
+
+    def health(self):
+        with self.answers_lock:
+            answer_count = len(self.answers)
+            history_count = len(self.histories)
+        return {'started': self.started, 'refreshed': self.refreshed, 'season': self.season, 'saved_states': len(self.states),
+                'answers': answer_count, 'histories': history_count, 'stations': len(station_index.get_station_index().stations)}
+
+def json_value(value):
+    if isinstance(value, (np.floating, float)):
+        return None if np.isnan(value) else float(value)
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+# The status of the point today, when breakup limits start and every milestone, and the days of the forecast
+def status_answer(point, df, breakup, today_string):
+    observed = df[df['day'] <= today_string]
+    today = observed.iloc[-1] if len(observed) > 0 else None
+    milestones = [{'day': day, 'message': message} for day, message in zip(df['day'], df['message']) if message in emulate_spreadsheet.MILESTONES]
+    forecast = df[df['day'] > today_string]
+    return {
+        'lat': point['lat'],
+        'lon': point['lon'],
+        'location': point['location'],
+        'day': today['day'] if today is not None else None,
+        'roadway_status': json_value(today['roadway_status']) if today is not None else None,
+        'average': json_value(today['average']) if today is not None else None,
+        'breakup': None if breakup is None else {'day': breakup[0], 'average': json_value(breakup[1])},
+        'breakup_limits': breakup is not None and breakup[0] <= today_string,
+        'milestones': milestones,
+        'forecast': [{'day': day, 'average': json_value(average), 'roadway_status': json_value(status)}
+                     for day, average, status in zip(forecast['day'], forecast['average'], forecast['roadway_status'])],
+    }
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    # Set by serve
+    service = None
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        with metrics.get_metrics().timer('service.request'):
+            try:
+                if url.path == '/breakup':
+                    try:
+                        lat = float(query['lat'][0])
+                        lon = float(query['lon'][0])
+                    except (KeyError, ValueError):
+                        self.send_json(400, {'error': 'lat and lon are needed, as numbers'})
+                        return
+                    location = query.get('location', [''])[0]
+                    self.send_json(200, self.service.point_status(lat, lon, location))
+                elif url.path == '/health':
+                    self.send_json(200, self.service.health())
+                elif url.path == '/metrics':
+                    self.send_json(200, metrics.get_metrics().summary())
+                else:
+                    self.send_json(404, {'error': 'unknown path {}'.format(url.path)})
+            except Exception as e:
+                traceback.print_exc()
+                self.send_json(500, {'error': str(e)})
+
+    # Requests aren't printed one by one, /metrics has them
+    def log_message(self, format, *args):
+        pass
+
+# Makes the server, port 0 picks a free one (server.server_address has it). serve_forever on the result starts answering.
+def make_server(service, host=None, port=None):
+    handler = type('BoundServiceHandler', (ServiceHandler,), {'service': service})
+    return ThreadingHTTPServer((host if host is not None else config.service_host, port if port is not None else config.service_port), handler)
+
+def serve(port=None):
+    service = BreakupService()
+    print('Warming up...\n')
+    service.warm()
+    service.start_refresher()
+    server = make_server(service, port=port)
+    print('Serving breakup status on http://{}:{}/breakup?lat=..&lon=..\n'.format(*server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+        server.server_close()
+
+if __name__ == "__main__":
+    serve(int(sys.argv[1]) if len(sys.argv) > 1 else None)
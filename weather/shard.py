@@ -0,0 +1,134 @@
+"""
+Splits a batch run across several machines that share a folder. python batch_output.py <file.csv> <-s/-r> [workers] --shard i/N
+runs only shard i of N (1 to N) of the points and writes its outputs to Shards\\shard-i-of-N: the Spreadsheets .csv and .png,
+closure_dates.csv, the dataset when config.output_format isn't 'csv', run_metrics.json, and shard.json once it has finished.
+When all N are done, python batch_output.py --merge N puts them together into the same Spreadsheets folder, closure_dates.csv and dataset
+a single run would have made.
+
+Points are split by id so every point of an id is in the same shard, and points that save to the same spreadsheet (same coordinates)
+go with it too. That keeps the earliest closure date of every id, its .png and every .csv inside one shard, so merging never has to choose
+between two shards. Which shard a point goes to only depends on the input, not the machine or the order the shards are run in.
+"""
+import os
+import json
+import glob
+import time
+import zlib
+import shutil
+import pandas as pd
+import config
+import spreadsheet_dataset
+
+__authors__ = "Jordan Hiatt"
+
+# '2/4' -> (2, 4)
+def parse_shard(text):
+    try:
+        index, count = [int(part) for part in text.split('/')]
+    except ValueError:
+        raise ValueError('--shard should look like i/N, got {}'.format(text))
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError('--shard i/N needs 1 <= i <= N, got {}'.format(text))
+    return index, count
+
+def shard_folder(index, count):
+    return os.path.join(config.shard_folder, 'shard-{}-of-{}'.format(index, count))
+
+# The key each point is split on: the id for RouteNo, the first column (what point_string names it by) for SegCode, tied together with
+# every other point that saves to the same spreadsheet. The smallest key of each of those sets stands for the set.
+def shard_keys(mp_coord_df, point_type):
+    if point_type == 'RouteNo':
+        keys = mp_coord_df['id'].astype(str).tolist()
+        lats, lons = mp_coord_df['LAT'], mp_coord_df['LON']
+    else:
+        keys = mp_coord_df.iloc[:, 0].astype(str).tolist()
+        lats, lons = mp_coord_df['lat'], mp_coord_df['lon']
+    # Same coordinate string as the spreadsheet file name (batch_output.create_file_path)
+    files = ['%.3f_%.3f' % (lat, lon) for lat, lon in zip(lats, lons)]
+
+    # Union-find over keys and file names
+    parent = {}
+    def find(node):
+        parent.setdefault(node, node)
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+    def union(a, b):
+        a, b = find(a), find(b)
+        if a != b:
+            # The smaller key stays the root so the set is named the same no matter what order the rows come in
+            parent[max(a, b)] = min(a, b)
+    for key, file_name in zip(keys, files):
+        union(('key', key), ('file', file_name))
+    return [find(('key', key))[1] for key in keys]
+
+# Positions in the input of the points in shard index of count, in input order. crc32 rather than hash() so every machine agrees.
+def shard_positions(mp_coord_df, point_type, index, count):
+    keys = shard_keys(mp_coord_df, point_type)
+    return [position for position, key in enumerate(keys) if zlib.crc32(key.encode('utf-8')) % count == index - 1]
+
+# Written to the shard's folder after it has finished, merge_shards only takes shards that have one
+def write_manifest(folder, index, count, point_type, input_points, positions):
+    manifest = {'index': index, 'count': count, 'point_type': point_type, 'input_points': input_points, 'points': len(positions),
+                'finished': time.time()}
+    with open(os.path.join(folder, 'shard.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+def read_manifest(folder):
+    path = os.path.join(folder, 'shard.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+# Clears out an earlier run of the same shard
+def clear_folder(folder):
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+
+# Puts the outputs of all count shards together in the working folder. Raises if any of them hasn't finished.
+def merge_shards(count):
+    folders = [shard_folder(index, count) for index in range(1, count + 1)]
+    manifests = [read_manifest(folder) for folder in folders]
+    missing = [index for index, manifest in enumerate(manifests, 1) if manifest is None]
+    if missing:
+        raise RuntimeError('Shards {} of {} haven\'t finished, nothing was merged'.format(', '.join(str(index) for index in missing), count))
+    if len(set(manifest['input_points'] for manifest in manifests)) > 1 or len(set(manifest['point_type'] for manifest in manifests)) > 1:
+        raise RuntimeError('The shards were run on different inputs, nothing was merged')
+
+    # Spreadsheets .csv and .png, no two shards have the same file
+    spreadsheet_folder = os.getcwd()+'\\Spreadsheets'
+    if not os.path.isdir(spreadsheet_folder):
+        os.makedirs(spreadsheet_folder)
+    for f in glob.glob(spreadsheet_folder+'\\*'):
+        os.remove(f)
+    copied = 0
+    for folder in folders:
+        for f in glob.glob(folder+'\\Spreadsheets\\*'):
+            shutil.copyfile(f, spreadsheet_folder+'\\'+f.split('\\')[-1])
+            copied += 1
+
+    # Dataset parts already have input positions and go in the same bucket folders, they only need names that don't clash
+    dataset_parts = 0
+    for index, folder in enumerate(folders, 1):
+        for bucket_folder, name in spreadsheet_dataset.part_files(os.path.join(folder, 'SpreadsheetDataset')):
+            if dataset_parts == 0:
+                spreadsheet_dataset.clear_folder(config.output_dataset_folder)
+            merged_folder = os.path.join(config.output_dataset_folder, bucket_folder)
+            if not os.path.isdir(merged_folder):
+                os.makedirs(merged_folder)
+            shutil.copyfile(os.path.join(folder, 'SpreadsheetDataset', bucket_folder, name), os.path.join(merged_folder, 'part-{:03d}-{}'.format(index, name[len('part-'):])))
+            dataset_parts += 1
+
+    # Every id is in only one shard, so this is the earliest day of each id the same as batch_run picks it. 
+    # The coordinates are read back exactly so they're written out the same as a single run writes them. 
+    closure_date_df = pd.concat([pd.read_csv(os.path.join(folder, 'closure_dates.csv'), float_precision='round_trip') for folder in folders], ignore_index=True)
+    closure_date_df['day'] = pd.to_datetime(closure_date_df['day'])
+    closure_date_df = closure_date_df.loc[closure_date_df.groupby(['id'])['day'].idxmin()]
+    file_name = 'closure_dates.csv'
+    if os.path.exists(file_name):
+        os.remove(file_name)
+    closure_date_df[['id', 'day', 'average', 'ROUTE', 'MILEPOINTER', 'LAT', 'LON']].to_csv(file_name, index=False)
+    print('Merged {} shards: {} spreadsheet files, {} dataset parts, {} closure dates\n'.format(count, copied, dataset_parts, len(closure_date_df)))
@@ -0,0 +1,157 @@
+"""
+Saves every point's spreadsheet into one dataset instead of a .csv for each point. Rows are gathered from the points as they finish and
+written out together every config.output_batch_rows rows as Parquet (or Arrow IPC) files in config.output_dataset_folder.
+Every row has the point it belongs to (position in the input, point key, id, route and coordinates) next to the spreadsheet columns.
+The files are partitioned by point key: each point goes in one of config.output_dataset_buckets folders (bucket=N, hive style) picked
+from its key, sorted by point and day inside, so read_point only opens the files of one bucket instead of scanning the whole dataset.
+A folder for every point would be thousands of tiny files again, so points share buckets. The breakup column marks the day breakup
+limits start, and closure_dates reads only those rows back to build closure_dates.csv.
+pyarrow is optional, it's only imported once a dataset is opened when config.output_format isn't 'csv'.
+"""
+import os
+import glob
+import zlib
+import shutil
+import threading
+import pandas as pd
+import config
+import season_state
+import metrics
+
+__authors__ = "Jordan Hiatt"
+
+# File extension and pyarrow.dataset format of each output format
+FORMATS = {'parquet': ('parquet', 'parquet'), 'arrow': ('arrow', 'ipc')}
+
+# The bucket a point key goes in, crc32 rather than hash() so it's the same in every process
+def point_bucket(key, buckets=None):
+    buckets = buckets if buckets is not None else config.output_dataset_buckets
+    return zlib.crc32(key.encode('utf-8')) % buckets
+
+# Empties the folder of an earlier run
+def clear_folder(folder):
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    for old_file in glob.glob(os.path.join(folder, 'part-*.*')):
+        os.remove(old_file)
+    for old_folder in glob.glob(os.path.join(folder, 'bucket=*')):
+        shutil.rmtree(old_folder)
+
+# Every file of a dataset as (bucket folder, file name)
+def part_files(folder):
+    return [(os.path.basename(os.path.dirname(f)), os.path.basename(f)) for f in sorted(glob.glob(os.path.join(folder, 'bucket=*', 'part-*.*')))]
+
+class SpreadsheetDataset():
+    # positions maps a point's position to its position in the whole input, for a shard (shard.py) that only runs some of the points.
+    # clear=False opens the dataset an earlier run left in the folder to read it back.
+    def __init__(self, folder=None, file_format=None, batch_rows=None, positions=None, buckets=None, clear=True):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError('pyarrow is needed for output_format = {}'.format(file_format or config.output_format))
+        self.folder = folder if folder is not None else config.output_dataset_folder
+        self.file_format = file_format if file_format is not None else config.output_format
+        if self.file_format not in FORMATS:
+            raise ValueError('Unknown output format: {}'.format(self.file_format))
+        self.batch_rows = batch_rows if batch_rows is not None else config.output_batch_rows
+        self.positions = positions
+        # Reading back by point needs the same number of buckets the dataset was written with
+        self.buckets = buckets if buckets is not None else config.output_dataset_buckets
+        self.extension, self.dataset_format = FORMATS[self.file_format]
+
+        # Each run replaces the last one
+        if clear:
+            clear_folder(self.folder)
+
+        self.frames = []
+        self.rows = 0
+        self.parts = 0
+        self.lock = threading.Lock()
+
+    # Adds one point's spreadsheet. breakup is the (day, average) from emulate_points or None.
+    def add(self, point, df, breakup=None):
+        frame = pd.DataFrame({
+            'position': point['position'] if self.positions is None else self.positions[point['position']],
+            'point': season_state.point_key(point['lat'], point['lon']),
+            'id': point.get('id'),
+            'route': point.get('route_code'),
+            'location': point['location'],
+            'lat': point['lat'],
+            'lon': point['lon'],
+            'day': df['day'].to_numpy(),
+            'average': df['average'].to_numpy(dtype=float),
+            'roadway_status': df['roadway_status'].to_numpy(),
+            'message': df['message'].to_numpy(),
+            'breakup': (df['day'] == breakup[0]).to_numpy() if breakup is not None else False,
+        })
+        with self.lock:
+            self.frames.append(frame)
+            self.rows += len(frame)
+            if self.rows >= self.batch_rows:
+                self.write_batch()
+
+    # Has to be called with the lock held
+    def write_batch(self):
+        if len(self.frames) == 0:
+            return
+        with metrics.get_metrics().timer('output.dataset_write', items=self.rows):
+            self.write_frames()
+
+    # One file in the folder of every bucket the batch has rows for. The bucket comes back as a column from the folder name when it's read.
+    def write_frames(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pa_parquet
+        batch_df = pd.concat(self.frames, ignore_index=True)
+        self.frames = []
+        self.rows = 0
+        # Blank cells of the text columns go in as nulls
+        for column in ('roadway_status', 'message'):
+            batch_df[column] = batch_df[column].map(lambda value: None if pd.isna(value) else str(value))
+        buckets = batch_df['point'].map(lambda key: point_bucket(key, self.buckets))
+        for bucket, bucket_df in batch_df.groupby(buckets.to_numpy(), sort=True):
+            bucket_df = bucket_df.sort_values(['point', 'position', 'day'], kind='stable')
+            table = pa.Table.from_pandas(bucket_df, preserve_index=False)
+            bucket_folder = os.path.join(self.folder, 'bucket={}'.format(bucket))
+            if not os.path.isdir(bucket_folder):
+                os.makedirs(bucket_folder)
+            file_path = os.path.join(bucket_folder, 'part-{:05d}.{}'.format(self.parts, self.extension))
+            if self.file_format == 'parquet':
+                pa_parquet.write_table(table, file_path)
+            else:
+                with pa.ipc.new_file(file_path, table.schema) as writer:
+                    writer.write_table(table)
+        self.parts += 1
+
+    def close(self):
+        with self.lock:
+            self.write_batch()
+
+    # Reads the dataset back, only the given columns and, with filter, only the rows that match (a pyarrow.dataset expression).
+    # A run with no points (an empty shard) has no files to read, so it's no rows.
+    def read(self, columns=None, filter=None):
+        import pyarrow.dataset as pa_dataset
+        if len(part_files(self.folder)) == 0:
+            return pd.DataFrame(columns=columns)
+        dataset = pa_dataset.dataset(self.folder, format=self.dataset_format, partitioning='hive')
+        return dataset.to_table(columns=columns, filter=filter).to_pandas()
+
+    # One point's spreadsheet rows, sorted by day. Points at the same coordinates share a key, their rows come back one point after another.
+    def read_point(self, lat, lon, columns=None):
+        import pyarrow.dataset as pa_dataset
+        key = season_state.point_key(lat, lon)
+        point_df = self.read(columns, (pa_dataset.field('bucket') == point_bucket(key, self.buckets)) & (pa_dataset.field('point') == key))
+        return point_df.sort_values(['position', 'day'], kind='stable').reset_index(drop=True) if 'position' in point_df else point_df
+
+    # The same rows closure_dates.csv has always been built from, one for every point that has broken up, in input order
+    def closure_dates(self):
+        import pyarrow.dataset as pa_dataset
+        columns = ['position', 'id', 'day', 'average', 'route', 'location', 'lat', 'lon']
+        breakup_df = self.read(columns, (pa_dataset.field('breakup') == True) & pa_dataset.field('id').is_valid())
+        breakup_df = breakup_df.sort_values('position', kind='stable').reset_index(drop=True)
+        return breakup_df.rename(columns={'route': 'ROUTE', 'location': 'MILEPOINTER', 'lat': 'LAT', 'lon': 'LON'})[['id', 'day', 'average', 'ROUTE', 'MILEPOINTER', 'LAT', 'LON']]
+
+# The dataset for a batch run, None when the output is a .csv for every point
+def open_dataset(folder=None, positions=None):
+    if config.output_format == 'csv':
+        return None
+    return SpreadsheetDataset(folder, positions=positions)
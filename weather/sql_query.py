@@ -4,64 +4,137 @@ Using David's SQL query, pulls the high/low temperatures every day over a range
 If there are questions about how the query works, ask David. 
 Creates a .csv which is the starting point before filling in vaisala data and a 7-day forecast. 
 """
-import pyodbc
+import numpy as np
 import pandas as pd
 import pprint as pp
 import os
 import config
+import db
+import station_index
 
 __authors__ = ["Jordan Hiatt", "David Coladner"]
 
+# The days that can be used, in one pass over the columns. The rows keep their index. 
+def usable_days(df):
+    high = df['high'].to_numpy(dtype=float)
+    low = df['low'].to_numpy(dtype=float)
+    return df[df['day'].notna().to_numpy() & ~np.isnan(high) & ~np.isnan(low) & (high != low)]
+
+# Number of station placeholders in the pull_data statement for count stations: count padded up to a multiple of config.station_count, 
+# so every point asks with the same statement (one for 8 stations or fewer, the next for up to 16, ...) and the server reuses its plan. 
+def station_slots(count):
+    step = max(1, config.station_count)
+    return max(1, -(-count//step))*step
+
 # ITD9HTSPC219328
 def pull_data(start_date, end_date, lat, lon):
-    # Setting the timeout tells the user if they're connected to the database
-    conn = pyodbc.connect('Driver={SQL Server};'
-                        'Server=ITD9HTSPC219328;'
-                        'Database=wx_history;'
-                        'Trusted_Connection=yes;', timeout=1)
-    cursor = conn.cursor()
-    hi_lo_list = []
-    df = pd.DataFrame(columns=['day', 'high', 'low'])
-    cursor.execute("""
-    DECLARE @Latitude FLOAT SET @Latitude   =   {}
-    DECLARE @Longitude FLOAT SET @Longitude = {}
-    DECLARE @START_DATE DATE SET @START_DATE = '{}'
-    DECLARE @END_DATE DATE SET @END_DATE = '{}'
-    DECLARE @HOWMANYSITETOFIGURE INTEGER SET @HOWMANYSITETOFIGURE = 8
-    DECLARE @RADIUSTOSITES FLOAT SET @RADIUSTOSITES = 50 -- in miles
-    DECLARE @IDW_POWER FLOAT SET @IDW_POWER = 1.2
-    SELECT vds.dt_iso, sum(hi/POWER(distance_to_site,@IDW_POWER))/sum(POWER(1/distance_to_site,@IDW_POWER)) as hi_idw, 
-    sum(lo/POWER(distance_to_site,@IDW_POWER))/sum(POWER(1/distance_to_site,@IDW_POWER)) as lo_idw 
+    hi_lo_columns = [('day', object), ('high', float), ('low', float)]
+
+    # The distances come from the local station index instead of being computed against every row of rwis_view. 
+    # The query only reads the rows of those sites, and a CASE gives each site its distance. 
+    stations = station_index.get_station_index().stations_within(lat, lon)
+    if stations.empty:
+        return pd.DataFrame({name: np.array([], dtype=dtype) for name, dtype in hi_lo_columns})
+
+    # The unused slots are NULL, which never matches a site. The numbers are cast so every backend types them as a float 
+    # the same way no matter what the driver binds them as. 
+    slots = station_slots(len(stations))
+    names = [str(name) for name in stations['name']] + [None]*(slots-len(stations))
+    distances = [float(distance) for distance in stations['distance']] + [None]*(slots-len(stations))
+    params = [config.idw_power]*4
+    for name, distance in zip(names, distances):
+        params += [name, distance]
+    params += names + [start_date, end_date]
+
+    df = db.query_columns("""
+    SELECT vds.dt_iso, sum(hi/POWER(distance_to_site,CAST(? AS FLOAT)))/sum(POWER(1/distance_to_site,CAST(? AS FLOAT))) as hi_idw, 
+    sum(lo/POWER(distance_to_site,CAST(? AS FLOAT)))/sum(POWER(1/distance_to_site,CAST(? AS FLOAT))) as lo_idw 
     FROM (
         SELECT
-        site, dt_iso, max(Air_Temp) as hi, min(Air_Temp) as lo,
-        avg(Lat__Decimal) as lat, avg(Long__Decimal) as lon, avg(distance_to_site) as distance_to_site 
+        r.site, dt_iso, max(Air_Temp) as hi, min(Air_Temp) as lo, avg(r.distance_to_site) as distance_to_site 
             FROM (
-            SELECT -- (would be more efficient to compute distance in a further out query, but I got this to work!)
+            SELECT
                 concat(substring(dt,7,5),'-',substring(dt,4,2),'-',substring(dt,1,2)) as dt_iso
-                ,substring(Timestamp,12,5) as tod, [Timestamp],[Surf_Temp], [Surf_State], [Air_Temp], [Rain_State], rwis.[site], [dt]
-                ,its.Lat__Decimal, its.Long__Decimal
-                ,( 3959 * acos( cos( radians(@Latitude) ) * cos( radians( its.Lat__Decimal ) ) * cos( radians(its.Long__Decimal) - radians(@Longitude) ) + sin( radians(@Latitude) ) * sin( radians(its.Lat__Decimal)))) AS distance_to_site 
-            FROM [wx_history].[dbo].[rwis_view] as rwis
-            LEFT JOIN RWIS_Station_Locations as its
-                ON rwis.site=its.Station_Name ) as r
-            where r.dt_iso BETWEEN @START_DATE AND @END_DATE
+                ,[Air_Temp], rwis.[site]
+                ,CASE rwis.site {} END as distance_to_site
+            FROM rwis_view as rwis
+            WHERE rwis.site IN ({}) ) as r
+            where r.dt_iso BETWEEN ? AND ?
             and Air_Temp is not null 
-            and distance_to_site is not null and distance_to_site < @RADIUSTOSITES 
             group by dt_iso, r.site) as vds
             group by vds.dt_iso
             ORDER BY vds.dt_iso
-    """.format(lat, lon, start_date, end_date))
-
-    for row in cursor:
-        df = df.append({'day':row[0], 'high':row[1], 'low':row[2]},ignore_index=True)
+    """.format(' '.join(['WHEN ? THEN CAST(? AS FLOAT)']*slots), ', '.join(['?']*slots)), params, hi_lo_columns)
 
     # Drop na values and where the high is equal to the low, because that day can't be used
-    df = df.dropna()
-    df = df[df.high != df.low]
+    df = usable_days(df)
 
     # file_name = 'historical_data.csv'
     # if os.path.exists(file_name):
     #     os.remove(file_name)
     # df.to_csv(file_name, index=False)
-    return df
\ No newline at end of file
+    return df
+
+# Daily high/low for each station by itself, for every station in station_names over the date range. 
+# This is the inner part of the pull_data query without the IDW, so the same stations aren't aggregated over and over for every point. 
+def pull_station_days(start_date, end_date, station_names):
+    station_day_columns = [('site', object), ('day', object), ('hi', float), ('lo', float)]
+    if len(station_names) == 0:
+        return pd.DataFrame({name: np.array([], dtype=dtype) for name, dtype in station_day_columns})
+    return db.query_columns("""
+    SELECT r.site, r.dt_iso, max(Air_Temp) as hi, min(Air_Temp) as lo
+        FROM (
+        SELECT
+            concat(substring(dt,7,5),'-',substring(dt,4,2),'-',substring(dt,1,2)) as dt_iso
+            ,[Air_Temp], rwis.[site]
+        FROM rwis_view as rwis
+        WHERE rwis.site IN ({}) ) as r
+        where r.dt_iso BETWEEN ? AND ?
+        and Air_Temp is not null 
+        group by r.dt_iso, r.site
+    """.format(', '.join(['?']*len(station_names))), [str(name) for name in station_names] + [start_date, end_date], station_day_columns)
+
+# Bulk version of pull_data for a whole list of points. The daily high/low of every station near any of the points is pulled 
+# in one query, then the IDW is done here for every point at once. Gives back one DataFrame per point, the same as pull_data would. 
+def pull_data_bulk(start_date, end_date, lats, lons):
+    index = station_index.get_station_index()
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+
+    # Distance from every point to every station inside the radius, inf for the ones outside it
+    points = station_index.to_unit_vectors(lats, lons)
+    nearby = index.tree.query_ball_point(points, station_index.miles_to_chord(index.radius))
+    used = np.array(sorted(set(i for station_list in nearby for i in station_list)), dtype=int)
+    distances = np.full((len(lats), len(used)), np.inf)
+    for p, station_list in enumerate(nearby):
+        columns = np.searchsorted(used, station_list)
+        chords = np.linalg.norm(index.tree.data[station_list] - points[p], axis=1)
+        distances[p, columns] = station_index.chord_to_miles(chords)
+
+    station_days = pull_station_days(start_date, end_date, index.stations['name'].iloc[used].tolist())
+
+    # Station x day matrices of the highs and lows, NaN where a station has nothing for the day
+    names = index.stations['name'].iloc[used].tolist()
+    hi = station_days.pivot_table(index='site', columns='day', values='hi', aggfunc='max').reindex(names)
+    lo = station_days.pivot_table(index='site', columns='day', values='lo', aggfunc='min').reindex(names)
+    days = hi.columns.tolist()
+    has_data = hi.notna().to_numpy()
+
+    # Same as the SQL: sum(hi/distance^p)/sum((1/distance)^p) over the stations that have data that day
+    with np.errstate(divide='ignore'):
+        numerator_weights = np.where(np.isfinite(distances), 1.0/np.power(distances, config.idw_power), 0.0)
+        denominator_weights = np.where(np.isfinite(distances), np.power(1.0/distances, config.idw_power), 0.0)
+    denominator = denominator_weights @ has_data
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hi_idw = (numerator_weights @ np.nan_to_num(hi.to_numpy(dtype=float)))/denominator
+        lo_idw = (numerator_weights @ np.nan_to_num(lo.to_numpy(dtype=float)))/denominator
+
+    result = []
+    for p in range(len(lats)):
+        df = pd.DataFrame({'day': days, 'high': hi_idw[p], 'low': lo_idw[p]})
+        # A day with no station in range doesn't come back from the SQL at all
+        df = df[denominator[p] > 0]
+
+        # Drop na values and where the high is equal to the low, because that day can't be used
+        result.append(usable_days(df))
+    return result
@@ -0,0 +1,111 @@
+"""
+Local index of the RWIS station locations so finding the stations near a point doesn't need a distance scan in SQL Server.
+The station table is pulled once and cached to disk, then stations are put in a KD-tree as 3D unit vectors so straight line
+(chord) distance orders them the same as distance along the earth.
+"""
+import os
+import time
+import threading
+import numpy as np
+import pandas as pd
+import config
+import db
+import metrics
+
+__authors__ = "Jordan Hiatt"
+
+# Same earth radius the SQL queries use
+EARTH_RADIUS_MILES = 3959.0
+
+def to_unit_vectors(lats, lons):
+    lats = np.radians(np.asarray(lats, dtype=float))
+    lons = np.radians(np.asarray(lons, dtype=float))
+    return np.column_stack((np.cos(lats)*np.cos(lons), np.cos(lats)*np.sin(lons), np.sin(lats)))
+
+def miles_to_chord(miles):
+    return 2.0*np.sin(np.asarray(miles, dtype=float)/(2.0*EARTH_RADIUS_MILES))
+
+def chord_to_miles(chord):
+    return 2.0*EARTH_RADIUS_MILES*np.arcsin(np.minimum(np.asarray(chord, dtype=float)/2.0, 1.0))
+
+class StationIndex():
+    # stations_df needs the columns name, id, lat, lon, the same as RWIS_Station_Locations
+    def __init__(self, stations_df, station_count=None, radius=None, idw_power=None):
+        self.stations = stations_df.dropna(subset=['lat', 'lon']).reset_index(drop=True)
+        self.station_count = station_count if station_count is not None else config.station_count
+        self.radius = radius if radius is not None else config.station_radius
+        self.idw_power = idw_power if idw_power is not None else config.idw_power
+        # scipy is only imported once there are stations to index
+        from scipy.spatial import cKDTree
+        self.tree = cKDTree(to_unit_vectors(self.stations['lat'], self.stations['lon']))
+
+    # Pulls the station table from wx_history
+    @staticmethod
+    def pull_stations():
+        return db.query_columns("""
+        SELECT Station_Name, Station_ID, Lat__Decimal, Long__Decimal
+        FROM RWIS_Station_Locations
+        """, columns=[('name', object), ('id', None), ('lat', float), ('lon', float)])
+
+    # Uses the cached station table if it's recent enough, otherwise pulls it again and saves it
+    @classmethod
+    def load(cls, refresh=False):
+        cache_path = config.station_cache_path
+        if not refresh and os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < config.station_cache_max_age:
+            metrics.get_metrics().hit('stations.cache')
+            stations_df = pd.read_csv(cache_path)
+        else:
+            metrics.get_metrics().miss('stations.cache')
+            stations_df = cls.pull_stations()
+            stations_df.to_csv(cache_path, index=False)
+        return cls(stations_df)
+
+    # For every point, the indices into self.stations and the distances in miles of the nearest stations, closest first.
+    # k=None and radius=None fall back to the configured station count and radius. radius=False means no radius at all.
+    # Slots with no station (fewer than k inside the radius) have an index of -1 and a distance of inf.
+    def query(self, lats, lons, k=None, radius=None):
+        k = self.station_count if k is None else k
+        k = min(k, len(self.stations))
+        radius = self.radius if radius is None else radius
+        upper_bound = np.inf if radius is False else miles_to_chord(radius)
+
+        chords, indices = self.tree.query(to_unit_vectors(np.atleast_1d(lats), np.atleast_1d(lons)), k=k, distance_upper_bound=upper_bound)
+        chords = np.asarray(chords, dtype=float).reshape(-1, k)
+        indices = np.asarray(indices).reshape(-1, k)
+        missing = indices >= len(self.stations)
+        indices = np.where(missing, -1, indices)
+        distances = np.where(missing, np.inf, chord_to_miles(np.where(missing, 0.0, chords)))
+        return indices, distances
+
+    # Stations near a single point in the same shape VaisalaObject.get_station_ids has always returned
+    def nearest_stations(self, lat, lon, k=None, radius=None):
+        indices, distances = self.query(lat, lon, k, radius)
+        found = indices[0] >= 0
+        df = self.stations.iloc[indices[0][found]][['name', 'id', 'lat', 'lon']].reset_index(drop=True)
+        df['distance'] = distances[0][found]
+        return df
+
+    # Every station inside the radius of a single point, closest first. This is the set the historical SQL IDW uses. 
+    def stations_within(self, lat, lon, radius=None):
+        radius = self.radius if radius is None else radius
+        point = to_unit_vectors([lat], [lon])
+        indices = np.array(sorted(self.tree.query_ball_point(point[0], miles_to_chord(radius))), dtype=int)
+        df = self.stations.iloc[indices][['name', 'id', 'lat', 'lon']].reset_index(drop=True)
+        df['distance'] = chord_to_miles(np.linalg.norm(self.tree.data[indices] - point, axis=1))
+        return df.sort_values('distance', kind='stable').reset_index(drop=True)
+
+    # Inverse distance weights, missing stations get a weight of 0
+    def idw_weights(self, distances):
+        with np.errstate(divide='ignore'):
+            return np.where(np.isfinite(distances), 1.0/np.power(distances, self.idw_power), 0.0)
+
+# The index is shared by every point in a run
+station_index = None
+station_index_lock = threading.Lock()
+
+def get_station_index():
+    global station_index
+    with station_index_lock:
+        if station_index is None:
+            station_index = StationIndex.load()
+        return station_index
@@ -0,0 +1,121 @@
+"""
+Draws a small DataFrame as a .png table with Pillow, the same look as df.style.background_gradient() (PuBu shading of each number
+column from its own min to max) without starting a browser for every image the way dataframe_image does.
+A TableRenderer keeps its font and colors, so one is made per process and reused for every table. render_table is a top level function
+so the PNG stage of batch_output.run_pipeline can send it to its process pool.
+"""
+import threading
+import numpy as np
+import pandas as pd
+from PIL import Image, ImageDraw, ImageFont
+
+__authors__ = "Jordan Hiatt"
+
+# The ColorBrewer PuBu stops matplotlib's PuBu colormap is made from, light to dark
+PUBU = ['#fff7fb', '#ece7f2', '#d0d1e6', '#a6bddb', '#74a9cf', '#3690c0', '#0570b0', '#045a8d', '#023858']
+
+# The same table of colors matplotlib makes for a colormap from stops: size colors spread evenly over 0 to 1, each channel
+# interpolated between the stops. Gives back a (size, 3) array of 0 to 1 RGB.
+def make_colormap(stops, size=256):
+    rgb = np.array([[int(stop[i:i+2], 16)/255.0 for i in (1, 3, 5)] for stop in stops])
+    positions = np.linspace(0.0, 1.0, len(stops))
+    samples = np.linspace(0.0, 1.0, size)
+    return np.stack([np.interp(samples, positions, rgb[:, channel]) for channel in range(3)], axis=1)
+
+class TableRenderer():
+    def __init__(self, font_size=13, padding=6, colors=PUBU):
+        self.padding = padding
+        try:
+            self.font = ImageFont.load_default(size=font_size)
+        except TypeError:
+            # Older Pillow only has the fixed size bitmap font
+            self.font = ImageFont.load_default()
+        self.colormap = make_colormap(colors)
+        # Only used to measure text
+        self.measure = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+        self.line_height = self.text_size('Ag')[1]
+
+    def text_size(self, text):
+        left, top, right, bottom = self.measure.multiline_textbbox((0, 0), text, font=self.font)
+        return right, bottom
+
+    # Same text a Styler shows, except missing values are left blank
+    @staticmethod
+    def cell_text(value):
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            return ''
+        if isinstance(value, (float, np.floating)):
+            return '{:.6f}'.format(value)
+        return str(value)
+
+    # Background of every cell of one column. Number columns are shaded by where each value is between the column's min and max,
+    # same as background_gradient. Everything else is white. A value picks its color out of the table the way matplotlib does,
+    # the one at value*size with 1 going to the last.
+    def column_colors(self, values):
+        white = (255, 255, 255)
+        if not pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+            return [white]*len(values)
+        values = values.to_numpy(dtype=float)
+        finite = np.isfinite(values)
+        if not finite.any():
+            return [white]*len(values)
+        low, high = values[finite].min(), values[finite].max()
+        scaled = np.zeros(len(values)) if high == low else (values-low)/(high-low)
+        size = len(self.colormap)
+        colors = []
+        for value, ok in zip(scaled, finite):
+            if ok:
+                r, g, b = self.colormap[min(max(int(value*size), 0), size-1)]
+                colors.append((int(round(r*255)), int(round(g*255)), int(round(b*255))))
+            else:
+                colors.append(white)
+        return colors
+
+    # Dark backgrounds get light text, using the same cutoff pandas does
+    @staticmethod
+    def text_color(background):
+        def linear(c):
+            c = c/255.0
+            return c/12.92 if c <= 0.04045 else ((c+0.055)/1.055)**2.4
+        luminance = 0.2126*linear(background[0]) + 0.7152*linear(background[1]) + 0.0722*linear(background[2])
+        return (241, 241, 241) if luminance < 0.408 else (0, 0, 0)
+
+    # Returns the table as a PIL image, the index is the first column and the column names are the header
+    def draw(self, df):
+        header = [''] + [str(column) for column in df.columns]
+        cells = [[self.cell_text(index)] + [self.cell_text(value) for value in row] for index, row in zip(df.index, df.itertuples(index=False))]
+        white = (255, 255, 255)
+        colors = [[white]*len(df)] + [self.column_colors(df[column]) for column in df.columns]
+
+        widths = [max([self.text_size(text)[0] for text in [header[c]]+[row[c] for row in cells]]) + 2*self.padding for c in range(len(header))]
+        heights = [max([self.text_size(text)[1] for text in row] + [self.line_height]) + 2*self.padding for row in [header]+cells]
+        image = Image.new('RGB', (sum(widths)+1, sum(heights)+1), white)
+        draw = ImageDraw.Draw(image)
+
+        y = 0
+        for r, row in enumerate([header]+cells):
+            x = 0
+            for c, text in enumerate(row):
+                background = white if r == 0 else colors[c][r-1]
+                draw.rectangle([x, y, x+widths[c], y+heights[r]], fill=background, outline=(221, 221, 221))
+                draw.multiline_text((x+self.padding, y+self.padding), text, font=self.font, fill=self.text_color(background))
+                x += widths[c]
+            y += heights[r]
+        return image
+
+    def render(self, df, path):
+        self.draw(df).save(path, format='PNG')
+
+# One renderer for each process
+renderer = None
+renderer_lock = threading.Lock()
+
+def get_table_renderer():
+    global renderer
+    with renderer_lock:
+        if renderer is None:
+            renderer = TableRenderer()
+        return renderer
+
+def render_table(df, path):
+    get_table_renderer().render(df, path)
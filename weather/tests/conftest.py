@@ -0,0 +1,71 @@
+"""
+The weather modules are imported by name the same way they import each other, and benchmarks/fixtures.py makes the synthetic inputs.
+Run from the weather folder: python -m pytest tests
+"""
+import os
+import sys
+from datetime import date
+import pytest
+
+__authors__ = "Jordan Hiatt"
+
+weather_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, weather_folder)
+sys.path.insert(0, os.path.join(weather_folder, 'benchmarks'))
+
+DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# The season the stand-ins have history for, up to a few days before the pinned today
+SEASON = '2025-10-01'
+HISTORY_END = '2026-03-10'
+
+# Today is pinned to Mar 15 2026 so the season has gone through the winter
+class PinnedDate(date):
+    @classmethod
+    def today(cls):
+        return cls(2026, 3, 15)
+
+# Local stand-ins for every upstream of a run: a SQLite wx_history up to HISTORY_END (config.db_backend = 'sqlite') and the Vaisala export
+# for the days since (fixtures.VaisalaStandIn), with today pinned. Paths are put together Windows style, so everything is kept inside
+# a folder of its own, which is the working folder and what the fixture gives. Module singletons start over for every test.
+@pytest.fixture
+def upstreams(tmp_path, monkeypatch):
+    import fixtures
+    import config
+    import db
+    import batch_output
+    import emulate_spreadsheet
+    import metrics
+    import season_state
+    import station_index
+    import vaisala_cache
+    import vaisala_request
+
+    folder = tmp_path / 'run'
+    folder.mkdir()
+    monkeypatch.chdir(folder)
+    fixtures.write_reference_temps(str(folder))
+    for module in (batch_output, emulate_spreadsheet, vaisala_request, vaisala_cache):
+        monkeypatch.setattr(module, 'date', PinnedDate)
+    fixtures.write_history_db(str(tmp_path / 'wx_history.sqlite'), fixtures.make_stations(40), SEASON, HISTORY_END)
+
+    stand_in = fixtures.start_server(fixtures.VaisalaStandIn)
+    monkeypatch.setattr(config, 'db_backend', 'sqlite')
+    monkeypatch.setattr(config, 'db_sqlite_path', str(tmp_path / 'wx_history.sqlite'))
+    monkeypatch.setattr(config, 'station_cache_path', str(tmp_path / 'station_locations.csv'))
+    monkeypatch.setattr(config, 'vaisala_cache_path', str(tmp_path / 'vaisala_cache.sqlite'))
+    monkeypatch.setattr(config, 'season_state_path', str(tmp_path / 'season_state.sqlite'))
+    monkeypatch.setattr(config, 'shard_folder', str(folder / 'Shards'))
+    monkeypatch.setattr(config, 'metrics_path', str(folder / 'run_metrics.json'))
+    monkeypatch.setattr(config, 'output_dataset_folder', str(folder / 'SpreadsheetDataset'))
+    monkeypatch.setattr(config, 'vaisala_export_url', 'http://127.0.0.1:{}/vaisala?username=stand-in'.format(stand_in.server_address[1]))
+    monkeypatch.setattr(emulate_spreadsheet, 'reference_temps', None)
+    monkeypatch.setattr(station_index, 'station_index', None)
+    monkeypatch.setattr(vaisala_cache, 'observation_cache', None)
+    monkeypatch.setattr(season_state, 'season_state_store', None)
+    db.reset_pool()
+    metrics.start_run()
+    yield folder
+    stand_in.shutdown()
+    stand_in.server_close()
+    db.reset_pool()
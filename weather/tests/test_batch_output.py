@@ -0,0 +1,156 @@
+"""
+A whole RouteNo batch run against local stand-ins for every upstream: a SQLite wx_history up to a few days ago (config.db_backend = 'sqlite'),
+a local HTTP server answering the Vaisala export for the days since, and a fixed week of forecast in place of the NDFD grids (no GDAL needed).
+Today is pinned to Mar 15 2026 so the season has gone through the winter. Several points share an id and two sit at the same coordinates,
+so closure_dates.csv has to pick the earliest day of each id.
+"""
+import os
+import sqlite3
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+import pytest
+from conftest import SEASON, PinnedDate
+import config
+import fixtures
+import batch_output
+import emulate_spreadsheet
+import raster_operations
+import season_state
+import shard
+import spreadsheet_dataset
+
+__authors__ = "Jordan Hiatt"
+
+# A warm week of forecast from tomorrow for every point so they break up, thawing later to the north
+def forecast_stand_in(lats, lons, files_downloaded=True, interpolation='nearest', worker=None):
+    days = [(PinnedDate.today()+timedelta(days=i+1)).strftime('%Y-%m-%d') for i in range(7)]
+    lows = np.linspace(30, 45, 7)[None, :] - 2*(np.asarray(lats, dtype=float)[:, None]-45)
+    return days, lows, lows+15, lows+7.5
+
+# Twelve points on four ids, the last one at the same coordinates as the first
+def route_points():
+    lats, lons = fixtures.make_points(11)
+    lats, lons = np.append(lats, lats[0]), np.append(lons, lons[0])
+    return pd.DataFrame({'id': [0, 0, 0, 1, 1, 2, 2, 2, 3, 3, 3, 2], 'ROUTE': [1, 1, 1, 2, 2, 3, 3, 3, 4, 4, 4, 3],
+                         'MILEPOINTER': np.round(np.arange(12)*1.5, 2), 'LON': lons, 'LAT': lats})
+
+@pytest.fixture
+def stand_ins(upstreams, monkeypatch):
+    monkeypatch.setattr(raster_operations.Raster, 'get_avg_at_coordinates', staticmethod(forecast_stand_in))
+    # Every run starts from Oct 1 so runs can be compared with each other
+    monkeypatch.setattr(config, 'resume_seasons', False)
+    return upstreams
+
+def read_closure_dates(folder):
+    with open(os.path.join(str(folder), 'closure_dates.csv'), 'rb') as f:
+        return f.read()
+
+# The earliest day of each id out of the spreadsheets a point at a time
+def expected_closure_dates(mp_coord_df):
+    rows = []
+    for position, row in mp_coord_df.iterrows():
+        point = batch_output.read_point(row, 'RouteNo')
+        days, lows, highs, averages = forecast_stand_in([point['lat']], [point['lon']])
+        forecast_df = raster_operations.Raster.forecast_frame(days, lows[0], highs[0])
+        df = batch_output.fetch_point(point, SEASON, PinnedDate.today().strftime('%Y-%m-%d'), forecast_df=forecast_df)
+        spreadsheet = emulate_spreadsheet.build_emulated_spreadsheet(point['lat'], point['lon'], point['point_string'], df)
+        breakup_rows = spreadsheet[spreadsheet['message'] == batch_output.BREAKUP_MESSAGE]
+        if len(breakup_rows) > 0:
+            rows.append((point['id'], breakup_rows['day'].iloc[0]))
+    earliest = {}
+    for image_id, day in rows:
+        earliest[image_id] = min(day, earliest.get(image_id, day))
+    return earliest
+
+def test_serial_closure_dates(stand_ins):
+    mp_coord_df = route_points()
+    batch_output.batch_run(mp_coord_df, 'RouteNo')
+    closure_date_df = pd.read_csv(os.path.join(str(stand_ins), 'closure_dates.csv'))
+    assert len(closure_date_df) > 0
+    assert closure_date_df['id'].is_unique
+    assert dict(zip(closure_date_df['id'], closure_date_df['day'])) == expected_closure_dates(mp_coord_df)
+
+# Shards run one after another in the same folder and merged give the same closure_dates.csv as one run
+def test_merged_shards_match_serial(stand_ins):
+    mp_coord_df = route_points()
+    batch_output.batch_run(mp_coord_df, 'RouteNo')
+    serial = read_closure_dates(stand_ins)
+    os.remove(os.path.join(str(stand_ins), 'closure_dates.csv'))
+    for index in (1, 2, 3):
+        batch_output.run_shard(mp_coord_df, 'RouteNo', index, 3)
+    shard.merge_shards(3)
+    assert read_closure_dates(stand_ins) == serial
+
+def saved_states(path):
+    conn = sqlite3.connect(path)
+    rows = [conn.execute('SELECT * FROM {} ORDER BY 1, 2, 3'.format(table)).fetchall() for table in ('season_state', 'season_rows')]
+    conn.close()
+    return rows
+
+# The pipeline (spreadsheets on a process pool) gives the same closure_dates.csv as running a point at a time, and saves the same states.
+# The states are only the same if the spreadsheet workers settle the same days, by the run's today and settings rather than their own.
+def test_pipeline_matches_serial(stand_ins, monkeypatch):
+    monkeypatch.setattr(config, 'season_settle_days', 4)
+    mp_coord_df = route_points()
+    batch_output.batch_run(mp_coord_df, 'RouteNo')
+    serial = read_closure_dates(stand_ins)
+    serial_states = saved_states(config.season_state_path)
+    assert len(serial_states[0]) > 0
+    os.remove(os.path.join(str(stand_ins), 'closure_dates.csv'))
+
+    monkeypatch.setattr(config, 'season_state_path', str(stand_ins / 'pipeline_state.sqlite'))
+    monkeypatch.setattr(season_state, 'season_state_store', None)
+    # Small batches so the spreadsheet workers each get some
+    monkeypatch.setattr(config, 'spreadsheet_batch_size', 3)
+    monkeypatch.setattr(config, 'pipeline_spreadsheet_workers', 2)
+    batch_output.batch_run(mp_coord_df, 'RouteNo', workers=3)
+    assert read_closure_dates(stand_ins) == serial
+    assert saved_states(config.season_state_path) == serial_states
+
+# A dataset instead of a .csv for every point gives the same closure_dates.csv, a point at a time and on the pipeline
+@pytest.mark.parametrize('workers', [1, 3])
+@pytest.mark.parametrize('output_format', ['parquet', 'arrow'])
+def test_dataset_closure_dates(stand_ins, monkeypatch, output_format, workers):
+    mp_coord_df = route_points()
+    batch_output.batch_run(mp_coord_df, 'RouteNo')
+    serial = read_closure_dates(stand_ins)
+    os.remove(os.path.join(str(stand_ins), 'closure_dates.csv'))
+
+    monkeypatch.setattr(config, 'output_format', output_format)
+    batch_output.batch_run(mp_coord_df, 'RouteNo', workers=workers)
+    assert read_closure_dates(stand_ins) == serial
+
+# One point read back out of the dataset is the same as the .csv it would have had
+def test_dataset_read_point(stand_ins, monkeypatch):
+    mp_coord_df = route_points()
+    batch_output.batch_run(mp_coord_df, 'RouteNo')
+    point = batch_output.read_point(mp_coord_df.iloc[5], 'RouteNo')
+    with open(batch_output.create_file_path(point['lat'], point['lon'], batch_output.create_folder_path('Spreadsheets'))) as f:
+        spreadsheet = f.read()
+
+    monkeypatch.setattr(config, 'output_format', 'parquet')
+    batch_output.batch_run(mp_coord_df, 'RouteNo')
+    dataset = spreadsheet_dataset.SpreadsheetDataset(clear=False)
+    point_df = dataset.read_point(point['lat'], point['lon'])
+    assert point_df['position'].unique().tolist() == [5]
+    assert point_df[['day', 'average', 'roadway_status', 'message']].to_csv(index=False) == spreadsheet
+
+# Shards with dataset output merged into one dataset have the same rows as a single run, and the same closure_dates.csv
+def test_merged_dataset_shards_match_serial(stand_ins, monkeypatch):
+    mp_coord_df = route_points()
+    monkeypatch.setattr(config, 'output_format', 'parquet')
+    batch_output.batch_run(mp_coord_df, 'RouteNo')
+    serial = read_closure_dates(stand_ins)
+    serial_df = spreadsheet_dataset.SpreadsheetDataset(clear=False).read()
+    os.remove(os.path.join(str(stand_ins), 'closure_dates.csv'))
+
+    for index in (1, 2, 3):
+        batch_output.run_shard(mp_coord_df, 'RouteNo', index, 3)
+    shard.merge_shards(3)
+    assert read_closure_dates(stand_ins) == serial
+    assert len(spreadsheet_dataset.part_files(config.output_dataset_folder)) > 0
+    merged_df = spreadsheet_dataset.SpreadsheetDataset(clear=False).read()
+    def in_order(df):
+        return df.sort_values(['position', 'day'], kind='stable').reset_index(drop=True)
+    pd.testing.assert_frame_equal(in_order(merged_df), in_order(serial_df))
@@ -0,0 +1,79 @@
+"""
+Golden file test of the spreadsheet. data/season.csv is a synthetic season from Oct 1 to Jul 5 with a few missing days (NaN high and low,
+and one day with only the low missing) that reaches every milestone. data/expected_spreadsheet.csv and data/expected_partial_spreadsheet.csv
+(the season up to Apr 10) were made with the original row by row build_emulated_spreadsheet, against data/reference_temp.csv and with
+today pinned to Mar 15 2026, which decides the CTI and CFI reset days and the creation date at the top of the message column.
+Every case runs with the plain Python kernel and with the Numba one when Numba is installed.
+"""
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from conftest import DATA_FOLDER, PinnedDate
+import emulate_spreadsheet
+
+__authors__ = "Jordan Hiatt"
+
+LAT = 45.123456
+LON = -114.654321
+LOCATION = 'US-95 MP 12'
+
+@pytest.fixture(params=['python', 'numba'])
+def kernel(request, monkeypatch):
+    if request.param == 'numba':
+        numba = pytest.importorskip('numba')
+        compiled = numba.njit(emulate_spreadsheet.freeze_thaw_kernel)
+    else:
+        compiled = emulate_spreadsheet.freeze_thaw_kernel
+    monkeypatch.setattr(emulate_spreadsheet, 'compiled_kernel', compiled)
+    monkeypatch.setattr(emulate_spreadsheet, 'date', PinnedDate)
+    monkeypatch.setattr(emulate_spreadsheet, 'reference_temps',
+                        pd.read_csv(os.path.join(DATA_FOLDER, 'reference_temp.csv'), header=None)[0].to_numpy(dtype=float))
+    return request.param
+
+def read_season(rows=None):
+    season_df = pd.read_csv(os.path.join(DATA_FOLDER, 'season.csv'))
+    return season_df if rows is None else season_df.iloc[:rows].reset_index(drop=True)
+
+# Both sides go through the same .csv the batch run writes, then are compared as text row by row
+def csv_rows(df):
+    return [list(row) for row in pd.read_csv(pd.io.common.StringIO(df.to_csv(index=False)), dtype=str, keep_default_na=False).itertuples(index=False)]
+
+def assert_same_rows(df, expected_file):
+    expected = [list(row) for row in pd.read_csv(os.path.join(DATA_FOLDER, expected_file), dtype=str, keep_default_na=False).itertuples(index=False)]
+    rows = csv_rows(df)
+    assert len(rows) == len(expected)
+    for number, (row, expected_row) in enumerate(zip(rows, expected)):
+        assert row == expected_row, 'row {} ({})'.format(number, expected_row[0])
+
+def test_full_season(kernel):
+    assert_same_rows(emulate_spreadsheet.build_emulated_spreadsheet(LAT, LON, LOCATION, read_season()), 'expected_spreadsheet.csv')
+
+def test_partial_season(kernel):
+    assert_same_rows(emulate_spreadsheet.build_emulated_spreadsheet(LAT, LON, LOCATION, read_season(192)), 'expected_partial_spreadsheet.csv')
+
+# Carrying on from the saved state at the end of split rows gives the same spreadsheet as running the whole season:
+# before the CTI reset, between it and breakup, in the 8 weeks after breakup, and after the overweight permits.
+@pytest.mark.parametrize('split', [60, 120, 180, 260])
+def test_resume_split(kernel, split):
+    season_df = read_season()
+    days = season_df['day'].to_numpy(dtype=object)
+    highs = season_df['high'].to_numpy(dtype=float)
+    lows = season_df['low'].to_numpy(dtype=float)
+    earlier = emulate_spreadsheet.build_emulated_batch(days[:split], highs[:split], lows[:split])
+    state = emulate_spreadsheet.season_state(earlier, 0, split-1)
+    earlier_df = emulate_spreadsheet.batch_rows(earlier, 0)
+    later = emulate_spreadsheet.build_emulated_batch(days[split:], highs[split:], lows[split:], [state])
+    assert later['row_offset'] == split
+    assert_same_rows(emulate_spreadsheet.spreadsheet_frame(later, 0, LAT, LON, LOCATION, earlier_df), 'expected_spreadsheet.csv')
+
+# Points run together in one batch come out the same as each one on its own
+def test_batch_of_points(kernel):
+    season_df = read_season()
+    highs = np.array([season_df['high'].to_numpy(dtype=float), season_df['high'].to_numpy(dtype=float)-3.0])
+    lows = np.array([season_df['low'].to_numpy(dtype=float), season_df['low'].to_numpy(dtype=float)-3.0])
+    batch = emulate_spreadsheet.build_emulated_batch(season_df['day'].to_numpy(dtype=object), highs, lows)
+    assert_same_rows(emulate_spreadsheet.spreadsheet_frame(batch, 0, LAT, LON, LOCATION), 'expected_spreadsheet.csv')
+    colder_df = pd.DataFrame({'day': season_df['day'], 'high': highs[1], 'low': lows[1]})
+    alone = emulate_spreadsheet.build_emulated_spreadsheet(LAT, LON, LOCATION, colder_df)
+    assert csv_rows(emulate_spreadsheet.spreadsheet_frame(batch, 1, LAT, LON, LOCATION)) == csv_rows(alone)
@@ -0,0 +1,160 @@
+"""
+ForecastDownloader against a local HTTP stand-in for NOAA that serves a fake NDFD file and can be told to fail in the ways NOAA does:
+an error status, a body cut off partway through, or a 304 when the product hasn't changed.
+GDAL isn't needed, the fake file carries its valid times in a header and ends with a marker so a cut off copy is caught the same way
+GDAL catches a truncated GRIB file.
+"""
+import os
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+import config
+import forecast_download
+
+__authors__ = "Jordan Hiatt"
+
+VALID_TIMES = [1773900000, 1773986400, 1774072800]
+PRODUCT = 'VP.001-003/ds.mint.bin'
+
+def fake_ndfd(valid_times, size=200000):
+    return 'NDFD {}\n'.format(' '.join(str(t) for t in valid_times)).encode('utf-8') + b'\0'*size + b'END'
+
+def read_fake_valid_times(file_path):
+    with open(file_path, 'rb') as f:
+        body = f.read()
+    if not body.startswith(b'NDFD ') or not body.endswith(b'END'):
+        raise Exception('{} is not a readable GRIB file'.format(file_path))
+    return [int(t) for t in body.split(b'\n')[0].split()[1:]]
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Set for each test by the stand_in fixture
+    state = None
+
+    def do_GET(self):
+        state = self.state
+        state['requests'].append({'path': self.path, 'headers': dict(self.headers)})
+        behaviour = state['script'].pop(0) if state['script'] else 'ok'
+        body = state['body']
+        if behaviour == 'error':
+            self.send_error(503)
+            return
+        if behaviour == 'ok' and self.headers.get('If-None-Match') == state['etag']:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', state['etag'])
+        self.send_header('Last-Modified', 'Thu, 19 Mar 2026 12:00:00 GMT')
+        self.end_headers()
+        # Cut off a little past half way and hang up
+        self.wfile.write(body if behaviour == 'ok' else body[:len(body)//2])
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def stand_in(tmp_path, monkeypatch):
+    state = {'requests': [], 'script': [], 'body': fake_ndfd(VALID_TIMES), 'etag': '"v1"'}
+    handler = type('Handler', (StandInHandler,), {'state': state})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(forecast_download.ForecastDownloader, 'read_valid_times', staticmethod(read_fake_valid_times))
+    monkeypatch.setattr(config, 'forecast_max_age', 3600)
+    state['url'] = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    state['entry'] = (str(tmp_path / 'days1to3min.bin'), 'min', PRODUCT)
+    yield state
+    server.shutdown()
+    server.server_close()
+
+def downloader(stand_in, max_tries=4):
+    # No waiting between tries
+    return forecast_download.ForecastDownloader(stand_in['url'], max_tries=max_tries, backoff_base=0.0)
+
+def test_download_writes_file_and_validators(stand_in):
+    file_path = stand_in['entry'][0]
+    assert downloader(stand_in).download(stand_in['entry'])
+    with open(file_path, 'rb') as f:
+        assert f.read() == stand_in['body']
+    metadata = forecast_download.ForecastDownloader.read_metadata(file_path)
+    assert metadata['etag'] == '"v1"'
+    assert metadata['valid_times'] == VALID_TIMES
+    assert stand_in['requests'][0]['path'] == '/'+PRODUCT
+    assert not os.path.exists(file_path+'.part')
+
+def test_fresh_file_is_not_asked_for(stand_in):
+    assert downloader(stand_in).download(stand_in['entry'])
+    assert not downloader(stand_in).download(stand_in['entry'])
+    assert len(stand_in['requests']) == 1
+
+def test_unchanged_product_gets_304(stand_in, monkeypatch):
+    file_path = stand_in['entry'][0]
+    assert downloader(stand_in).download(stand_in['entry'])
+    fetched_at = forecast_download.ForecastDownloader.read_metadata(file_path)['fetched_at']
+    # Old enough to ask again, the stand-in answers 304 to the ETag
+    monkeypatch.setattr(config, 'forecast_max_age', 0)
+    assert not downloader(stand_in).download(stand_in['entry'])
+    assert stand_in['requests'][1]['headers'].get('If-None-Match') == '"v1"'
+    assert stand_in['requests'][1]['headers'].get('If-Modified-Since') == 'Thu, 19 Mar 2026 12:00:00 GMT'
+    metadata = forecast_download.ForecastDownloader.read_metadata(file_path)
+    assert metadata['fetched_at'] >= fetched_at
+    assert metadata['valid_times'] == VALID_TIMES
+
+def test_changed_product_is_downloaded_again(stand_in, monkeypatch):
+    assert downloader(stand_in).download(stand_in['entry'])
+    monkeypatch.setattr(config, 'forecast_max_age', 0)
+    stand_in['etag'] = '"v2"'
+    stand_in['body'] = fake_ndfd([t+86400 for t in VALID_TIMES])
+    assert downloader(stand_in).download(stand_in['entry'])
+    metadata = forecast_download.ForecastDownloader.read_metadata(stand_in['entry'][0])
+    assert metadata['etag'] == '"v2"'
+    assert metadata['valid_times'] == [t+86400 for t in VALID_TIMES]
+
+def test_retries_after_errors(stand_in):
+    stand_in['script'] = ['error', 'error']
+    assert downloader(stand_in).download(stand_in['entry'])
+    assert len(stand_in['requests']) == 3
+    with open(stand_in['entry'][0], 'rb') as f:
+        assert f.read() == stand_in['body']
+
+def test_truncated_body_is_retried(stand_in):
+    file_path = stand_in['entry'][0]
+    stand_in['script'] = ['truncated']
+    assert downloader(stand_in).download(stand_in['entry'])
+    assert len(stand_in['requests']) == 2
+    with open(file_path, 'rb') as f:
+        assert f.read() == stand_in['body']
+    assert not os.path.exists(file_path+'.part')
+
+# After the last try the older cached file is kept as it was and nothing half written is left
+def test_giving_up_keeps_cached_file(stand_in, monkeypatch):
+    file_path = stand_in['entry'][0]
+    assert downloader(stand_in).download(stand_in['entry'])
+    monkeypatch.setattr(config, 'forecast_max_age', 0)
+    stand_in['etag'] = '"v2"'
+    old_body = stand_in['body']
+    stand_in['body'] = fake_ndfd([t+86400 for t in VALID_TIMES])
+    stand_in['script'] = ['truncated', 'error', 'truncated']
+    assert not downloader(stand_in, max_tries=3).download(stand_in['entry'])
+    assert len(stand_in['requests']) == 4
+    with open(file_path, 'rb') as f:
+        assert f.read() == old_body
+    assert forecast_download.ForecastDownloader.read_metadata(file_path)['etag'] == '"v1"'
+    assert not os.path.exists(file_path+'.part')
+
+# With no cached file to fall back on giving up is an error, not a file that isn't there
+def test_giving_up_without_cached_file_raises(stand_in):
+    file_path = stand_in['entry'][0]
+    stand_in['script'] = ['error', 'truncated', 'error']
+    with pytest.raises(Exception, match='no cached copy'):
+        downloader(stand_in, max_tries=3).download(stand_in['entry'])
+    assert len(stand_in['requests']) == 3
+    assert not os.path.exists(file_path)
+    assert not os.path.exists(file_path+'.part')
+
+def test_download_all_fetches_every_product(stand_in, tmp_path):
+    entries = [(str(tmp_path / 'cache' / name), kind, product) for name, kind, product in (
+        ('days1to3min.bin', 'min', 'VP.001-003/ds.mint.bin'), ('days4to7min.bin', 'min', 'VP.004-007/ds.mint.bin'),
+        ('days1to3max.bin', 'max', 'VP.001-003/ds.maxt.bin'), ('days4to7max.bin', 'max', 'VP.004-007/ds.maxt.bin'))]
+    assert downloader(stand_in).download_all(entries) == [True]*4
+    assert sorted(request['path'] for request in stand_in['requests']) == sorted('/'+entry[2] for entry in entries)
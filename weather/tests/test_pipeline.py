@@ -0,0 +1,38 @@
+"""
+Pipeline with a process stage while the stage before it has threads busy. The fetch threads hold a lock most of the time, so a worker
+forked from this process would likely get a copy of it that's held and never let go, and the run would hang. Spawned workers start
+with their own, and get config's settings as they are at the start of the run.
+"""
+import threading
+import time
+import config
+import metrics
+import pipeline
+
+__authors__ = "Jordan Hiatt"
+
+busy = threading.Lock()
+
+def fetch(item):
+    with busy:
+        time.sleep(0.02)
+    return item
+
+# Run in the process pool
+def square(items):
+    with busy:
+        return [(item*item, config.season_settle_days) for item in items]
+
+def test_process_stage_with_busy_threads(monkeypatch):
+    monkeypatch.setattr(config, 'season_settle_days', 5)
+    metrics.start_run()
+    stages = [
+        pipeline.Stage('fetch', fetch, 4),
+        pipeline.Stage('square', square, 2, processes=True, batch_size=3),
+    ]
+    results = []
+    run = threading.Thread(target=lambda: results.extend(pipeline.Pipeline(stages).run(range(24))), daemon=True)
+    run.start()
+    run.join(timeout=120)
+    assert not run.is_alive()
+    assert sorted(results) == [(item*item, 5) for item in range(24)]
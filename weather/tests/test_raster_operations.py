@@ -0,0 +1,41 @@
+"""
+ForecastGrid.sample_points on a small grid made in memory instead of warped out of the NDFD files, so GDAL isn't needed.
+The grid is 3 rows by 4 columns of 1 degree cells from 50N 120W, with a low and a high band that give back the row and column they came from.
+"""
+import numpy as np
+import pytest
+import raster_operations
+
+__authors__ = "Jordan Hiatt"
+
+def small_grid():
+    rows, cols = np.meshgrid(np.arange(3), np.arange(4), indexing='ij')
+    lows = (10*rows + cols).astype(np.float32)
+    grid = raster_operations.ForecastGrid.__new__(raster_operations.ForecastGrid)
+    grid.grids = [{'geo_transform': (-120.0, 1.0, 0.0, 50.0, 0.0, -1.0), 'bands': np.stack([lows, lows+5]), 'is_max': np.array([False, True])}]
+    return grid
+
+def fahrenheit(celsius):
+    return celsius*9/5 + 32
+
+def test_nearest_takes_the_cell_the_point_is_in():
+    lows, highs = small_grid().sample_points([49.5, 48.2, 47.01], [-119.5, -117.3, -116.01])
+    assert lows[:, 0] == pytest.approx([fahrenheit(0), fahrenheit(12), fahrenheit(23)])
+    assert highs[:, 0] == pytest.approx([fahrenheit(5), fahrenheit(17), fahrenheit(28)])
+    # Still the grid's float32, the same values as before
+    assert lows.dtype == np.float32
+
+# North, south, west and east of the grid, not wrapped around or mirrored back onto it
+def test_nearest_is_nan_off_the_grid():
+    lows, highs = small_grid().sample_points([50.5, 46.5, 48.5, 48.5, 48.5], [-118.5, -118.5, -120.5, -115.5, -118.5])
+    assert np.isnan(lows[:4]).all() and np.isnan(highs[:4]).all()
+    assert lows[4, 0] == pytest.approx(fahrenheit(11))
+
+# Bilinear blends the cell centers and is clamped to the edge off the grid
+def test_bilinear_is_clamped_to_the_edge():
+    lows, highs = small_grid().sample_points([49.0, 50.5, 46.5], [-119.0, -119.5, -116.5], interpolation='bilinear')
+    assert lows[:, 0] == pytest.approx([fahrenheit(5.5), fahrenheit(0), fahrenheit(23)])
+
+def test_unknown_interpolation():
+    with pytest.raises(ValueError):
+        small_grid().sample_points([49.5], [-119.5], interpolation='cubic')
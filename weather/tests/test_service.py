@@ -0,0 +1,174 @@
+"""
+service.py over HTTP against local stand-ins for every upstream: a SQLite wx_history up to a few days ago (config.db_backend = 'sqlite'),
+a local HTTP server answering the Vaisala export for the days since, and a fixed week of forecast in place of the NDFD grids (no GDAL needed).
+Today is pinned to Mar 15 2026 so the season has gone through the winter. The answers are checked against the spreadsheet built directly
+from the same days, and a query must never write season states, only the batch run does.
+"""
+import sqlite3
+import threading
+from datetime import timedelta
+import numpy as np
+import pytest
+import requests
+from conftest import SEASON, PinnedDate
+import config
+import fixtures
+import batch_output
+import emulate_spreadsheet
+import metrics
+import raster_operations
+import service
+
+__authors__ = "Jordan Hiatt"
+
+TODAY = '2026-03-15'
+LOCATION = 'US-95 MP 12'
+
+# A week of forecast from tomorrow
+def forecast_stand_in(lat, lon):
+    days = [(PinnedDate.today()+timedelta(days=i+1)).strftime('%Y-%m-%d') for i in range(7)]
+    lows = np.linspace(20, 30, 7) + (lat-45)
+    return raster_operations.Raster.forecast_frame(days, lows, lows+15)
+
+def saved_rows(path):
+    conn = sqlite3.connect(path)
+    counts = [conn.execute('SELECT count(*) FROM {}'.format(table)).fetchone()[0] for table in ('season_state', 'season_rows')]
+    conn.close()
+    return counts
+
+@pytest.fixture
+def running(upstreams, monkeypatch):
+    monkeypatch.setattr(config, 'resume_seasons', True)
+    breakup_service = service.BreakupService(forecast=forecast_stand_in)
+    breakup_service.warm()
+    server = service.make_server(breakup_service, host='127.0.0.1', port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield {'service': breakup_service, 'url': 'http://127.0.0.1:{}'.format(server.server_address[1]), 'folder': upstreams}
+    server.shutdown()
+    server.server_close()
+    breakup_service.stop()
+
+def get(running, path, **params):
+    return requests.get(running['url']+path, params=params)
+
+def breakup(running, lat, lon, location=LOCATION):
+    response = get(running, '/breakup', lat=lat, lon=lon, location=location)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+# The spreadsheet of the same days built the way a batch run builds it
+def expected_spreadsheet(lat, lon, location=LOCATION):
+    point = {'lat': lat, 'lon': lon, 'location': location, 'point_string': location}
+    df = batch_output.fetch_point(point, SEASON, TODAY, forecast_df=forecast_stand_in(lat, lon))
+    return emulate_spreadsheet.build_emulated_spreadsheet(lat, lon, location, df)
+
+def test_breakup_answer(running):
+    lats, lons = fixtures.make_points(1)
+    answer = breakup(running, lats[0], lons[0])
+    assert (answer['lat'], answer['lon'], answer['location']) == (pytest.approx(lats[0]), pytest.approx(lons[0]), LOCATION)
+    assert answer['day'] == TODAY
+    assert answer['cached'] is False
+
+    expected_df = expected_spreadsheet(lats[0], lons[0])
+    today = expected_df[expected_df['day'] == TODAY].iloc[0]
+    assert answer['roadway_status'] == today['roadway_status']
+    assert answer['average'] == pytest.approx(today['average'])
+    milestones = [(day, message) for day, message in zip(expected_df['day'], expected_df['message']) if message in emulate_spreadsheet.MILESTONES]
+    assert [(milestone['day'], milestone['message']) for milestone in answer['milestones']] == milestones
+    assert 'FREEZING STARTED' in [message for day, message in milestones]
+    breakup_days = [day for day, message in milestones if message == emulate_spreadsheet.MILESTONES[3]]
+    if breakup_days:
+        assert answer['breakup']['day'] == breakup_days[0]
+        assert answer['breakup_limits'] is (breakup_days[0] <= TODAY)
+    else:
+        assert answer['breakup'] is None and answer['breakup_limits'] is False
+
+    forecast_df = expected_df[expected_df['day'] > TODAY]
+    assert [day['day'] for day in answer['forecast']] == forecast_stand_in(lats[0], lons[0])['day'].tolist()
+    assert [day['roadway_status'] for day in answer['forecast']] == forecast_df['roadway_status'].tolist()
+    np.testing.assert_allclose([day['average'] for day in answer['forecast']], forecast_df['average'].to_numpy(dtype=float))
+
+def test_repeat_is_kept(running):
+    lats, lons = fixtures.make_points(2)
+    first = breakup(running, lats[0], lons[0])
+    again = breakup(running, lats[0], lons[0])
+    assert again['cached'] is True
+    assert dict(again, cached=False) == first
+    # A different location at the same point is its own answer
+    assert breakup(running, lats[0], lons[0], location='elsewhere')['cached'] is False
+    breakup(running, lats[1], lons[1])
+    assert metrics.get_metrics().summary()['names']['spreadsheet.emulate']['calls'] == 3
+
+    health = get(running, '/health').json()
+    assert health['season'] == SEASON
+    assert health['answers'] == 3
+    assert health['stations'] == 40
+    assert health['saved_states'] == 0
+
+# Queries only read the season states, after the batch run saves one the service carries on from it and gives the same answer
+def test_queries_never_save_states(running):
+    path = config.season_state_path
+    lats, lons = fixtures.make_points(2)
+    cold = breakup(running, lats[0], lons[0])
+    breakup(running, lats[1], lons[1])
+    assert saved_rows(path) == [0, 0]
+
+    point = {'lat': lats[0], 'lon': lons[0], 'location': LOCATION, 'point_string': LOCATION}
+    df = batch_output.fetch_point(point, SEASON, TODAY, forecast_df=forecast_stand_in(lats[0], lons[0]))
+    batch_output.emulate_points([point], [df], [None], SEASON)
+    saved = saved_rows(path)
+    assert saved[0] == 1 and saved[1] > 0
+
+    running['service'].refresh()
+    assert get(running, '/health').json()['saved_states'] == 1
+    resumed = breakup(running, lats[0], lons[0])
+    # The averages carry on from the saved sums, so they can be off in the last bits
+    assert resumed['average'] == pytest.approx(cold['average'])
+    assert dict(resumed, seconds=None, average=None) == dict(cold, seconds=None, average=None)
+    assert saved_rows(path) == saved
+
+def test_bad_requests(running):
+    response = get(running, '/breakup', lat='north', lon=-114.0)
+    assert response.status_code == 400
+    assert 'lat and lon' in response.json()['error']
+    assert get(running, '/breakup', lat=45.0).status_code == 400
+    response = get(running, '/nowhere')
+    assert response.status_code == 404
+    assert response.json() == {'error': 'unknown path /nowhere'}
+
+def history_counts():
+    entry = metrics.get_metrics().summary()['names']['service.history']
+    return entry['hits'], entry['misses']
+
+# The RWIS history of a point is only pulled from wx_history the first time, after that it's kept and a refresh pulls it again in bulk
+def test_histories_stay_warm(running):
+    lats, lons = fixtures.make_points(1)
+    first = breakup(running, lats[0], lons[0])
+    assert history_counts() == (0, 1)
+    breakup(running, lats[0], lons[0], location='elsewhere')
+    assert history_counts() == (1, 1)
+
+    running['service'].refresh()
+    assert get(running, '/health').json()['histories'] == 1
+    again = breakup(running, lats[0], lons[0])
+    assert again['cached'] is False
+    assert history_counts() == (2, 1)
+    assert metrics.get_metrics().summary()['names']['service.pull_histories']['items'] == 1
+    # The bulk pull does the IDW for every point at once, so the averages can be off in the last bits
+    assert again['average'] == pytest.approx(first['average'])
+    assert dict(again, seconds=None, average=None) == dict(first, seconds=None, average=None)
+
+# An answer that was being worked out when a refresh came in is given to the query that asked, but not kept
+def test_answer_from_before_refresh_is_dropped(running, monkeypatch):
+    lats, lons = fixtures.make_points(1)
+    refreshed = []
+    def refreshing_forecast(lat, lon):
+        if not refreshed:
+            refreshed.append(True)
+            running['service'].refresh()
+        return forecast_stand_in(lat, lon)
+    monkeypatch.setattr(running['service'], 'forecast', refreshing_forecast)
+    assert breakup(running, lats[0], lons[0])['cached'] is False
+    assert get(running, '/health').json()['answers'] == 0
+    assert breakup(running, lats[0], lons[0])['cached'] is False
+    assert breakup(running, lats[0], lons[0])['cached'] is True
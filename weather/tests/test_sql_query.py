@@ -0,0 +1,136 @@
+"""
+pull_data_bulk against a SQLite stand-in for wx_history (config.db_backend = 'sqlite', made by fixtures.write_history_db).
+Every point has to come out the same as its own pull_data, and as the original query that worked the distances out in SQL against
+every row of rwis_view, for points at the same coordinates, stations with days missing, days where a station only has one reading
+(the high is the low) and a point with no station in range. pull_data sends the same statement whatever the number of stations.
+"""
+import math
+import sqlite3
+import numpy as np
+import pandas as pd
+import pytest
+import config
+import db
+import fixtures
+import sql_query
+import station_index
+
+__authors__ = "Jordan Hiatt"
+
+START_DAY = '2025-10-01'
+END_DAY = '2025-12-31'
+
+# The original per point query, run in SQLite with the same functions SQL Server has
+ORIGINAL_QUERY = """
+    SELECT vds.dt_iso, sum(hi/POWER(distance_to_site,?))/sum(POWER(1/distance_to_site,?)) as hi_idw,
+    sum(lo/POWER(distance_to_site,?))/sum(POWER(1/distance_to_site,?)) as lo_idw
+    FROM (
+        SELECT
+        site, dt_iso, max(Air_Temp) as hi, min(Air_Temp) as lo,
+        avg(Lat__Decimal) as lat, avg(Long__Decimal) as lon, avg(distance_to_site) as distance_to_site
+            FROM (
+            SELECT
+                concat(substring(dt,7,5),'-',substring(dt,4,2),'-',substring(dt,1,2)) as dt_iso
+                ,[Air_Temp], rwis.[site], [dt]
+                ,its.Lat__Decimal, its.Long__Decimal
+                ,( 3959 * acos( cos( radians(?) ) * cos( radians( its.Lat__Decimal ) ) * cos( radians(its.Long__Decimal) - radians(?) ) + sin( radians(?) ) * sin( radians(its.Lat__Decimal)))) AS distance_to_site
+            FROM rwis_view as rwis
+            LEFT JOIN RWIS_Station_Locations as its
+                ON rwis.site=its.Station_Name ) as r
+            where r.dt_iso BETWEEN ? AND ?
+            and Air_Temp is not null
+            and distance_to_site is not null and distance_to_site < ?
+            group by dt_iso, r.site) as vds
+            group by vds.dt_iso
+            ORDER BY vds.dt_iso
+"""
+
+def original_pull_data(path, start_date, end_date, lat, lon):
+    conn = sqlite3.connect(path)
+    for name, function in (('acos', lambda x: math.acos(min(max(x, -1.0), 1.0))), ('cos', math.cos), ('sin', math.sin), ('radians', math.radians)):
+        conn.create_function(name, 1, function)
+    conn.create_function('substring', 3, db.sqlite_substring)
+    conn.create_function('concat', -1, db.sqlite_concat)
+    conn.create_function('power', 2, db.sqlite_power)
+    rows = conn.execute(ORIGINAL_QUERY, [config.idw_power]*4 + [lat, lon, lat, start_date, end_date, config.station_radius]).fetchall()
+    conn.close()
+    df = pd.DataFrame(rows, columns=['day', 'high', 'low']).dropna()
+    return df[df.high != df.low]
+
+@pytest.fixture
+def history(tmp_path, monkeypatch):
+    path = str(tmp_path / 'wx_history.sqlite')
+    stations_df = fixtures.make_stations(30)
+    # A station off by itself that only has one reading on some days
+    lonely = pd.DataFrame({'name': ['LONELY'], 'id': [999], 'lat': [44.0], 'lon': [-119.5]})
+    fixtures.write_history_db(path, pd.concat([stations_df, lonely], ignore_index=True), START_DAY, END_DAY)
+    conn = sqlite3.connect(path)
+    # Whole weeks missing at a couple of stations, and the lonely station down to one reading every other day
+    conn.execute("DELETE FROM rwis_view WHERE site = 'STATION3' AND dt LIKE '%/11/2025'")
+    conn.execute("DELETE FROM rwis_view WHERE site = 'STATION7' AND dt BETWEEN '01/12/2025' AND '20/12/2025' AND dt LIKE '%/12/2025'")
+    conn.execute("DELETE FROM rwis_view WHERE site = 'LONELY'")
+    for i, day in enumerate(pd.date_range(START_DAY, END_DAY).strftime('%d/%m/%Y')):
+        readings = [30.0+i % 7] if i % 2 == 0 else [25.0+i % 5, 38.0]
+        conn.executemany('INSERT INTO rwis_view VALUES (?, ?, ?)', [('LONELY', day, reading) for reading in readings])
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(config, 'db_backend', 'sqlite')
+    monkeypatch.setattr(config, 'db_sqlite_path', path)
+    monkeypatch.setattr(config, 'station_cache_path', str(tmp_path / 'station_locations.csv'))
+    monkeypatch.setattr(station_index, 'station_index', None)
+    db.reset_pool()
+    yield path
+    db.reset_pool()
+
+def test_bulk_matches_pull_data(history):
+    lats, lons = fixtures.make_points(8)
+    # Points 0 and 1 repeated, the lonely station and a point with nothing in range
+    lats = np.concatenate([lats, [lats[0], lats[1], lats[0], 44.05, 30.0]])
+    lons = np.concatenate([lons, [lons[0], lons[1], lons[0], -119.45, -100.0]])
+    bulk = sql_query.pull_data_bulk(START_DAY, END_DAY, lats, lons)
+    assert len(bulk) == len(lats)
+    for p, (lat, lon) in enumerate(zip(lats, lons)):
+        single = sql_query.pull_data(START_DAY, END_DAY, lat, lon)
+        original = original_pull_data(history, START_DAY, END_DAY, lat, lon)
+        for expected, rtol in ((single, 1e-9), (original, 1e-6)):
+            assert bulk[p]['day'].tolist() == expected['day'].tolist(), 'point {}'.format(p)
+            np.testing.assert_allclose(bulk[p]['high'].to_numpy(dtype=float), expected['high'].to_numpy(dtype=float), rtol=rtol, err_msg='point {}'.format(p))
+            np.testing.assert_allclose(bulk[p]['low'].to_numpy(dtype=float), expected['low'].to_numpy(dtype=float), rtol=rtol, err_msg='point {}'.format(p))
+
+    # Same coordinates, same days
+    for p, q in ((0, 8), (1, 9), (0, 10)):
+        pd.testing.assert_frame_equal(bulk[p].reset_index(drop=True), bulk[q].reset_index(drop=True))
+    # The lonely station's days with a single reading can't be used
+    assert 0 < len(bulk[11]) < len(pd.date_range(START_DAY, END_DAY))
+    assert len(bulk[12]) == 0
+
+def test_later_start_day(history):
+    lats, lons = fixtures.make_points(4)
+    bulk = sql_query.pull_data_bulk('2025-11-15', END_DAY, lats, lons)
+    for p, (lat, lon) in enumerate(zip(lats, lons)):
+        single = sql_query.pull_data('2025-11-15', END_DAY, lat, lon)
+        assert bulk[p]['day'].tolist() == single['day'].tolist()
+        np.testing.assert_allclose(bulk[p][['high', 'low']].to_numpy(dtype=float), single[['high', 'low']].to_numpy(dtype=float), rtol=1e-9)
+
+# Points with different numbers of stations in range get the same statement text, only the parameters change
+def test_pull_data_statement_has_one_shape(history, monkeypatch):
+    lats, lons = fixtures.make_points(8)
+    index = station_index.get_station_index()
+    counts = [len(index.stations_within(lat, lon)) for lat, lon in zip(lats, lons)]
+
+    statements = []
+    query_columns = db.query_columns
+    def recording(sql, params, columns):
+        statements.append((sql, len(params)))
+        return query_columns(sql, params, columns)
+    monkeypatch.setattr(db, 'query_columns', recording)
+    for lat, lon in zip(lats, lons):
+        sql_query.pull_data(START_DAY, END_DAY, lat, lon)
+    assert len(set(counts)) > 1 and max(counts) <= config.station_count
+    assert len(statements) == sum(count > 0 for count in counts)
+    assert len(set(statements)) == 1
+
+def test_station_slots(monkeypatch):
+    monkeypatch.setattr(config, 'station_count', 8)
+    assert [sql_query.station_slots(count) for count in (1, 7, 8, 9, 16, 17)] == [8, 8, 8, 16, 16, 24]
@@ -0,0 +1,46 @@
+"""
+The breakup table .png drawn by table_image: a week from the start of breakup limits, the way batch_output.breakup_table cuts it out
+of a spreadsheet. The header row is white and the average column is shaded from the lightest PuBu stop at its min to the darkest at its max.
+"""
+import numpy as np
+import pandas as pd
+from PIL import Image
+import batch_output
+import table_image
+
+__authors__ = "Jordan Hiatt"
+
+def breakup_week():
+    days = pd.date_range('2026-03-01', periods=10).strftime('%Y-%m-%d')
+    messages = [None]*10
+    messages[2] = batch_output.BREAKUP_MESSAGE
+    df = pd.DataFrame({'day': days, 'average': np.linspace(30.0, 48.0, 10), 'roadway_status': ['Thawing']*10, 'message': messages})
+    return batch_output.breakup_table(df)
+
+def hex_color(stop):
+    return tuple(int(stop[i:i+2], 16) for i in (1, 3, 5))
+
+def test_breakup_table_image(tmp_path):
+    table = breakup_week()
+    assert len(table) == 7
+    path = str(tmp_path / 'table.png')
+    table_image.render_table(table, path)
+    renderer = table_image.get_table_renderer()
+
+    # One column for the index and one for each of the table's, every row one line high
+    texts = [[''] + [renderer.cell_text(index) for index in table.index]]
+    texts += [[str(column)] + [renderer.cell_text(value) for value in table[column]] for column in table.columns]
+    widths = [max(renderer.text_size(text)[0] for text in column) + 2*renderer.padding for column in texts]
+    row_height = renderer.line_height + 2*renderer.padding
+    image = Image.open(path).convert('RGB')
+    assert image.size == (sum(widths)+1, 8*row_height+1)
+
+    # Just inside the top left corner of a cell, clear of its outline and its text
+    def background(column, row):
+        return image.getpixel((sum(widths[:column])+2, row*row_height+2))
+    average = 1 + list(table.columns).index('average')
+    assert background(average, 0) == (255, 255, 255)
+    assert background(average, 1) == hex_color(table_image.PUBU[0])
+    assert background(average, 7) == hex_color(table_image.PUBU[-1])
+    # Text columns aren't shaded
+    assert background(average+1, 4) == (255, 255, 255)
@@ -0,0 +1,90 @@
+"""
+ObservationCache with a stand-in for VaisalaObject.get_vaisala_xml that can be told to fail the way the export does:
+raising (an error status) or giving back nothing (a station that's offline or an error body that doesn't parse).
+Neither may be saved as days that have been asked for, so the next run's fetch fills them in. Nothing back is only asked for once a run.
+"""
+import io
+from datetime import datetime, timedelta
+import pandas as pd
+import pytest
+from conftest import PinnedDate
+import fixtures
+import vaisala_cache
+import vaisala_request
+
+__authors__ = "Jordan Hiatt"
+
+START = '2026-03-01'
+END = '2026-03-14'
+
+class StandInFetch():
+    def __init__(self):
+        self.script = []
+        self.calls = []
+
+    def __call__(self, station, fromdate, todate):
+        self.calls.append((fromdate, todate))
+        behaviour = self.script.pop(0) if self.script else 'ok'
+        if behaviour == 'error':
+            raise Exception('403 Client Error: Forbidden')
+        if behaviour == 'empty':
+            return pd.DataFrame({'site':[], 'timestamp':[], 't':[], 'rh':[], 'ts':[], 'st':[]})
+        # Asked for up to the day after, the same as get_vaisala_xml does
+        latest = (datetime.strptime(todate, '%Y-%m-%d')+timedelta(days=1)).strftime('%Y-%m-%d')
+        body = fixtures.vaisala_response({'station': [station], 'earliesttime': [fromdate], 'latesttime': [latest]})
+        df = vaisala_request.parse_vaisala_xml(io.BytesIO(body))
+        df['day'] = df['timestamp'].str.slice(0, 10)
+        return df[:-1]
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(vaisala_cache, 'date', PinnedDate)
+    return vaisala_cache.ObservationCache(path=str(tmp_path / 'vaisala_cache.sqlite'), settle_days=2)
+
+def test_days_are_saved(cache):
+    fetch = StandInFetch()
+    days_df = cache.get_station_days(7, START, END, fetch)
+    assert days_df.index.tolist() == pd.date_range(START, END).strftime('%Y-%m-%d').tolist()
+    assert cache.coverage('7') == (START, END)
+    # Only the unsettled days are asked for again by the next run
+    cache.forget_recent()
+    assert cache.coverage('7') == (START, '2026-03-13')
+    assert cache.get_station_days(7, START, END, fetch).equals(days_df)
+    assert fetch.calls == [(START, END), ('2026-03-14', END)]
+
+@pytest.mark.parametrize('behaviour', ['error', 'empty'])
+def test_failed_fetch_is_asked_for_again(cache, behaviour):
+    fetch = StandInFetch()
+    fetch.script = [behaviour]
+    if behaviour == 'error':
+        with pytest.raises(Exception):
+            cache.get_station_days(7, START, END, fetch)
+    else:
+        assert cache.get_station_days(7, START, END, fetch).empty
+    assert cache.saved_coverage('7') is None
+
+    # The next run finds the export working again and gets every day, not just the ones that haven't settled
+    cache.forget_recent()
+    days_df = cache.get_station_days(7, START, END, fetch)
+    assert fetch.calls == [(START, END), (START, END)]
+    assert days_df.index.tolist() == pd.date_range(START, END).strftime('%Y-%m-%d').tolist()
+    assert cache.coverage('7') == (START, END)
+
+# A station that gives nothing for the newer days keeps the days it already had
+def test_empty_fetch_keeps_cached_days(cache):
+    fetch = StandInFetch()
+    cached_df = cache.get_station_days(7, START, '2026-03-10', fetch)
+    fetch.script = ['empty']
+    days_df = cache.get_station_days(7, START, END, fetch)
+    assert days_df.equals(cached_df)
+    assert cache.saved_coverage('7') == (START, '2026-03-10')
+
+# The rest of the run doesn't ask for a station again after it gave nothing
+def test_empty_fetch_is_asked_for_once_a_run(cache):
+    fetch = StandInFetch()
+    fetch.script = ['empty', 'empty']
+    assert cache.get_station_days(7, START, END, fetch).empty
+    assert cache.get_station_days(7, START, END, fetch).empty
+    assert fetch.calls == [(START, END)]
+    assert cache.coverage('7') == (START, END)
+    assert cache.saved_coverage('7') is None
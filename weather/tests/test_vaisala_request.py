@@ -0,0 +1,99 @@
+"""
+fetch_stations against a local HTTP stand-in for the Vaisala export where some stations keep failing: one with a 5xx on every retry,
+one refused outright and one that answers with an HTML error page. Those stations are left out and the rest still come back,
+and none of the failures is saved as a station with no data.
+get_hi_lo_interpolated is checked against the day by day interpolation it replaced, with stations missing days.
+"""
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+import pytest
+from conftest import PinnedDate
+import config
+import fixtures
+import metrics
+import vaisala_cache
+import vaisala_request
+
+__authors__ = "Jordan Hiatt"
+
+START = '2026-03-01'
+END = '2026-03-14'
+STATUSES = {'1': 503, '2': 403}
+
+class FailingStandIn(fixtures.VaisalaStandIn):
+    def do_GET(self):
+        station = parse_qs(urlparse(self.path).query)['station'][0]
+        if station in STATUSES:
+            self.send_error(STATUSES[station])
+        elif station == '3':
+            self.send_body(b'<html><body>Service unavailable</body>', 'text/html')
+        else:
+            super().do_GET()
+
+@pytest.fixture
+def stand_in(tmp_path, monkeypatch):
+    server = fixtures.start_server(FailingStandIn)
+    monkeypatch.setattr(vaisala_cache, 'date', PinnedDate)
+    monkeypatch.setattr(config, 'vaisala_export_url', 'http://127.0.0.1:{}/vaisala?username=stand-in'.format(server.server_address[1]))
+    monkeypatch.setattr(config, 'vaisala_retries', 1)
+    monkeypatch.setattr(vaisala_cache, 'observation_cache', vaisala_cache.ObservationCache(path=str(tmp_path / 'vaisala_cache.sqlite')))
+    monkeypatch.setattr(vaisala_request, 'session', None)
+    metrics.start_run()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_failing_stations_are_left_out(stand_in):
+    station_days = vaisala_request.fetch_stations([0, 1, 2, 3, 4], START, END)
+    assert sorted(station_days) == [0, 3, 4]
+    for station_id in (0, 4):
+        assert station_days[station_id].index.tolist() == pd.date_range(START, END).strftime('%Y-%m-%d').tolist()
+    assert station_days[3].empty
+
+    cache = vaisala_cache.get_observation_cache()
+    assert [cache.saved_coverage(station) is None for station in ('0', '1', '2', '3', '4')] == [False, True, True, True, False]
+
+# The interpolation as it was first written, a day at a time and a station at a time in distance order. Stations without the day are
+# passed over (the first version raised on them) and days no station has are left out.
+def original_hi_lo_interpolated(station_days, stations_df, start_date, end_date):
+    rows = []
+    for day in pd.date_range(start=start_date, end=end_date).strftime('%Y-%m-%d'):
+        hi_num, lo_num, den_sum = 0, 0, 0
+        for station_id, dist in zip(stations_df['id'], stations_df['distance']):
+            days_df = station_days.get(station_id)
+            if days_df is None or day not in days_df.index or np.isnan(days_df['hi'].loc[day]):
+                continue
+            hi_num += days_df['hi'].loc[day]/(dist**config.idw_power)
+            lo_num += days_df['lo'].loc[day]/(dist**config.idw_power)
+            den_sum += 1/(dist**config.idw_power)
+        if den_sum > 0:
+            rows.append((day, (hi_num/den_sum)*(9/5)+32.0, (lo_num/den_sum)*(9/5)+32.0))
+    return pd.DataFrame(rows, columns=['day', 'high', 'low'])
+
+def test_interpolation_matches_day_by_day(monkeypatch):
+    lat, lon = 45.0, -114.0
+    stations_df = fixtures.nearest_stations(fixtures.make_stations(40), lat, lon)
+    days = pd.date_range(START, END).strftime('%Y-%m-%d')
+    rng = np.random.default_rng(3)
+    station_days = {}
+    for station_id in stations_df['id']:
+        average = rng.normal(2, 8, len(days))
+        days_df = pd.DataFrame({'hi': average+rng.uniform(2, 8, len(days)), 'lo': average-rng.uniform(2, 8, len(days))}, index=days)
+        # Every station misses some days, and none of them has the 5th
+        keep = rng.random(len(days)) > 0.3
+        keep[4] = False
+        station_days[station_id] = days_df[keep]
+    # One station left out altogether, one that gave nothing back
+    del station_days[stations_df['id'].iloc[2]]
+    station_days[stations_df['id'].iloc[5]] = station_days[stations_df['id'].iloc[5]].iloc[:0]
+
+    monkeypatch.setattr(vaisala_request.VaisalaObject, 'get_station_ids', lambda self: stations_df)
+    monkeypatch.setattr(vaisala_request, 'fetch_stations', lambda station_ids, start_date, end_date, worker=None: station_days)
+    result_df = vaisala_request.VaisalaObject(lat, lon).get_hi_lo_interpolated(START, END)
+    expected_df = original_hi_lo_interpolated(station_days, stations_df, START, END)
+    assert days[4] not in result_df['day'].tolist()
+    assert result_df['day'].tolist() == expected_df['day'].tolist()
+    # Exactly the same, not just close
+    np.testing.assert_array_equal(result_df['high'].to_numpy(), expected_df['high'].to_numpy())
+    np.testing.assert_array_equal(result_df['low'].to_numpy(), expected_df['low'].to_numpy())
@@ -0,0 +1,120 @@
+"""
+Local cache of the daily high/low at each Vaisala station so the same history isn't downloaded again for every nearby point and every daily run.
+Days are kept in a SQLite file keyed by station and day, along with the range of days that has already been asked for.
+Only days older than config.vaisala_settle_days are treated as final, so the last day or two are always asked for again.
+"""
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from datetime import date
+import pandas as pd
+import config
+import metrics
+
+__authors__ = "Jordan Hiatt"
+
+class ObservationCache():
+    def __init__(self, path=None, settle_days=None):
+        self.path = path if path is not None else config.vaisala_cache_path
+        self.settle_days = settle_days if settle_days is not None else config.vaisala_settle_days
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS station_days (station TEXT, day TEXT, hi REAL, lo REAL, PRIMARY KEY (station, day))')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS station_coverage (station TEXT PRIMARY KEY, first_day TEXT, last_day TEXT)')
+        self.conn.commit()
+        # The SQLite connection is shared between threads, so only one uses it at a time
+        self.db_lock = threading.Lock()
+        # Points that share a station wait on each other instead of both downloading it
+        self.station_locks = {}
+        self.station_locks_lock = threading.Lock()
+        # Everything that's been read or fetched this run, station -> DataFrame of hi/lo indexed by day. 
+        # run_coverage also includes the recent days that aren't saved and the days a fetch gave nothing for, so nearby points don't ask for them again. 
+        self.memory = {}
+        self.run_coverage = {}
+
+    def station_lock(self, station):
+        with self.station_locks_lock:
+            if station not in self.station_locks:
+                self.station_locks[station] = threading.Lock()
+            return self.station_locks[station]
+
+    # (first_day, last_day) that has been asked for, from this run or else from the file
+    def coverage(self, station):
+        if station in self.run_coverage:
+            return self.run_coverage[station]
+        return self.saved_coverage(station)
+
+    # (first_day, last_day) saved in the file, what the next run starts from
+    def saved_coverage(self, station):
+        with self.db_lock:
+            return self.conn.execute('SELECT first_day, last_day FROM station_coverage WHERE station = ?', (station,)).fetchone()
+
+    def read_station(self, station):
+        if station not in self.memory:
+            with self.db_lock:
+                rows = self.conn.execute('SELECT day, hi, lo FROM station_days WHERE station = ? ORDER BY day', (station,)).fetchall()
+            self.memory[station] = pd.DataFrame.from_records(rows, columns=['day', 'hi', 'lo']).set_index('day')
+        return self.memory[station]
+
+    def store(self, station, daily_df, first_day, last_day):
+        rows = [(station, day, float(hi), float(lo)) for day, hi, lo in zip(daily_df.index, daily_df['hi'], daily_df['lo'])]
+        with self.db_lock:
+            self.conn.executemany('INSERT OR REPLACE INTO station_days VALUES (?, ?, ?, ?)', rows)
+            self.conn.execute('INSERT OR REPLACE INTO station_coverage VALUES (?, ?, ?)', (station, first_day, last_day))
+            self.conn.commit()
+
+    # Daily hi/lo of one station from start_date to end_date (inclusive, YYYY-mm-dd), indexed by day.
+    # fetch(station, fromdate, todate) is VaisalaObject.get_vaisala_xml and is only called for the days the cache doesn't have.
+    def get_station_days(self, station, start_date, end_date, fetch):
+        station = str(station)
+        with self.station_lock(station):
+            coverage = self.coverage(station)
+            if coverage is None or start_date < coverage[0]:
+                fetch_start, first_day = start_date, start_date
+                last_day = end_date if coverage is None else max(end_date, coverage[1])
+            elif end_date > coverage[1]:
+                fetch_start = (datetime.strptime(coverage[1], '%Y-%m-%d')+timedelta(days=1)).strftime('%Y-%m-%d')
+                first_day, last_day = coverage[0], end_date
+            else:
+                fetch_start = None
+
+            if fetch_start is not None:
+                metrics.get_metrics().miss('vaisala.cache')
+                vai_df = fetch(station, fetch_start, last_day)
+                # Nothing back means the station is offline or the export gave an error body, so the days are only marked as asked for 
+                # in this run and the next run asks for them again. Whatever the cache already has is still given back. 
+                if not vai_df.empty:
+                    daily_df = pd.DataFrame(columns=['hi', 'lo'], index=pd.Index([], dtype=str, name='day'))
+                    daily_df['hi'] = vai_df.groupby(by="day")['t'].max()
+                    daily_df['lo'] = vai_df.groupby(by="day")['t'].min()
+
+                    # Only days up to final_day are saved, the newer ones can still change upstream
+                    final_day = (date.today()-timedelta(days=self.settle_days)).strftime('%Y-%m-%d')
+                    if min(last_day, final_day) >= first_day:
+                        self.store(station, daily_df[daily_df.index <= final_day], first_day, min(last_day, final_day))
+
+                    station_df = pd.concat([self.read_station(station), daily_df])
+                    self.memory[station] = station_df[~station_df.index.duplicated(keep='last')].sort_index()
+                self.run_coverage[station] = (first_day, last_day)
+
+            else:
+                metrics.get_metrics().hit('vaisala.cache')
+
+            station_df = self.read_station(station)
+            return station_df[(station_df.index >= start_date) & (station_df.index <= end_date)]
+
+    # Drops what's been fetched in memory so the recent days that aren't saved are asked for again, for a process that keeps running (service.py)
+    def forget_recent(self):
+        with self.station_locks_lock:
+            self.memory = {}
+            self.run_coverage = {}
+
+# One cache for the whole process
+observation_cache = None
+observation_cache_lock = threading.Lock()
+
+def get_observation_cache():
+    global observation_cache
+    with observation_cache_lock:
+        if observation_cache is None:
+            observation_cache = ObservationCache()
+        return observation_cache
@@ -3,18 +3,119 @@
 Pulls 8 stations closest to a lat/lon point, then queries VAISALA using those station codes and the date range. 
 Finally we use inverse square with temperature and distance from the point to get an estimation at that point. 
 """
-import pyodbc
+import numpy as np
 import pandas as pd
 import pprint as pp
 import os
 import config
+import station_index
+import vaisala_cache
+import metrics
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import xml.etree.ElementTree as et
+from array import array
 from datetime import datetime, timedelta
 from datetime import date
 
 __authors__ = "Jordan Hiatt"
 
+# Parses a Vaisala export as it streams in, so the whole response and the whole tree are never held at once. 
+# Every instance under the root is a station with a name and a resultOf for each observation time, each of those has value 
+# elements coded T, RH, TS and ST. Elements are cleared as soon as they've been read and the values go straight into typed arrays. 
+# Missing values are -999.99, and every observation in an instance gets the last name in that instance, same as walking the full tree. 
+def parse_vaisala_xml(source):
+    site = []
+    timestamp = []
+    t = array('d')
+    rh = array('d')
+    ts = array('d')
+    st = array('d')
+    depth = 0
+    root = None
+    name = None
+    instance_start = 0
+    for event, elem in et.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        tag = elem.tag
+        if tag == 'name':
+            name = elem.text
+        elif tag == 'resultOf':
+            timestamp.append(elem.get('timestamp'))
+            foo3, foo4, foo5, foo6 = -999.99,-999.99,-999.99,-999.99
+            for val in elem.iterfind('value'):
+                code = val.get('code')
+                if code == 'T':
+                    foo3 = float(val.text)
+                elif code == 'RH':
+                    foo4 = float(val.text)
+                elif code == 'TS':
+                    foo5 = float(val.text)
+                elif code == 'ST':
+                    foo6 = float(val.text)
+            t.append(foo3)
+            rh.append(foo4)
+            ts.append(foo5)
+            st.append(foo6)
+            elem.clear()
+        if depth == 1:
+            # End of an instance, now we know its name
+            site.extend([name]*(len(timestamp) - instance_start))
+            instance_start = len(timestamp)
+            root.clear()
+    return pd.DataFrame({'site':site, 'timestamp':timestamp, 't':np.frombuffer(t).copy(), 'rh':np.frombuffer(rh).copy(), 
+                         'ts':np.frombuffer(ts).copy(), 'st':np.frombuffer(st).copy()})
+
+# One session for every Vaisala request so connections are kept alive and reused, with retries on connection errors and 5xx/429. 
+# After the last retry the error response is given back instead of raising, so get_vaisala_xml's raise_for_status reports it. 
+session = None
+session_lock = threading.Lock()
+
+def get_session():
+    global session
+    with session_lock:
+        if session is None:
+            session = requests.Session()
+            retry = Retry(total=config.vaisala_retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'], raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.vaisala_max_concurrency, max_retries=retry)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        return session
+
+# Daily hi/lo for each station from the cache, with the stations that need downloading fetched at the same time 
+# (at most config.vaisala_max_concurrency at once). Gives back station id -> DataFrame of hi/lo indexed by day. 
+# Used for the stations of one point, or for every station of a batch up front. 
+# A station that can't be fetched is left out, same as a station with no data, instead of failing the rest. 
+def fetch_stations(station_ids, start_date, end_date, worker=None):
+    cache = vaisala_cache.get_observation_cache()
+    fetcher = VaisalaObject(None, None)
+    station_days = {}
+    with ThreadPoolExecutor(max_workers=config.vaisala_max_concurrency) as pool:
+        futures = {}
+        for station_id in station_ids:
+            futures[pool.submit(cache.get_station_days, station_id, start_date, end_date, fetcher.get_vaisala_xml)] = station_id
+        for done_count, future in enumerate(as_completed(futures)):
+            # Emitted signal in the case of a PyQt GUI using the object from a worker 
+            if worker is not None:
+                worker.emit_progress("Got data from VAISALA station {} out of {}\n".format(done_count+1, len(futures)))
+            if config.cancel_flag:
+                for f in futures:
+                    f.cancel()
+                raise Exception('Operation Cancelled')
+            try:
+                station_days[futures[future]] = future.result()
+            except Exception as e:
+                print('Skipping VAISALA station {}: {}'.format(futures[future], e))
+    return station_days
+
 class VaisalaObject():
     # The worker parameter is in case this object is used with a GUI, which would emit signals that updates the GUI from a separate thread. 
     def __init__(self, lat, lon, worker=None):
@@ -26,31 +127,9 @@ class VaisalaObject():
         return temp*(9/5)+32.0
 
     # Pulls all of the closest stations along with their distances to the point. 
+    # These come from the local station index, so it's the same 8 closest stations with no radius that the SQL used to give. 
     def get_station_ids(self):
-        conn = pyodbc.connect('Driver={SQL Server};'
-                            'Server=ITD9HTSPC219328;'
-                            'Database=wx_history;'
-                            'Trusted_Connection=yes;')
-        # print('{} {}'.format(self.lat, self.lon))
-        cursor = conn.cursor()
-        df = pd.DataFrame(columns=['name', 'id', 'lat', 'lon', 'distance'])
-        cursor.execute("""
-        DECLARE @Latitude FLOAT SET @Latitude   =   {}
-        DECLARE @Longitude FLOAT SET @Longitude = {}
-        DECLARE @DOI Date SET @DOI              = '2021-04-05'
-        DECLARE @HOWMANYSITETOFIGURE INTEGER SET @HOWMANYSITETOFIGURE = 8
-        DECLARE @RADIUSTOSITES FLOAT SET @RADIUSTOSITES = 50 -- in miles
-        DECLARE @IDW_POWER FLOAT SET @IDW_POWER = 1.2
-
-        SELECT  -- (would be more efficient to compute distance in a further out query, but I got this to work!)
-            TOP 8 Station_Name, Station_ID, its.Lat__Decimal, its.Long__Decimal
-            ,( 3959 * acos( cos( radians(@Latitude) ) * cos( radians( its.Lat__Decimal ) ) * cos( radians(its.Long__Decimal) - radians(@Longitude) ) + sin( radians(@Latitude) ) * sin( radians(its.Lat__Decimal)))) AS distance_to_site 
-        FROM RWIS_Station_Locations as its
-        Order by distance_to_site
-        """.format(self.lat, self.lon))
-        for row in cursor:
-            df = df.append({'name': row[0], 'id': row[1], 'lat':row[2], 'lon':row[3], 'distance':row[4]}, ignore_index=True)
-        return(df)
+        return station_index.get_station_index().nearest_stations(self.lat, self.lon, radius=False)
 
     # Query the vaisala database over a range of dates. It gives back xml which needs to be parsed. 
     # To get the full day we need to push the request ahead by a day and drop the last entry in the dataframe
@@ -58,89 +137,67 @@ class VaisalaObject():
         #date format is YYYY-mm-dd[ HH:MM:SS]  (todate is non-inclusive)
         to_date_forward = datetime.strptime(todate, '%Y-%m-%d')+timedelta(hours=24)
         to_date_forward_str = to_date_forward.strftime("%Y-%m-%d")
-        url = 'https://exportdb.vaisala.io/export?username=idt&password=Data4Idaho'
+        url = config.vaisala_export_url
         if len(str(siteid)) > 0:
             url = url + '&station='+str(siteid)
         if len(fromdate) > 0 and len(todate) > 0:
             url = url + '&earliesttime=' + fromdate + '&latesttime='+ to_date_forward_str 
-        r = requests.get(url)
-        xml_string = r.text
-        site = []
-        timestamp = []
-        t    = []
-        rh   = []
-        ts   = []
-        st   = []
-        try:
-            xroot = et.fromstring(xml_string)
-        except et.ParseError:
-            return pd.DataFrame({'site':site, 'timestamp':timestamp, 't':t, 'rh':rh, 'ts':ts, 'st':st})
-        for instance in xroot:
-            for name in instance.iter('name'):
-                foo1 = name.text
-            for resultOf in instance.iter('resultOf'):
-                foo2 = resultOf.get('timestamp')
-                foo3, foo4, foo5, foo6 = -999.99,-999.99,-999.99,-999.99,
-                for val in resultOf.findall('value'):
-                    if val.get('code') == 'T':
-                        foo3 = float(val.text)
-                    if val.get('code') == 'RH':
-                        foo4 = float(val.text)
-                    if val.get('code') == 'TS':
-                        foo5 = float(val.text)
-                    if val.get('code') == 'ST':
-                        foo6 = float(val.text)
-                site.append(foo1)
-                timestamp.append(foo2)
-                t.append(foo3)
-                rh.append(foo4)
-                ts.append(foo5)
-                st.append(foo6)
-        df = pd.DataFrame({'site':site, 'timestamp':timestamp, 't':t, 'rh':rh, 'ts':ts, 'st':st})
+        with metrics.get_metrics().timer('vaisala.request'):
+            with get_session().get(url, stream=True, timeout=config.vaisala_timeout) as r:
+                # An error status isn't read as a station with no data, so it's never cached as one
+                r.raise_for_status()
+                # Let urllib3 undo any gzip so the parser gets plain XML
+                r.raw.decode_content = True
+                try:
+                    df = parse_vaisala_xml(r.raw)
+                except et.ParseError:
+                    df = None
+                finally:
+                    # Bytes as they came over the wire, before any gzip is undone
+                    metrics.get_metrics().add('vaisala.request', bytes=r.raw.tell())
+        if df is None:
+            return pd.DataFrame({'site':[], 'timestamp':[], 't':[], 'rh':[], 'ts':[], 'st':[]})
+        metrics.get_metrics().add('vaisala.request', items=len(df))
         df['day'] = df['timestamp'].str.slice(0, 10)
         return df[:-1]
 
     def get_hi_lo_interpolated(self, start_date, end_date):
-        result_df = pd.DataFrame()
-        df_list = []
-        date_temp_tuples = []
         stations_df = self.get_station_ids()
-        for i, row in stations_df.iterrows():
-            # Emitted signal in the case of a PyQt GUI using the object from a worker 
-            if self.worker is not None:
-                self.worker.emit_progress("Getting data from VAISALA station {} out of {}\n".format(i+1, len(stations_df)))
-                if config.cancel_flag:
-                    raise Exception('Operation Cancelled')
-
-            # get_vaisala_xml could possibly return an empty dataframe if the station isn't working
-            vai_df = self.get_vaisala_xml(row[1],start_date, end_date)
-            if not vai_df.empty:
-                vai_df['distance'] = row[4]
-                grouped_df = pd.DataFrame()
-                grouped_df['hi'] = vai_df.groupby(by="day")['t'].max()
-                grouped_df['lo'] = vai_df.groupby(by="day")['t'].min()
-                grouped_df['distance'] = row[4]
-                df_list.append(grouped_df)
-        date_range = pd.date_range(start=start_date, end=end_date)
-        for date in date_range: 
-            hi_num, lo_num, den_sum = 0,0,0
-            date_string = date.strftime('%Y-%m-%d')
-            for df in df_list:
-                dist = df['distance'].iloc[0]
-                hi = df['hi'].loc[date_string]
-                lo = df['lo'].loc[date_string]
-                hi_num += hi/(dist**1.2)
-                lo_num += lo/(dist**1.2)
-                den_sum += 1/(dist**1.2)
-            interp_hi = (hi_num/den_sum)
-            interp_lo = (lo_num/den_sum)            
-            result_df = result_df.append({'day': date_string,'high': self.cel_to_faren(interp_hi), 'low': self.cel_to_faren(interp_lo)}, ignore_index=True)
-            print(result_df)
+        # All of the stations are requested at the same time, a station could possibly be empty or left out if it isn't working
+        station_days = fetch_stations(stations_df['id'].tolist(), start_date, end_date, self.worker)
+
+        # Station x day matrices of the highs and lows, NaN where a station has nothing for the day
+        days = pd.date_range(start=start_date, end=end_date).strftime('%Y-%m-%d')
+        no_days = pd.DataFrame({'hi': [], 'lo': []}, dtype=float)
+        hi = np.array([station_days.get(station_id, no_days)['hi'].reindex(days).to_numpy(dtype=float) for station_id in stations_df['id']]).reshape(len(stations_df), len(days))
+        lo = np.array([station_days.get(station_id, no_days)['lo'].reindex(days).to_numpy(dtype=float) for station_id in stations_df['id']]).reshape(len(stations_df), len(days))
+        has_data = ~np.isnan(hi)
+
+        # Inverse distance weighting over every day at once, a station only counts on the days it has data. 
+        # The stations are still added up one at a time in distance order, the order the day by day version added them, so every sum 
+        # comes out bit for bit the same (test_vaisala_request checks it). A masked matrix product would add them in whatever order BLAS 
+        # picks and could be off in the last bits. It's only a loop over the config.station_count nearest stations, each step does every day. 
+        hi_num = np.zeros(len(days))
+        lo_num = np.zeros(len(days))
+        den_sum = np.zeros(len(days))
+        for i, dist in enumerate(stations_df['distance']):
+            dist_power = dist**config.idw_power
+            hi_num += np.where(has_data[i], hi[i]/dist_power, 0.0)
+            lo_num += np.where(has_data[i], lo[i]/dist_power, 0.0)
+            den_sum += np.where(has_data[i], 1/dist_power, 0.0)
+
+        # Days that no station has anything for are left out, same as the SQL does
+        found = den_sum > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            interp_hi = hi_num/den_sum
+            interp_lo = lo_num/den_sum
+        result_df = pd.DataFrame({'day': days[found], 'high': self.cel_to_faren(interp_hi[found]), 'low': self.cel_to_faren(interp_lo[found])})
         return result_df
 
     # TODO: existing file must match metadata of request to bother appending. 
     # Looks for historical_data created by the SQL query, and creates a new .csv by appending this data onto that file. 
-    def append_existing_file(self, in_df):
+    # first_day is where to start if in_df is empty, which happens when a run carries on from a saved state and the SQL history hasn't caught up yet
+    def append_existing_file(self, in_df, first_day=None):
         # if file exists, check most recent date 
         today_string = date.today().strftime('%Y-%m-%d')
         # file_name = 'historical_data.csv'
@@ -149,9 +206,12 @@ class VaisalaObject():
             # reading csv have to set index col to 1 to grab the 'day' from it
             # df = pd.read_csv('historical_data.csv', header=0)
         df = in_df.copy()
-        last_day_string = df['day'].iloc[-1]
-        next_day_after_last = (datetime.strptime(last_day_string, '%Y-%m-%d')+timedelta(days=1)).strftime('%Y-%m-%d')
-        df = df.append(self.get_hi_lo_interpolated(next_day_after_last, today_string), ignore_index=True)
+        if df.empty and first_day is not None:
+            next_day_after_last = first_day
+        else:
+            last_day_string = df['day'].iloc[-1]
+            next_day_after_last = (datetime.strptime(last_day_string, '%Y-%m-%d')+timedelta(days=1)).strftime('%Y-%m-%d')
+        df = pd.concat([df, self.get_hi_lo_interpolated(next_day_after_last, today_string)], ignore_index=True)
 
         # create a new file as to not ruin the one that takes forever to make
         # if os.path.exists(append_file_name):
@@ -13,6 +13,7 @@ import pandas as pd
 import os
 import math
 import time
+import record_batch
 
 def build_url(lon, lat):
     #url = 'https://api.weather.gov/points/{0},{1}/forecast'.format(lat, lon)
@@ -23,28 +24,30 @@ def build_url(lon, lat):
     forecast_url = r.json()['properties']['forecastHourly']
     return forecast_url
 
-# url = build_url(-74.3, 40.6)  # ny
-url = build_url(-116.3, 43.6)  # boi
-r = requests.get(url)
+# Prints the hourly forecast for Boise, averaged by day
+if __name__ == "__main__":
+    # url = build_url(-74.3, 40.6)  # ny
+    url = build_url(-116.3, 43.6)  # boi
+    r = requests.get(url)
 
-r_json = r.json()
+    r_json = r.json()
 
-#print([[r_json['properties']['periods'][i]['temperature'], 
-#        r_json['properties']['periods'][i]['name'],
-#        r_json['properties']['periods'][i]['shortForecast']]
-#       for i in range(len(r_json['properties']['periods']))])
+    #print([[r_json['properties']['periods'][i]['temperature'], 
+    #        r_json['properties']['periods'][i]['name'],
+    #        r_json['properties']['periods'][i]['shortForecast']]
+    #       for i in range(len(r_json['properties']['periods']))])
 
-temps_df = pd.DataFrame(columns=['day', 'avg'])
+    temps = record_batch.RecordBatchBuilder([('day', object), ('avg', float)])
 
-for i in range(len(r_json['properties']['periods'])):
-    cd_string = r_json['properties']['periods'][i]['startTime']
-    temp = r_json['properties']['periods'][i]['temperature']
-    temps_df = temps_df.append({'day':cd_string, 'avg':temp}, ignore_index=True)
+    for i in range(len(r_json['properties']['periods'])):
+        cd_string = r_json['properties']['periods'][i]['startTime']
+        temp = r_json['properties']['periods'][i]['temperature']
+        temps.append_values((cd_string, temp))
 
-temps_df.index.name = 'index'
-temps_df['day_only'] = temps_df['day'].str.slice(start=8,stop=10)
-#print(temps_df)
-print(temps_df.groupby(['day_only'],as_index=False).mean())
+    temps_df = temps.build(index_name='index')
+    temps_df['day_only'] = temps_df['day'].str.slice(start=8,stop=10)
+    #print(temps_df)
+    print(temps_df[['day_only','avg']].groupby(['day_only'],as_index=False).mean())
 
 
 